@@ -12,7 +12,8 @@
 # - Add coding rate control
 # ===
 # Notes
-#
+#   The responses are read line by line and matched against COMMAND_GRAMMAR, the lines
+#   no command expects (late mac_tx_ok, mac_rx, ...) go to the unsolicited handlers.
 # ===
 # M.Alexandre   oct.24  creation
 #
@@ -23,20 +24,172 @@
 #
 
 import time
+import zlib
+from collections import Counter, namedtuple
 from typing import Dict
-import datetime
 import logging
 import serial
 
+import cycle_trace
+
 # #############################################################################
 #
 # Global Variables & Configs
 #
 
-#Logger
-logging.basicConfig(level=logging.DEBUG,
-            format='%(asctime)s,%(msecs)03d %(levelname)-8s - [%(filename)s:%(lineno)d] - \
-%(threadName)s - %(message)s')
+#Logger of the per command traces, can be rate limited (see log_config)
+trace = logging.getLogger("RN2483.trace")
+
+#User EEPROM address of the configuration fingerprint (4 bytes, see warm_start_abp)
+FINGERPRINT_NVM_ADDRESS = 0x300
+
+#Timeout of one read on the port, fixed : setting it reconfigures the port (tcsetattr).
+#read_line checks its deadline between the reads.
+READ_TIMEOUT = 0.1
+
+# #############################################################################
+#
+# Response grammar
+#
+
+#Status code of the status tokens
+#   0 - Standard response
+#   1 - Error
+#   3 - Timeout (no token)
+RESPONSE_STATUS = {
+    "ok":0,
+    "invalid_param":1,
+    "keys_not_init":1,
+    "no_free_ch":1,
+    "silent":1,
+    "busy":1,
+    "mac_paused":1,
+    "not_joined":1,
+    "frame_counter_err_rejoin_needed":1,
+    "invalid_data_len":1,
+    "accepted":0,
+    "denied":1,
+    "mac_tx_ok":0,
+    "mac_rx":0,
+    "mac_err":1,
+    "radio_tx_ok":0,
+    "radio_rx":0,
+    "radio_err":1,
+}
+
+#First response of a command
+STATUS = "status"   #A status token of RESPONSE_STATUS
+VALUE = "value"     #Any line, the value asked (mac get, sys get, version after a reset)
+
+#Expected responses per command, looked up by the longest matching prefix :
+#   (first response, tokens of the second response or None if there is no second one)
+COMMAND_GRAMMAR = {
+    "":(STATUS,None),
+    "mac get":(VALUE,None),
+    "sys get":(VALUE,None),
+    "radio get":(VALUE,None),
+    "sys reset":(VALUE,None),
+    "sys factoryRESET":(VALUE,None),
+    "mac tx":(STATUS,("mac_tx_ok","mac_rx","mac_err","invalid_data_len")),
+    "mac join":(STATUS,("accepted","denied")),
+    "radio tx":(STATUS,("radio_tx_ok","radio_err")),
+    "radio rx":(STATUS,("radio_rx","radio_err")),
+}
+
+#Tokens that can arrive without being asked (second responses of a command that timed out)
+UNSOLICITED_TOKENS = ("mac_tx_ok","mac_rx","mac_err","accepted","denied","radio_tx_ok",
+                      "radio_rx","radio_err")
+
+#Status tokens of a first response
+FIRST_RESPONSE_TOKENS = tuple(token for token in RESPONSE_STATUS
+                              if token not in UNSOLICITED_TOKENS)
+
+Reply = namedtuple("Reply",["line","token","status","args"])
+
+def parse_line(line:str):
+    """
+    Parse one decoded line of the module.
+    Params:
+        line:str : Decoded line without the CRLF
+    Returns:
+        reply:Reply : token is the first word, status the code of RESPONSE_STATUS or None
+            if the line is a value, args the other words
+    """
+    words = line.split()
+    token = words[0] if words else ""
+    return Reply(line,token,RESPONSE_STATUS.get(token),words[1:])
+
+def command_grammar(command:str):
+    """
+    Get the expected responses of a command.
+    Params:
+        command:str : Command sent to the module
+    Returns:
+        (first,second) : see COMMAND_GRAMMAR
+    """
+    words = command.split()
+    for length in range(len(words),-1,-1):
+        grammar = COMMAND_GRAMMAR.get(" ".join(words[:length]))
+        if grammar is not None:
+            return grammar
+    return COMMAND_GRAMMAR[""]
+
+# #############################################################################
+#
+# Class CommandCounters
+#
+
+class CommandCounters:
+    """
+    Counters of the serial traffic, a cheap summary replacing the per line debug output
+    """
+    def __init__(self):
+        self.commands = Counter()
+        self.status_codes = Counter()
+        self.errors = Counter()
+        self.lines = 0
+        self.unsolicited = 0
+        self.serial_time = 0.0
+
+    @staticmethod
+    def command_name(command:str):
+        """
+        Get the name of a command without its arguments.
+        Params:
+            command:str : Command sent to the module, e.g. "mac set dr 5"
+        Returns:
+            name:str : e.g. "mac set dr"
+        """
+        words = command.split()
+        if len(words) > 2 and words[1] in ("set","get"):
+            return " ".join(words[:3])
+        return " ".join(words[:2])
+
+    def record(self,command:str,status_code:int,nb_lines:int,elapsed:float):
+        """
+        Count a command.
+        Params:
+            command:str : Command sent to the module
+            status_code:int : Status code returned
+            nb_lines:int : Number of lines received
+            elapsed:float : Time spent waiting for the response in seconds
+        """
+        name = self.command_name(command)
+        self.commands[name] += 1
+        self.status_codes[status_code] += 1
+        if status_code != 0:
+            self.errors[name] += 1
+        self.lines += nb_lines
+        self.serial_time += elapsed
+
+    def summary(self):
+        """
+        Returns:
+            summary:dict : Copy of the counters
+        """
+        return {"commands":dict(self.commands),"status_codes":dict(self.status_codes),
+                "errors":dict(self.errors),"lines":self.lines,"unsolicited":self.unsolicited,
+                "serial_time":round(self.serial_time,3)}
 
 # #############################################################################
 #
@@ -53,60 +206,127 @@ class RN2483( serial.Serial ):
         serial.Serial.__init__(
             self,port=port, baudrate=baudrate,
             bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
-            timeout=1, xonxoff=False, rtscts=False, write_timeout=None,
+            timeout=READ_TIMEOUT, xonxoff=False, rtscts=False, write_timeout=None,
             dsrdtr=False, inter_byte_timeout=None, exclusive=None
         )
+        self.counters = CommandCounters()
+        self.unsolicited_handlers = []
+        self._partial = b''
 
-    def send_command(self,data:str,timeout:int=10):
+    def add_unsolicited_handler(self,handler):
         """
-        Method used for sending a command to the module
-        TODO : write docstring
+        Register a function called with the lines received while no command expects them
+        (see UNSOLICITED_TOKENS).
+        Params:
+            handler:Callable[[Reply],None] : Called with the parsed line
+        """
+        self.unsolicited_handlers.append(handler)
+
+    def _route_unsolicited(self,reply:Reply):
+        """
+        Give an unexpected line to the unsolicited handlers.
+        Params:
+            reply:Reply : Parsed line
+        """
+        logging.debug("Unsolicited line : %s",reply.line)
+        self.counters.unsolicited += 1
+        for handler in self.unsolicited_handlers:
+            handler(reply)
+
+    def read_line(self,deadline:float):
+        """
+        Read one non empty line, blocking until it is complete or the deadline.
+        Params:
+            deadline:float : time.monotonic() value after which we give up
+        Returns:
+            line:str|None : Decoded line without the CRLF, None at the deadline
+        """
+        while True:
+            if time.monotonic() >= deadline:
+                return None
+            self._partial += self.readline()
+            if not self._partial.endswith(b'\n'):
+                continue
+            line = self._partial.decode('utf-8',errors='replace').strip()
+            self._partial = b''
+            if line:
+                trace.debug("Decoded line : %s",line)
+                return line
+
+    def read_reply(self,expected,deadline:float):
+        """
+        Read the next reply of a command, routing the unexpected lines.
+        Params:
+            expected:tuple|str : Tokens expected, or VALUE for any non status line
+            deadline:float : time.monotonic() value after which we give up
+        Returns:
+            reply:Reply|None : None at the deadline
+        """
+        while True:
+            line = self.read_line(deadline)
+            if line is None:
+                return None
+            reply = parse_line(line)
+            if expected == VALUE:
+                if reply.token not in UNSOLICITED_TOKENS:
+                    return reply
+            elif reply.token in expected:
+                return reply
+            self._route_unsolicited(reply)
+
+    def send_command(self,data:str,timeout:float=10):
+        """
+        Method used for sending a command to the module and reading its first response.
+        Params:
+            data:str : Command
+            timeout:float : Max time to wait for the response in seconds
+        Returns:
+            (status_code, response)
+                0 - Standard response (ok or the value asked)
+                1 - Error
+                3 - No response from the module
+            response:list : Decoded lines
         """
+        (first,_) = command_grammar(data)
+        start_counter = time.perf_counter()
+
         #Encode data and send it through the serial connection
-        data_to_send = (data.rstrip()+"\x0d\x0a").encode()
-        self.write(data_to_send)
-        time.sleep(0.2)
+        self.write((data.rstrip()+"\x0d\x0a").encode())
 
         #Wait for a response
         response = []
-        status_code = -1
-        start_time = datetime.datetime.now()
-        while status_code==-1:
-            #Check if something is being received
-            if self.in_waiting:
-                line = self.readline()
-                if line !=b'\r\n':
-                    #Decode line and remove leading + trailing whitespaces
-                    decoded_line = line.decode('utf-8').strip()
-                    logging.debug("Decoded line : %s",decoded_line)
-                    response.append(decoded_line)
-                    if 'ok' in decoded_line :
-                        status_code=0
-                    elif 'invalid_param' in decoded_line:
-                        status_code=1
-                    elif 'keys_not_init' in decoded_line:
-                        status_code=1
-                    elif 'no_free_ch'in decoded_line:
-                        status_code=1
-                    elif 'silent'in decoded_line:
-                        status_code=1
-                    elif 'busy'in decoded_line:
-                        status_code=1
-                    elif 'mac_paused'in decoded_line:
-                        status_code=1
-                    elif 'not_joined'in decoded_line:
-                        status_code=1
-            if (datetime.datetime.now() - start_time).seconds > timeout:
-                status_code=3
-            time.sleep(0.3)
-
-        if response and status_code==3:
-            status_code=0
+        status_code = 3
+        expected = VALUE if first == VALUE else FIRST_RESPONSE_TOKENS
+        reply = self.read_reply(expected,time.monotonic() + timeout)
+        if reply is not None:
+            response.append(reply.line)
+            status_code = 0 if reply.status is None else reply.status
+
+        self.counters.record(data,status_code,len(response),time.perf_counter() - start_counter)
 
         #Decode response and send it
-        logging.debug("Decoded response : %s",response)
+        trace.debug("Decoded response : %s",response)
         return (status_code,response)
 
+    def read_second_response(self,data:str,timeout:float=20):
+        """
+        Wait for the second response of a command accepted by the module (mac tx, mac join).
+        Params:
+            data:str : Command, gives the tokens expected (see COMMAND_GRAMMAR)
+            timeout:float : Max time to wait for the response in seconds
+        Returns:
+            (status_code, response)
+                0 - Standard response
+                1 - Error
+                3 - Timeout
+            response:list : Decoded line, empty at the timeout
+        """
+        (_,second) = command_grammar(data)
+        reply = self.read_reply(second,time.monotonic() + timeout)
+        if reply is None:
+            return (3,[])
+        return (reply.status,[reply.line])
+
     def factory_reset(self):
         """
         Method to factory reset the module.
@@ -129,7 +349,7 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command("sys factoryRESET",timeout=5)
-        logging.debug("FACTORYRESET : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("FACTORYRESET : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -153,7 +373,62 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command("sys reset",timeout=5)
-        logging.debug("RESET : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("RESET : (statuscode,response):%s,%s",status_code,response)
+
+        return (status_code,response)
+
+    def sleep(self,length_ms:int):
+        """
+        Method to put the module in Sleep mode.
+            This command puts the system to Sleep for the specified number of milliseconds.
+        The module can be forced to exit from Sleep by sending a break condition followed by
+        a 0x55 character at the new baud rate (see wake_up). The LoRaWAN state is kept.
+            Response: ok after the system gets back from Sleep mode
+                      invalid_param if the length is not valid
+        Params:
+            length_ms:int : Sleep length, 100 to 4294967296 ms
+        Returns:
+                (status_code, response)
+                0 - Standard response
+                1 - Error
+                3 - No response from the module, it may still be asleep
+        """
+        response    = []
+        status_code = 1
+
+        #Send the command, the ok comes at the wake up
+        (status_code,response) = self.send_command(f"sys sleep {length_ms}",
+                                                   timeout=length_ms/1000 + 2)
+        trace.debug("SLEEP : (statuscode,response):%s,%s",status_code,response)
+
+        return (status_code,response)
+
+    def wake_up(self,break_duration:float=0.01):
+        """
+        Method to wake up the module and resynchronize the serial link.
+            A break condition is sent, then 0x55 for the automatic baud rate detection. The
+        pending input (ok of the interrupted sleep, partial line) is dropped and the link is
+        checked with sys get ver.
+        Params:
+            break_duration:float : Length of the break condition in seconds
+        Returns:
+                (status_code, response)
+                0 - Standard response, the version of the module
+                1 - Error
+                3 - No response from the module
+        """
+        self.send_break(duration=break_duration)
+        self.write(b'\x55')
+        self.flush()
+        time.sleep(0.01)
+
+        #Resync : drop what was received around the wake up
+        self.reset_input_buffer()
+        self._partial = b''
+        (status_code,response) = self.send_command("sys get ver",timeout=1)
+        if status_code == 0 and not response[0].startswith("RN2483"):
+            status_code = 1
+        trace.debug("WAKE UP : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -180,7 +455,7 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command(f"mac set deveui {deveui}",timeout=5)
-        logging.debug("SET DEVEUI : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET DEVEUI : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -208,7 +483,7 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command(f"mac set appeui {appeui}",timeout=5)
-        logging.debug("SET APPEUI : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET APPEUI : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -235,7 +510,7 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command(f"mac set appkey {appkey}",timeout=5)
-        logging.debug("SET APPKEY : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET APPKEY : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -275,7 +550,7 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command(f"mac set pwridx {pwr_index}",timeout=5)
-        logging.debug("SET PWRIDX : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET PWRIDX : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -306,7 +581,7 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command(f"mac set dr {datarate}",timeout=5)
-        logging.debug("SET DATARATE : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET DATARATE : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -338,7 +613,7 @@ class RN2483( serial.Serial ):
         else:
             command = 'off'
         (status_code,response) = self.send_command(f"mac set adr {command}",timeout=5)
-        logging.debug("SET ADR : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET ADR : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -368,7 +643,7 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command(f"mac set linkchk {time_interval}",timeout=5)
-        logging.debug("SET LINKCHECK : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET LINKCHECK : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -396,7 +671,7 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command(f"mac set rxdelay1 {rx1_delay}",timeout=5)
-        logging.debug("SET RXDELAY : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET RXDELAY : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -423,10 +698,24 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command(f"mac set rx2 {datarate} {frequency}",timeout=5)
-        logging.debug("SET RX2PARAMS : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET RX2PARAMS : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
+    @staticmethod
+    def dutycycle_param(duty_cycle_percentage:int):
+        """
+        Compute the value given to mac set ch dcycle.
+        Params:
+            dutycycle_percentage:int : percentage representing the duty cycle you want.
+                If you input 0, the duty cycle will be 100%
+        Returns:
+            d_cycle_param:int : 100/percentage - 1, 0 for 100%
+        """
+        if duty_cycle_percentage == 0:
+            return 0
+        return int(100.0/duty_cycle_percentage)-1
+
     def set_dutycycle(self,channel_id:int,duty_cycle_percentage:int):
         """
         Method to set the duty cycle.
@@ -447,12 +736,7 @@ class RN2483( serial.Serial ):
                 3 - No response from the module
         """
         #Compute dutycycle
-        if duty_cycle_percentage == 0:
-            d_cycle_param = 0
-        else:
-            logging.debug("Val : %s",int(100.0/duty_cycle_percentage)-1)
-            d_cycle_param = int(100.0/duty_cycle_percentage)-1
-
+        d_cycle_param = self.dutycycle_param(duty_cycle_percentage)
         logging.debug("d_cycle_param : %s",d_cycle_param)
 
         response    = []
@@ -461,7 +745,7 @@ class RN2483( serial.Serial ):
         #Send the command
         (status_code,response) = self.send_command(f"mac set ch dcycle {channel_id} {d_cycle_param}"
                                                     ,timeout=5)
-        logging.debug("SET DCYCLE PARAMS : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET DCYCLE PARAMS : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -496,7 +780,7 @@ class RN2483( serial.Serial ):
         #Send the command
         (status_code,response)= self.send_command(f"mac set ch status {channel_id} {channel_state}",
                                 timeout=5)
-        logging.debug("SET CHANNEL STATUS : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET CHANNEL STATUS : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -523,7 +807,7 @@ class RN2483( serial.Serial ):
         #Send the command
         (status_code,response)= self.send_command(f"mac set retx {nb_rx}",
                                 timeout=5)
-        logging.debug("SET RETX : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET RETX : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -552,7 +836,7 @@ class RN2483( serial.Serial ):
         #Send the command
         (status_code,response)= self.send_command(f"mac set devaddr {devaddr}",
                                 timeout=5)
-        logging.debug("SET DEVADDR : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET DEVADDR : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -579,7 +863,7 @@ class RN2483( serial.Serial ):
         #Send the command
         (status_code,response)= self.send_command(f"mac set nwkskey {nwkskey}",
                                 timeout=5)
-        logging.debug("SET NWSKEY : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET NWSKEY : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -606,7 +890,7 @@ class RN2483( serial.Serial ):
         #Send the command
         (status_code,response)= self.send_command(f"mac set appskey {appskey}",
                                 timeout=5)
-        logging.debug("SET APPSKEY : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("SET APPSKEY : (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -645,7 +929,7 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command("mac save", timeout=5)
-        logging.debug("MAC SAVE: (statuscode,response):%s,%s",status_code,response)
+        trace.debug("MAC SAVE: (statuscode,response):%s,%s",status_code,response)
 
         return (status_code,response)
 
@@ -672,8 +956,8 @@ class RN2483( serial.Serial ):
         status_code = 1
 
         #Send the command
-        (status_code,response) = self.send_command("mac get dr",timeout=0.2)
-        logging.debug("GET DATARATE : (statuscode,datarate):%s,%s",status_code,response)
+        (status_code,response) = self.send_command("mac get dr",timeout=1)
+        trace.debug("GET DATARATE : (statuscode,datarate):%s,%s",status_code,response)
 
         if status_code==0:
             response = int(response[0])
@@ -710,14 +994,225 @@ class RN2483( serial.Serial ):
         status_code = 1
 
         #Send the command
-        (status_code,response) = self.send_command("mac get pwridx",timeout=0.2)
-        logging.debug("GET PWRIDX : (statuscode,datarate):%s,%s",status_code,response)
+        (status_code,response) = self.send_command("mac get pwridx",timeout=1)
+        trace.debug("GET PWRIDX : (statuscode,datarate):%s,%s",status_code,response)
 
         if status_code==0:
             response = int(response[0])
 
         return (status_code,response)
 
+    def get_margin(self):
+        """
+        Method to get the demodulation margin.
+            This command will return the demodulation margin as received in the last Link
+        Check Answer frame. The margin is the SNR of the LinkCheckReq at the gateway above
+        the demodulation floor of the datarate used.
+        Returns:
+                (status_code, margin)
+                0 - Standard response
+                3 - No response from the module
+
+                margin:int : decimal number representing the demodulation margin, from 0
+                    to 255, in dB
+        """
+        status_code = 1
+
+        #Send the command
+        (status_code,response) = self.send_command("mac get mrgn",timeout=1)
+        trace.debug("GET MARGIN : (statuscode,margin):%s,%s",status_code,response)
+
+        if status_code==0:
+            response = int(response[0])
+
+        return (status_code,response)
+
+    def get_gateway_count(self):
+        """
+        Method to get the number of gateways.
+            This command will return the number of gateways that successfully received the
+        last Link Check Request frame command, as received in the last Link Check Answer.
+        Returns:
+                (status_code, gwnb)
+                0 - Standard response
+                3 - No response from the module
+
+                gwnb:int : decimal number representing the number of gateways, from 0
+                    to 255
+        """
+        status_code = 1
+
+        #Send the command
+        (status_code,response) = self.send_command("mac get gwnb",timeout=1)
+        trace.debug("GET GWNB : (statuscode,gwnb):%s,%s",status_code,response)
+
+        if status_code==0:
+            response = int(response[0])
+
+        return (status_code,response)
+
+    def get_devaddr(self):
+        """
+        Method to get the device address.
+        Returns:
+                (status_code, devaddr)
+                0 - Standard response
+                3 - No response from the module
+
+                devaddr:str : 4-byte hexadecimal number representing the device address
+        """
+        status_code = 1
+
+        #Send the command
+        (status_code,response) = self.send_command("mac get devaddr",timeout=1)
+        trace.debug("GET DEVADDR : (statuscode,devaddr):%s,%s",status_code,response)
+
+        if status_code==0:
+            response = response[0]
+
+        return (status_code,response)
+
+    def get_channel_status(self,channel_id:int):
+        """
+        Method to know if a channel is enabled.
+        Params:
+            channel_id:int :  decimal number representing the channel number, from 0 to 15
+        Returns:
+                (status_code, status)
+                0 - Standard response
+                3 - No response from the module
+
+                status:bool : True if the channel is enabled
+        """
+        status_code = 1
+
+        #Send the command
+        (status_code,response) = self.send_command(f"mac get ch status {channel_id}",
+                                                   timeout=1)
+        trace.debug("GET CHANNEL STATUS : (statuscode,status):%s,%s",status_code,response)
+
+        if status_code==0:
+            response = response[0] == "on"
+
+        return (status_code,response)
+
+    def get_channel_dutycycle(self,channel_id:int):
+        """
+        Method to get the duty cycle parameter of a channel.
+        Params:
+            channel_id:int :  decimal number representing the channel number, from 0 to 15
+        Returns:
+                (status_code, d_cycle_param)
+                0 - Standard response
+                3 - No response from the module
+
+                d_cycle_param:int : value set by mac set ch dcycle (see dutycycle_param)
+        """
+        status_code = 1
+
+        #Send the command
+        (status_code,response) = self.send_command(f"mac get ch dcycle {channel_id}",
+                                                   timeout=1)
+        trace.debug("GET DCYCLE : (statuscode,dcycle):%s,%s",status_code,response)
+
+        if status_code==0:
+            response = int(response[0])
+
+        return (status_code,response)
+
+    def set_nvm(self,address:int,value:int):
+        """
+        Method to write one byte of the user EEPROM.
+            This command modifies user non-volatile memory at <address> to <data>.
+            Response:   ok if address and data are valid
+                        invalid_param if address or data is not valid
+        Params:
+            address:int : address of the user EEPROM, from 0x300 to 0x3FF
+            value:int : byte to write, from 0 to 255
+        Returns:
+                (status_code, response)
+                0 - Standard response
+                1 - Error
+                3 - No response from the module
+        """
+        response    = []
+        status_code = 1
+
+        #Send the command
+        (status_code,response) = self.send_command(f"sys set nvm {address:X} {value:02X}",
+                                                   timeout=5)
+        trace.debug("SET NVM : (statuscode,response):%s,%s",status_code,response)
+
+        return (status_code,response)
+
+    def get_nvm(self,address:int):
+        """
+        Method to read one byte of the user EEPROM.
+        Params:
+            address:int : address of the user EEPROM, from 0x300 to 0x3FF
+        Returns:
+                (status_code, value)
+                0 - Standard response
+                1 - Error
+                3 - No response from the module
+
+                value:int : byte stored at this address
+        """
+        status_code = 1
+
+        #Send the command
+        (status_code,response) = self.send_command(f"sys get nvm {address:X}",timeout=1)
+        trace.debug("GET NVM : (statuscode,value):%s,%s",status_code,response)
+
+        if status_code==0:
+            try:
+                response = int(response[0],16)
+            except ValueError:
+                status_code = 1
+
+        return (status_code,response)
+
+    def get_config_fingerprint(self):
+        """
+        Read the fingerprint of the configuration stored in the user EEPROM by
+        set_config_fingerprint.
+        Returns:
+                (status_code, fingerprint)
+                0 - Standard response
+                1 - Error
+
+                fingerprint:int|None : 32 bits fingerprint
+        """
+        fingerprint = 0
+        for offset in range(4):
+            (status_code,value) = self.get_nvm(FINGERPRINT_NVM_ADDRESS + offset)
+            if status_code != 0:
+                return (1,None)
+            fingerprint = (fingerprint << 8) | value
+
+        return (0,fingerprint)
+
+    def set_config_fingerprint(self,fingerprint:int):
+        """
+        Store the fingerprint of the configuration in the user EEPROM.
+        Params:
+            fingerprint:int : 32 bits fingerprint (see abp_fingerprint)
+        Returns:
+                (status_code, responses)
+                0 - Standard response
+                1 - Error
+        """
+        responses = []
+        for offset in range(4):
+            value = (fingerprint >> (8*(3 - offset))) & 0xFF
+            (status_code,response) = self.set_nvm(FINGERPRINT_NVM_ADDRESS + offset,value)
+            responses.extend(response)
+            if status_code != 0:
+                logging.error("Could not write the configuration fingerprint")
+                return (1,responses)
+
+        return (0,responses)
+
     def config_savable_parameters_otaa(self,deveui:str,appeui:str,appkey:str,
                             link_check_time_interval:int,
                             channels_and_duty:Dict[int, int]):
@@ -898,6 +1393,112 @@ class RN2483( serial.Serial ):
 
         return (nb_error,responses)
 
+    @staticmethod
+    def abp_fingerprint(devaddr:str,nwkskey:str,appskey:str,link_check_time_interval:int,
+                        channels_and_duty:Dict[int, int]):
+        """
+        Compute the fingerprint of an ABP configuration. The keys cannot be read back from
+        the module, their fingerprint is stored in the user EEPROM instead.
+        Params:
+            see config_savable_parameters_abp
+        Returns:
+            fingerprint:int : CRC32 of the configuration
+        """
+        channels = ",".join(f"{key}:{value}" for key,value in sorted(channels_and_duty.items()))
+        config = f"{devaddr}|{nwkskey}|{appskey}|{link_check_time_interval}|{channels}"
+        return zlib.crc32(config.upper().encode())
+
+    def warm_start_abp(self,devaddr:str,nwkskey:str,appskey:str,
+                       link_check_time_interval:int,
+                       channels_and_duty:Dict[int, int]):
+        """
+        Bring the module to an ABP configuration without a factory reset.
+            The device address and channels are read back and compared with the wanted
+        configuration, the keys and link check interval are compared through the
+        fingerprint stored in the user EEPROM. Only the differences are sent, mac save
+        is only called if something changed.
+        Params:
+            see config_savable_parameters_abp
+        Returns:
+            (status_code, responses)
+                0 - The module is configured
+                1 - Error, do a factory reset and config_savable_parameters_abp
+        """
+        responses = []
+        nb_changes = 0
+        fingerprint = self.abp_fingerprint(devaddr,nwkskey,appskey,link_check_time_interval,
+                                           channels_and_duty)
+
+        #Keys and link check, through the fingerprint
+        (status_code,stored_fingerprint) = self.get_config_fingerprint()
+        if status_code != 0:
+            return (1,responses)
+        if stored_fingerprint != fingerprint:
+            logging.info("Configuration fingerprint differs, pushing the keys")
+            for (setter,value) in ((self.set_network_session_key,nwkskey),
+                                   (self.set_application_session_key,appskey),
+                                   (self.set_linkchk,link_check_time_interval)):
+                (status_code,response) = setter(value)
+                responses.extend(response)
+                if status_code != 0:
+                    return (1,responses)
+                nb_changes += 1
+
+        #Device address
+        (status_code,module_devaddr) = self.get_devaddr()
+        if status_code != 0:
+            return (1,responses)
+        if stored_fingerprint != fingerprint or module_devaddr.upper() != devaddr.upper():
+            (status_code,response) = self.set_dev_addr(devaddr)
+            responses.extend(response)
+            if status_code != 0:
+                return (1,responses)
+            nb_changes += 1
+
+        #Channels
+        for channel_id in range(0,3):
+            enabled = channel_id in channels_and_duty
+            (status_code,module_enabled) = self.get_channel_status(channel_id)
+            if status_code != 0:
+                return (1,responses)
+
+            if enabled:
+                d_cycle_param = self.dutycycle_param(channels_and_duty[channel_id])
+                (status_code,module_d_cycle) = self.get_channel_dutycycle(channel_id)
+                if status_code != 0:
+                    return (1,responses)
+                if module_d_cycle != d_cycle_param:
+                    (status_code,response) = self.set_dutycycle(channel_id,
+                                                                channels_and_duty[channel_id])
+                    responses.extend(response)
+                    if status_code != 0:
+                        return (1,responses)
+                    nb_changes += 1
+
+            if module_enabled != enabled:
+                (status_code,response) = self.set_channel_status(channel_id,enabled)
+                responses.extend(response)
+                if status_code != 0:
+                    return (1,responses)
+                nb_changes += 1
+
+        #Save only what changed
+        if nb_changes:
+            logging.info("Warm start pushed %s parameters, saving",nb_changes)
+            (status_code,response) = self.save_parameters()
+            responses.extend(response)
+            if status_code != 0:
+                return (1,responses)
+            if stored_fingerprint != fingerprint:
+                (status_code,response) = self.set_config_fingerprint(fingerprint)
+                responses.extend(response)
+                if status_code != 0:
+                    return (1,responses)
+        else:
+            logging.info("Module already configured, skipping reset and save")
+
+        return (0,responses)
+
     def config_transmission_parameter(self,datarate:int,adr:bool,pwr_index:int):
         """
         This method will set the transmissions parameters.
@@ -980,41 +1581,39 @@ class RN2483( serial.Serial ):
 
         #Send the command
         (status_code,response) = self.send_command(command, timeout=5)
-        logging.debug("MAC JOIN : (statuscode,response):%s,%s",status_code,response)
+        trace.debug("MAC JOIN : (statuscode,response):%s,%s",status_code,response)
         if status_code != 0 :
             logging.error("Error joining the network")
             return (status_code,response)
 
         #Now that we've sent the command we should get a response
-        start_time = datetime.datetime.now()
-        got_response = False
-        while not got_response:
-            #Check if something is being received
-            if self.in_waiting:
-                line = self.readline()
-                if line !=b'\r\n':
-                    #Decode line and remove leading + trailing whitespaces
-                    decoded_line = line.decode('utf-8').strip()
-                    logging.debug("Decoded line : %s",decoded_line)
-                    response.append(decoded_line)
-                    got_response = True
-            if (datetime.datetime.now() - start_time).seconds > 20:
-                status_code=3
-                logging.error("Could not join the network")
-            time.sleep(0.3)
-
-        logging.debug("decoded line : %s",decoded_line)
-
-        if got_response and 'accepted' in decoded_line:
-            status_code = 0
-        elif status_code != 3 or 'denied' in decoded_line:
-            logging.debug("status code to 1")
-            status_code = 1
+        (status_code,second) = self.read_second_response(command,timeout=20)
+        response += second
+        if status_code != 0:
             logging.error("Could not join the network")
 
         return (status_code,response)
 
-    def send_uplink(self,data:str,type_confirmed:bool,portno:int=220):
+    @staticmethod
+    def parse_mac_rx(line:str):
+        """
+        Parse a downlink line.
+        Params:
+            line:str : Decoded line, mac_rx <portno> <data>
+        Returns:
+            (portno,payload) or None if the line is not a valid mac_rx
+            portno:int : port number, from 1 to 223
+            payload:bytes : data received from the server
+        """
+        words = line.split()
+        if len(words) != 3 or words[0] != "mac_rx":
+            return None
+        try:
+            return (int(words[1]),bytes.fromhex(words[2]))
+        except ValueError:
+            return None
+
+    def send_uplink(self,data,type_confirmed:bool,portno:int=220):
         """
         Method to call to send an uplink.
             You should join the network and set the transmission and network parameters
@@ -1049,9 +1648,9 @@ class RN2483( serial.Serial ):
             • invalid_data_len if application payload length is greater than the maximum
             application payload length corresponding to the current data rate
         Params:
-            data:str : Data to send. The length of <data> bytes capable of being
+            data:str|bytes : Data to send. The length of <data> bytes capable of being
                 transmitted are dependent upon the set data rate. 
-                (it will be converted to hexadecimal)
+                (it will be converted to hexadecimal, a str is encoded in utf-8)
                 Maximum :
                     51 bytes at SF12 / 125 kHz (lowest data rate)
                     51 bytes at SF11 / 125 kHz
@@ -1072,9 +1671,13 @@ class RN2483( serial.Serial ):
                 1 - Error
                 3 - Timeout
             message:str|None : If got mac_rx then message is a string, else None
+                (None for a binary payload, use parse_mac_rx on the response)
         """
         #Encode message to hexadecimal
-        encoded_data = data.encode("utf-8").hex()
+        if isinstance(data,bytes):
+            encoded_data = data.hex()
+        else:
+            encoded_data = data.encode("utf-8").hex()
 
         msg_type = 'uncnf'
         if type_confirmed :
@@ -1087,44 +1690,35 @@ class RN2483( serial.Serial ):
         message = None
 
         #Send the command
-        (status_code,response) = self.send_command(command, timeout=5)
-        logging.debug("MAC TX: (statuscode,response):%s,%s",status_code,response)
+        with cycle_trace.span("mac tx ack"):
+            (status_code,response) = self.send_command(command, timeout=5)
+        trace.debug("MAC TX: (statuscode,response):%s,%s",status_code,response)
         if status_code != 0 :
             logging.error("Error sending uplink")
             return (status_code,response,message)
 
         #Now that we've sent the command we should get a response
-        start_time = datetime.datetime.now()
-        got_response = False
-        while not got_response:
-            #Check if something is being received
-            if self.in_waiting:
-                line = self.readline()
-                if line !=b'\r\n':
-                    #Decode line and remove leading + trailing whitespaces
-                    decoded_line = line.decode('utf-8').strip()
-                    logging.debug("Decoded line : %s",decoded_line)
-                    response.append(decoded_line)
-                    got_response = True
-            if (datetime.datetime.now() - start_time).seconds > 20:
-                status_code=3
-                logging.error("Could not get a message")
-                return (status_code,response,message)
-            time.sleep(0.3)
-
-        if 'mac_rx' in decoded_line :
+        with cycle_trace.span("mac tx completion"):
+            (status_code,second) = self.read_second_response(command,timeout=20)
+        response += second
+        if status_code == 3:
+            logging.error("Could not get a message")
+            return (status_code,response,message)
+
+        decoded_line = second[0]
+        if decoded_line.startswith('mac_rx'):
             #Extract the data
             #mac_rx <portno> <data>
-            payload=decoded_line.split(" ")[-1]
-            payload_bytes = bytes.fromhex(payload)
-            decoded_payload = payload_bytes.decode('utf-8')
-            logging.debug("Decoded payload : %s",decoded_payload)
-            message = decoded_payload
-
-        if got_response or 'mac_tx_ok' in decoded_line or 'mac_rx' in decoded_line:
-            status_code = 0
-        elif status_code != 3 or 'invalid_data_len' in decoded_line or 'mac_err' in decoded_line:
-            status_code = 1
+            rx = self.parse_mac_rx(decoded_line)
+            if rx is not None:
+                try:
+                    message = rx[1].decode('utf-8')
+                    logging.debug("Decoded payload : %s",message)
+                except UnicodeDecodeError:
+                    #Binary payload, see parse_mac_rx
+                    logging.debug("Binary payload on port %s : %s",rx[0],rx[1].hex())
+
+        if status_code != 0:
             logging.error("Could not send the uplink")
 
         return (status_code,response,message)
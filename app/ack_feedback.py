@@ -0,0 +1,173 @@
+"""
+    This module adapts DR/PWRIDX from the outcome of confirmed uplinks
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# ACK feedback
+#
+# A share of the uplinks is sent confirmed (sampling ratio). The outcome read from the
+# module (mac_tx_ok/mac_rx : acknowledged, mac_err : not acknowledged after the
+# retransmissions) and the estimated number of attempts give a local link quality, no
+# broker round trip is needed.
+#
+# Adaptation :
+#   - not acknowledged : step up the power first, then lower the datarate
+#   - acknowledged at the first attempt step_up_after times in a row : raise the datarate
+#     first (largest airtime saving), then lower the power
+#   - acknowledged after retransmissions : keep the parameters
+#
+# ===
+# Notes
+#   The RN2483 does not report the number of retransmissions. It is estimated from the
+#   duration of send_uplink, divided by the shortest duration seen for an acknowledged
+#   frame at the same datarate (one attempt).
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import lora_phy
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Time spent in the receive windows after each attempt (RX1 at 1 s, RX2 at 2 s) [s]
+RX_WINDOWS_DURATION = 2.0
+
+ACK = "ack"
+NACK = "nack"
+
+# #############################################################################
+#
+# Functions
+#
+
+def uplink_outcome(response:list):
+    """
+    Get the outcome of a confirmed uplink from the response of RN2483.send_uplink.
+    Params:
+        response:list : Lines returned by send_uplink
+    Returns:
+        outcome:str|None : ACK, NACK or None if the transmission did not complete
+    """
+    for line in reversed(response):
+        if line.startswith("mac_tx_ok") or line.startswith("mac_rx"):
+            return ACK
+        if line.startswith("mac_err"):
+            return NACK
+    return None
+
+# #############################################################################
+#
+# Class AckSampler
+#
+
+class AckSampler:
+    """
+    Decide which uplinks are confirmed, ratio of them evenly spread
+    """
+    def __init__(self,ratio:float):
+        if not 0 <= ratio <= 1:
+            raise ValueError(f"Invalid confirmed ratio {ratio}")
+        self._ratio = ratio
+        self._credit = 1.0 - ratio if ratio > 0 else 0.0
+
+    def next(self):
+        """
+        Returns:
+            bool : True if the next uplink must be confirmed
+        """
+        self._credit += self._ratio
+        if self._credit >= 1.0:
+            self._credit -= 1.0
+            return True
+        return False
+
+# #############################################################################
+#
+# Class AckAdapter
+#
+
+class AckAdapter:
+    """
+    Link quality and DR/PWRIDX adaptation from the confirmed uplinks outcome
+    """
+    def __init__(self,step_up_after:int=4,alpha:float=0.2,payload_len:int=26):
+        self._step_up_after = step_up_after
+        self._alpha = alpha
+        self._payload_len = payload_len
+        self._single_attempt = {}
+        self._streak = 0
+        self.quality = 1.0
+        self.acks = 0
+        self.nacks = 0
+        self.retransmissions = 0
+
+    def estimate_attempts(self,datarate:int,elapsed:float,outcome:str):
+        """
+        Estimate the number of attempts of a confirmed uplink.
+        Params:
+            datarate:int : Datarate used
+            elapsed:float : Duration of send_uplink in seconds
+            outcome:str : ACK or NACK
+        Returns:
+            attempts:int : At least 1
+        """
+        single = self._single_attempt.get(datarate)
+        if single is None:
+            single = (lora_phy.time_on_air(lora_phy.datarate_to_sf(datarate),self._payload_len)
+                      + RX_WINDOWS_DURATION)
+        if outcome == ACK and elapsed < single:
+            single = elapsed
+        self._single_attempt[datarate] = single
+        return max(1,round(elapsed/single))
+
+    def update(self,outcome:str,attempts:int,datarate:int,pwridx:int):
+        """
+        Update the link quality and get the next parameters.
+        Params:
+            outcome:str : ACK or NACK
+            attempts:int : Number of attempts (see estimate_attempts)
+            datarate:int : Datarate used, 0 to 5
+            pwridx:int : PWRIDX used, 1 (max) to 5 (min)
+        Returns:
+            (datarate,pwridx) : Parameters for the next uplinks
+        """
+        success = 1.0/attempts if outcome == ACK else 0.0
+        self.quality = self._alpha*success + (1 - self._alpha)*self.quality
+        self.retransmissions += attempts - 1
+
+        if outcome == NACK:
+            self.nacks += 1
+            self._streak = 0
+            if pwridx > 1:
+                return datarate, pwridx - 1
+            return max(datarate - 1,0), pwridx
+
+        self.acks += 1
+        if attempts > 1:
+            self._streak = 0
+            return datarate, pwridx
+
+        self._streak += 1
+        if self._streak < self._step_up_after:
+            return datarate, pwridx
+
+        self._streak = 0
+        if datarate < 5:
+            return datarate + 1, pwridx
+        return datarate, min(pwridx + 1,5)
+
+    def metrics(self):
+        """
+        Returns:
+            metrics:dict : quality, acks, nacks, retransmissions
+        """
+        return {"quality":round(self.quality,3),"acks":self.acks,"nacks":self.nacks,
+                "retransmissions":self.retransmissions}
@@ -0,0 +1,370 @@
+"""
+    This module holds the greedy actions of a Q-Table in a compact form, without NumPy
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Action table
+#
+# The node only needs the greedy action of each (SNR, TP) state : 275 bytes instead of the
+# 77 KB pickle and NumPy. The action table is precomputed next to the pickle
+# (<table>.actions) and the state indexes are computed with integers, as np.digitize on
+# the grid of qtable.
+#
+#   snr_index = 13 - floor(2*snr)        clipped to [0, 54]     (grid 6.5 dB to -20.5 dB)
+#               NaN and +inf give 0, -inf gives 54, as np.digitize
+#   tp_index  = bisect(POWER_LEVELS, tp) - 1, -1 is the last row as in NumPy
+#
+# File format (<table>.actions, little endian) :
+#   header  : magic "QACT", version (B), nb SNR (B), nb TP (B), nb actions (B),
+#             CRC32 of the pickle (I), CRC32 of the actions (I)
+#   actions : nb SNR x nb TP bytes, action index of state snr_index*nb TP + tp_index
+#
+# Usage :
+#   python3 action_table.py ./config/Q_model-LORA-rob.pkl     (needs NumPy, tooling)
+#   get_policy(path).decide(snr,tp)                          (runtime, stdlib only)
+#
+# ===
+# Notes
+#   - QTablePolicy keeps the greedy actions of a table file and reloads them when the file
+#     changes (watcher thread, reload_policies on a signal or a command). The new table is
+#     loaded, validated and reduced beside the current one, then swapped in one
+#     assignment : a decision uses either the old or the new table, never a mix.
+#   - Without an up to date .actions file (new or patched pickle), the pickle is reduced
+#     with qtable, NumPy is imported then, and the .actions file is written for the next
+#     start.
+#   - table_lock is held while a table file or its .actions file is written or loaded :
+#     the loads and reloads here, the patches (qtable_delta.install_patch). Two writers
+#     never share <table>.actions.tmp.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+from array import array
+from bisect import bisect_right
+from itertools import product
+import logging
+import math
+import os
+import pickle
+import struct
+import sys
+import threading
+import time
+import zlib
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Power levels in dbm
+POWER_LEVELS = [6, 8, 10, 12, 14]
+#Available SF, 13 is kept since the table was trained with it
+SFS = [7, 8, 9, 10, 11, 12, 13]
+#SNR grid in half dB, from 6.5 (13) to -20.5 dB by 0.5 dB steps
+SNR_TOP_HALF_DB = 13
+#Index of the last SNR state
+MAX_SNR_INDEX = 54
+NB_SNR = MAX_SNR_INDEX + 1
+NB_TP = len(POWER_LEVELS)
+#Actions (SF,TP in dBm)
+ACTIONS = list(product(SFS, POWER_LEVELS))
+#Convert dbm to TP
+MAPPING_TP = {6: 5, 8: 4, 10: 3, 12: 2, 14: 1}
+
+#Per action lookups, datarate (12-SF) and PWRIDX
+ACTION_DATARATE = [12-sf for (sf,_) in ACTIONS]
+ACTION_PWRIDX = [MAPPING_TP[power] for (_,power) in ACTIONS]
+
+FILE_MAGIC = b"QACT"
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct("<4sBBBBII")
+
+#Held while a table file or its action table is written or loaded, reentrant
+table_lock = threading.RLock()
+
+# #############################################################################
+#
+# Functions
+#
+
+def snr_index(snr:float):
+    """
+    Compute the SNR state index, as np.digitize on the SNR grid of qtable.
+    Params:
+        snr:float : Signal To Noise Ratio, NaN or infinite for a malformed LSNR
+    Returns:
+        snr_index:int
+    """
+    half_db = 2*snr
+    if not math.isfinite(half_db):
+        return MAX_SNR_INDEX if half_db == -math.inf else 0
+    return min(max(SNR_TOP_HALF_DB - math.floor(half_db),0),MAX_SNR_INDEX)
+
+def tp_index(tp:int):
+    """
+    Compute the TP state index, as np.digitize on POWER_LEVELS (a PWRIDX gives -1, the
+    last row, as in q_model).
+    Params:
+        tp:int : Transmission power given to q_model
+    Returns:
+        tp_index:int : From 0 to NB_TP - 1
+    """
+    return (bisect_right(POWER_LEVELS,tp) - 1) % NB_TP
+
+def actions_path(path:str):
+    """
+    Returns:
+        path:str : Action table file of a pickle
+    """
+    return os.path.splitext(path)[0] + ".actions"
+
+def write_action_table(path:str,actions:bytes,source_crc:int):
+    """
+    Write an action table file, replacing the previous one in one rename.
+    Params:
+        path:str : Action table file
+        actions:bytes : Action index of each state, NB_SNR x NB_TP bytes
+        source_crc:int : CRC32 of the pickle it was computed from
+    """
+    actions = bytes(actions)
+    if len(actions) != NB_SNR*NB_TP:
+        raise ValueError(f"Invalid action table size {len(actions)}, expected {NB_SNR*NB_TP}")
+    temporary = f"{path}.tmp"
+    with open(temporary,'wb') as f:
+        f.write(FILE_HEADER.pack(FILE_MAGIC,FILE_VERSION,NB_SNR,NB_TP,len(ACTIONS),
+                                 source_crc,zlib.crc32(actions)) + actions)
+    os.replace(temporary,path)
+
+def read_action_table(path:str):
+    """
+    Read an action table file.
+    Params:
+        path:str : Action table file
+    Returns:
+        (source_crc,actions)
+        source_crc:int : CRC32 of the pickle it was computed from
+        actions:array : Action index of each state
+    Raises:
+        ValueError : if the file is not a valid action table
+    """
+    with open(path,'rb') as f:
+        data = f.read()
+    if len(data) < FILE_HEADER.size:
+        raise ValueError(f"{path} is truncated")
+    (magic,version,nb_snr,nb_tp,nb_actions,source_crc,crc) = FILE_HEADER.unpack_from(data)
+    if magic != FILE_MAGIC or version != FILE_VERSION:
+        raise ValueError(f"{path} is not a version {FILE_VERSION} action table")
+    if (nb_snr,nb_tp,nb_actions) != (NB_SNR,NB_TP,len(ACTIONS)):
+        raise ValueError(f"Invalid action table shape {(nb_snr,nb_tp,nb_actions)}")
+    actions = array('B',data[FILE_HEADER.size:])
+    if len(actions) != NB_SNR*NB_TP or zlib.crc32(actions) != crc:
+        raise ValueError(f"{path} is corrupted")
+    if max(actions) >= len(ACTIONS):
+        raise ValueError(f"Action out of range in {path}")
+    return source_crc,actions
+
+def reduce_pickle(content:bytes):
+    """
+    Compute the action table of a pickled Q-Table (imports NumPy).
+    Params:
+        content:bytes : Pickle file content
+    Returns:
+        actions:bytes : Action index of each state
+    Raises:
+        ValueError : if the table is invalid
+    """
+    import qtable
+    q_table = pickle.loads(content)
+    qtable.validate_q_table(q_table)
+    return qtable.best_actions(q_table).astype("u1").tobytes()
+
+# #############################################################################
+#
+# Class QTablePolicy
+#
+
+class QTablePolicy:
+    """
+    Greedy policy of a Q-Table file, reloadable while running
+    """
+    def __init__(self,path:str):
+        self.path = path
+        #(version, actions, file signature), replaced as a whole
+        self._state = None
+        self._rejected = None
+        self.reloads = 0
+        self.reload()
+
+    @staticmethod
+    def _signature(path:str):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns,stat.st_size)
+
+    @property
+    def version(self):
+        """
+        Returns:
+            version:str : CRC32 of the table file in use
+        """
+        return self._state[0]
+
+    def _load_actions(self,content:bytes,crc:int):
+        """
+        Get the actions of the pickle, from its action table file when it is up to date.
+        """
+        path = actions_path(self.path)
+        try:
+            (source_crc,actions) = read_action_table(path)
+            if source_crc == crc:
+                return actions
+        except FileNotFoundError:
+            pass
+        except (OSError,ValueError) as error:
+            logging.warning("Action table %s not used : %s",path,error)
+
+        actions = reduce_pickle(content)
+        try:
+            write_action_table(path,actions,crc)
+        except OSError as error:
+            logging.warning("Action table %s not written : %s",path,error)
+        return array('B',actions)
+
+    def reload(self):
+        """
+        Load, validate and reduce the table file, then swap it in.
+        Returns:
+            bool : True if the table in use changed
+        Raises:
+            ValueError, OSError : if the file is invalid, the current table is kept
+        """
+        signature = self._signature(self.path)
+        with open(self.path,'rb') as f:
+            content = f.read()
+        crc = zlib.crc32(content)
+        version = f"{crc:08x}"
+        if self._state is not None and version == self._state[0]:
+            self._state = (version,self._state[1],signature)
+            return False
+
+        actions = self._load_actions(content,crc)
+        previous = self._state[0] if self._state is not None else None
+        self._state = (version,actions,signature)
+        self.reloads += 1
+        logging.info("Q-Table %s version %s (previous %s)",self.path,version,previous)
+        return True
+
+    def rejected(self):
+        """
+        Remember the signature of a file that could not be loaded, so it is not retried
+        until it changes again.
+        """
+        try:
+            self._rejected = self._signature(self.path)
+        except OSError:
+            self._rejected = None
+
+    def changed(self):
+        """
+        Returns:
+            bool : True if the file changed since the last load or rejected load
+        """
+        try:
+            signature = self._signature(self.path)
+        except OSError:
+            return False
+        return signature not in (self._state[2],self._rejected)
+
+    def decide(self,snr,tp):
+        """
+        Get the greedy action, as q_model does.
+        Params:
+            snr:float : Signal To Noise Ratio
+            tp:int : Transmission power given to q_model
+        Returns:
+            (action,version) : Index in ACTIONS and version of the table used
+        """
+        (version,actions,_) = self._state
+        return actions[snr_index(snr)*NB_TP + tp_index(tp)],version
+
+#Policies by path
+_policies = {}
+_policies_lock = threading.Lock()
+_watcher = None
+
+def get_policy(path:str):
+    """
+    Get the policy of a table file, loaded on the first call.
+    Params:
+        path:str : Path to the pickle file
+    Returns:
+        policy:QTablePolicy
+    """
+    policy = _policies.get(path)
+    if policy is None:
+        with _policies_lock, table_lock:
+            policy = _policies.get(path)
+            if policy is None:
+                policy = QTablePolicy(path)
+                _policies[path] = policy
+    return policy
+
+def reload_policies(only_changed:bool=False):
+    """
+    Reload the loaded policies, an invalid file is logged and the old table kept.
+    Params:
+        only_changed:bool : Only the files changed since their last load
+    """
+    with table_lock:
+        for policy in list(_policies.values()):
+            if only_changed and not policy.changed():
+                continue
+            try:
+                policy.reload()
+            except Exception as error:
+                #Whatever is wrong with the file, keep deciding with the current table
+                policy.rejected()
+                logging.error("Q-Table %s not reloaded : %s",policy.path,error)
+
+def start_watcher(interval:float=5):
+    """
+    Start a thread reloading the table files when they change.
+    Params:
+        interval:float : Seconds between two checks
+    """
+    global _watcher
+    if _watcher is not None:
+        return
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            reload_policies(only_changed=True)
+
+    _watcher = threading.Thread(target=watch,name="QTableWatcher",daemon=True)
+    _watcher.start()
+
+# #############################################################################
+#
+# Main
+#
+
+def main():
+    #Command line entry point, precompute the action tables of pickles
+    if len(sys.argv) < 2:
+        print(f"Usage : {sys.argv[0]} <Q-Table pickle> [...]")
+        return 1
+    for path in sys.argv[1:]:
+        with open(path,'rb') as f:
+            content = f.read()
+        write_action_table(actions_path(path),reduce_pickle(content),zlib.crc32(content))
+        print(f"{actions_path(path)} : {zlib.crc32(content):08x}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -24,153 +24,220 @@ This script python get and will run the RL algorithm
 #
 import logging
 import os
-from time import sleep
+from time import perf_counter, sleep, time
 from pathlib import Path
-#Socket for execption handling
-import socket
 import json
-
-#Threads
-from queue import Queue
-
-from itertools import product
-import pickle
+import threading
+import base64
 
 import datetime
-
-import numpy as np
+import signal
 
 from dotenv import load_dotenv
 import paho.mqtt.client as paho
 
 from RN2483 import RN2483
+import action_table
+from feedback_window import FeedbackWindows
+from log_config import configure_logging
+from mqtt_supervisor import MqttSupervisor
+import downlink_control
+import ack_feedback
+from linkcheck_feedback import LinkCheckFeedback
+from uplink_aggregator import UplinkAggregator, unpack_samples
+import campaign
+from snr_store import SnrStore
+from mqtt_archive import ArchiveWriter
+import cycle_trace
+import profiling
+from uplink_scheduler import UplinkScheduler, StagedDecision, FeedbackWorker
+from feedback_mailbox import FeedbackMailbox
+from power_manager import PowerManager
+from serial_mux import RN2483Client
 
 # #############################################################################
 #
 # Configuration
 #
-logging.basicConfig(
-    level=logging.DEBUG,
-            format='%(asctime)s,%(msecs)03d %(levelname)-8s - [%(filename)s.%(funcName)-10s:\
-%(lineno)-3d.] - %(message)s')
-
 #Get the server and node credentials from a .env file
 #Get .env name
 node_str = os.getenv('NODE')
-logging.debug("%s",node_str)
 
 dotenv_path = Path(f"./files_env/{node_str}")
 load_dotenv(dotenv_path=dotenv_path)
 
+#Logging, level and mode from the .env file (see log_config)
+configure_logging()
+#Cycle tracing, off without TRACE_FILE, and stage timers with STAGE_TIMERS=1 (see cycle_trace)
+cycle_trace.configure_tracing()
+logging.debug("%s",node_str)
+
 DEVADDR = os.getenv('DEVADDR')
 APPSKEY = os.getenv('APPSKEY')
 NWKSKEY = os.getenv('NWKSKEY')
 
 MQTT_SERVER = os.getenv('MQTT_SERVER')
-MQTT_PORT = int(os.getenv('MQTT_PORT'))
+MQTT_PORT = int(os.getenv('MQTT_PORT', '1883'))
 MQTT_USERNAME = os.getenv('MQTT_USERNAME')
 MQTT_PASSWORD = os.getenv('MQTT_PASSWORD')
 MQTT_TOPIC    = os.getenv('MQTT_TOPIC')
+#Persistent session, the client id must stay the same across restarts
+MQTT_CLIENT_ID = os.getenv('MQTT_CLIENT_ID', f"dsf2r-{DEVADDR}")
+MQTT_QOS = int(os.getenv('MQTT_QOS', '1'))
+#Reconnection backoff, from min to max seconds
+MQTT_RECONNECT_MIN = int(os.getenv('MQTT_RECONNECT_MIN', '1'))
+MQTT_RECONNECT_MAX = int(os.getenv('MQTT_RECONNECT_MAX', '60'))
+#Time to wait for the first connection before starting anyway
+MQTT_CONNECT_TIMEOUT = float(os.getenv('MQTT_CONNECT_TIMEOUT', '10'))
 
 
 PORT = "/dev/ttyACM0"
+#Unix socket of the serial multiplexer owning PORT (see serial_mux), empty to open PORT
+SERIAL_MUX_SOCKET = os.getenv('SERIAL_MUX_SOCKET', '')
+
+#Enabled channels and their duty cycle
+CHANNELS_AND_DUTY = {0:0,1:0,2:0}
+
+#Where the transmission parameters come from, comma separated, the latest decision wins :
+#   mqtt     : LSNR feedback from the broker given to q_model
+#   downlink : DR/PWRIDX commands received in downlinks (see downlink_control)
+#   ack      : outcome of confirmed uplinks (see ack_feedback)
+#   linkcheck: demodulation margin of the LoRaWAN Link Check (see linkcheck_feedback)
+#   both     : mqtt,downlink
+CONTROL_MODE = os.getenv('CONTROL_MODE', 'mqtt').lower()
+CONTROL_SOURCES = ("mqtt","downlink","ack","linkcheck")
+
+#Confirmed uplinks feedback (ack source)
+ACK_CONFIRMED_RATIO = float(os.getenv('ACK_CONFIRMED_RATIO', '0.25'))
+ACK_RETRANSMISSIONS = int(os.getenv('ACK_RETRANSMISSIONS', '2'))
+ACK_STEP_UP_AFTER = int(os.getenv('ACK_STEP_UP_AFTER', '4'))
+
+#Link check interval in seconds (linkcheck source)
+LINKCHECK_INTERVAL = int(os.getenv('LINKCHECK_INTERVAL', '60'))
+DOWNLINK_CONTROL_PORT = int(os.getenv('DOWNLINK_CONTROL_PORT', str(downlink_control.CONTROL_PORT)))
+
+#Pack the samples into uplinks of the maximum size of the datarate (see uplink_aggregator)
+UPLINK_AGGREGATION = os.getenv('UPLINK_AGGREGATION', '0') == '1'
+#Max time a sample waits for a full uplink, and time between two samples [s]
+AGGREGATION_MAX_DELAY = float(os.getenv('AGGREGATION_MAX_DELAY', '60'))
+SAMPLE_PERIOD = float(os.getenv('SAMPLE_PERIOD', '5'))
+
+#Skip the factory reset and mac save when the module is already configured
+WARM_START = os.getenv('WARM_START', '0') == '1'
 
 Q_TABLE_PATH = './config/Q_model-LORA-rob.pkl'
-
-#Create Queue for MQTT
-mqtt_queue = Queue()
+#Reload the Q-Tables when their file changes, check period in seconds (0 : off)
+#They are also reloaded on SIGHUP and on any message of QTABLE_RELOAD_TOPIC
+QTABLE_WATCH_INTERVAL = float(os.getenv('QTABLE_WATCH_INTERVAL', '5'))
+QTABLE_RELOAD_TOPIC = os.getenv('QTABLE_RELOAD_TOPIC')
+#Patches of Q_TABLE_PATH (see qtable_delta), chunks on this topic or in the downlinks of
+#this port (0 : off, default qtable_delta.PATCH_PORT)
+QTABLE_PATCH_TOPIC = os.getenv('QTABLE_PATCH_TOPIC')
+QTABLE_PATCH_PORT = int(os.getenv('QTABLE_PATCH_PORT', '202'))
+#Reassembly of the patches, created with the first chunk
+qtable_patches = None
+
+#Newest MQTT feedback of the node, the older frames are coalesced (see feedback_mailbox)
+mqtt_mailbox = FeedbackMailbox()
+#Campaign run of the last uplink sent, tag of the feedback whose message does not carry
+#the uplink payload (see payload_run)
+uplink_run = None
+#Fields of the MQTT message that may carry the uplink payload (JSON text, hex or base64)
+MQTT_PAYLOAD_FIELDS = ("payload","data","frm_payload")
 
 #Max number of transmissions
 MAX_TRANSMISSIONS = 50
 
+#Decision policy without campaign : qtable (q_model) or adr (network server ADR baseline)
+POLICY = os.getenv('POLICY', 'qtable')
+
+#Scenario of a campaign, runs executed on the same joined session (see campaign)
+CAMPAIGN_FILE = os.getenv('CAMPAIGN_FILE')
+
+#Log the serial counters every N transmissions
+LOG_COUNTERS_EVERY = int(os.getenv('LOG_COUNTERS_EVERY', '10'))
+
+#SNR feedback window, the aggregated SNR is given to q_model
+#(last, mean, ewma, median, min or pNN for a percentile)
+FEEDBACK_WINDOW = int(os.getenv('FEEDBACK_WINDOW', '8'))
+FEEDBACK_AGGREGATOR = os.getenv('FEEDBACK_AGGREGATOR', 'last')
+FEEDBACK_EWMA_ALPHA = float(os.getenv('FEEDBACK_EWMA_ALPHA', '0.3'))
+
+#Uplink cadence, 0 to send as fast as possible (see uplink_scheduler)
+#With a period the feedback is handled as soon as it arrives, applied at the next slot
+UPLINK_PERIOD = float(os.getenv('UPLINK_PERIOD', '0'))
+UPLINK_JITTER = float(os.getenv('UPLINK_JITTER', '0'))
+#Slots missed by more than this are skipped, default half the period [s]
+UPLINK_DEADLINE = float(os.getenv('UPLINK_DEADLINE', str(UPLINK_PERIOD/2)))
+
+#Sleep the module between the uplinks (see power_manager), awake WAKE_MARGIN [s] before
+#the slot, gaps shorter than MIN_SLEEP [s] are spent awake
+POWER_SAVE = os.getenv('POWER_SAVE', '0') == '1'
+POWER_WAKE_MARGIN = float(os.getenv('POWER_WAKE_MARGIN', '0.1'))
+POWER_MIN_SLEEP = float(os.getenv('POWER_MIN_SLEEP', '0.5'))
+
+#Archive of the MQTT messages in compressed segments (see mqtt_archive) instead of the
+#plain exp-<start>_mqtt.txt, segments rotated on size [bytes] and age [s]
+MQTT_ARCHIVE = os.getenv('MQTT_ARCHIVE', '0') == '1'
+MQTT_ARCHIVE_SEGMENT_BYTES = int(os.getenv('MQTT_ARCHIVE_SEGMENT_BYTES', str(4*1024*1024)))
+MQTT_ARCHIVE_SEGMENT_SECONDS = float(os.getenv('MQTT_ARCHIVE_SEGMENT_SECONDS', '3600'))
+
+#History of the LSNR of every device and gateway heard (see snr_store), off by default
+SNR_STORE = os.getenv('SNR_STORE', '0') == '1'
+SNR_STORE_RETENTION = float(os.getenv('SNR_STORE_RETENTION', '3600'))
+SNR_STORE_SIZE = int(os.getenv('SNR_STORE_SIZE', '1024'))
+#Snapshot written at the end of the experiment, none if empty
+SNR_STORE_SNAPSHOT = os.getenv('SNR_STORE_SNAPSHOT')
+snr_store = SnrStore(SNR_STORE_RETENTION,SNR_STORE_SIZE) if SNR_STORE else None
+
 #Get experiment start time
 TIME_START = datetime.datetime.now()
 START_EXP = TIME_START.strftime("%m%d%Y-%H:%M:%S")
 
+mqtt_archive = None
+if MQTT_ARCHIVE:
+    mqtt_archive = ArchiveWriter(f"./logs/exp-{START_EXP}_mqtt",MQTT_ARCHIVE_SEGMENT_BYTES,
+                                 MQTT_ARCHIVE_SEGMENT_SECONDS)
+
 # #############################################################################
 #
 # MQTT functions
 #
 
-def connect_to_broker(max_number_of_tries:int):
-    """
-    Function that initiate a broker connection
-    Param :
-        max_number_of_tries:int : Max number of tries before considering impossible to connect
-            to broker
-    Returns:
-        mqtt_client:paho.mqtt.client.Client : Client we tried to connect to the broker
-    """
-
-    #Check if we can connect
-    errors_count = 0
-    f_connected =   False
-    while not f_connected:
-        try :
-            mqtt_client = paho.Client()
-            mqtt_client.connect(MQTT_SERVER,port=MQTT_PORT)
-            mqtt_client.username_pw_set(username=MQTT_USERNAME,password=MQTT_PASSWORD)
-
-            mqtt_client.loop_start()
-            sleep(0.1)
-            f_connected = True
-        except (socket.error) as error:
-            errors_count+=1
-            logging.error("While connecting to broker, %s : %s ",error.__class__,error)
-            sleep(1)
-            if errors_count >= max_number_of_tries:
-                logging.critical("Could not connect to broker, address is %s and\
- port is %s.Error : %s : %s",MQTT_SERVER,MQTT_PORT,error.__class__,error)
-                raise error
-
-    return mqtt_client
-
-def wait_connection(mqtt_client:paho.Client,max_number_of_tries:int):
-    """
-    Simple function to wait for connection.
-    If it fails after max_number_of_tries tries, return False else True
-    Param :
-        mqtt_client:paho.Client : A paho.Client 
-        max_number_of_tries:int : Number of tries before returning False
-    Returns :
-        bool : True if connected, else False
+def payload_run(json_data:dict):
     """
-    errors_count = 0
-    while mqtt_client.is_connected() is False :
-        #Wait for connection
-        errors_count += 1
-        sleep(1)
-
-        if errors_count >= max_number_of_tries:
-            return False
-    return True
-
-def mqtt_connect():
-    """
-    Function that tries to connect to a broker and return mqtt_client
-
+    Get the campaign run of the uplink a feedback message is about, from the R field of
+    the uplink payload carried by the message (decoded object or raw payload, a single
+    sample or aggregated samples).
+    Params:
+        json_data:dict : MQTT message
     Returns:
-        mqtt_client:paho.Client : The mqtt_client for the connection
+        run:int|None : Run index, None if the message carries no payload with a run
     """
-
-    #Connect to Broker
-    try :
-        mqtt_client = connect_to_broker(5)
-    except (socket.error) as error:
-        logging.critical("Could not connect to broker, address is %s and\
- port is %s.Error : %s : %s",MQTT_SERVER,MQTT_PORT,error.__class__,error)
-        #End related threads
-        raise RuntimeError("Could not connect to MQTT Broker") from error
-
-    #Wait for connection
-    connect_status = wait_connection(mqtt_client,5)
-    if not connect_status :
-        logging.critical("Could not connect to broker, address is %s and port is %s",
-                            MQTT_SERVER,MQTT_PORT)
-        #End related threads
-        raise RuntimeError("Could not connect to MQTT Broker")
-
-    return mqtt_client
+    decoded = json_data.get("object")
+    if isinstance(decoded,dict) and "R" in decoded:
+        return decoded["R"]
+    for field in MQTT_PAYLOAD_FIELDS:
+        value = json_data.get(field)
+        if not isinstance(value,str) or not value:
+            continue
+        candidates = []
+        if value.lstrip().startswith("{"):
+            candidates.append(value.encode("utf-8"))
+        for decode in (bytes.fromhex,lambda text: base64.b64decode(text,validate=True)):
+            try:
+                candidates.append(decode(value))
+            except ValueError:
+                pass
+        for raw in candidates:
+            try:
+                sample = raw if raw.startswith(b"{") else unpack_samples(raw)[0]
+                data = json.loads(sample)
+            except (ValueError,IndexError):
+                continue
+            if isinstance(data,dict) and "R" in data:
+                return data["R"]
+    return None
 
 def mqtt_on_message(client:paho.Client,userdata:any,message:paho.MQTTMessage):
     """
@@ -188,56 +255,160 @@ def mqtt_on_message(client:paho.Client,userdata:any,message:paho.MQTTMessage):
         filename:str = f"./logs/exp-{START_EXP}_mqtt.txt"
 
         #Save start
-        with open(filename,"a+",encoding="utf-8") as file:
+        if mqtt_archive is not None:
             json_data = json.loads(message.payload)
-            json.dump(json_data,file)
-            file.write("\n")
-            if json_data["devaddr"]==DEVADDR:
-                mqtt_queue.put(json_data,block=True,timeout=None)
+            mqtt_archive.write(json_data.get("devaddr"),message.payload)
+        else:
+            with open(filename,"a+",encoding="utf-8") as file:
+                json_data = json.loads(message.payload)
+                json.dump(json_data,file)
+                file.write("\n")
+        best_gw = json_data.get("best_gw")
+        if snr_store is not None and best_gw and "lsnr" in best_gw:
+            snr_store.add(json_data["devaddr"],str(best_gw.get("desc")),time(),
+                          float(best_gw["lsnr"]))
+        if json_data["devaddr"]==DEVADDR:
+            cycle_trace.instant("mqtt arrival")
+            #Run of the uplink carried by the message, late feedback keeps its run
+            run_index = payload_run(json_data)
+            if run_index is None:
+                run_index = uplink_run
+            mqtt_mailbox.put(DEVADDR,{**json_data,"uplink_run":run_index})
     except ValueError:
         #Not a json
         logging.info("NO JSON = Message : %s",message.payload)
 
+def mqtt_on_reload(client:paho.Client,userdata:any,message:paho.MQTTMessage):
+    """
+    Call back function of QTABLE_RELOAD_TOPIC, reload the Q-Tables
+    """
+    logging.info("Q-Table reload asked on %s",message.topic)
+    action_table.reload_policies()
+
+def receive_patch_chunk(chunk:bytes):
+    """
+    Add a chunk of a Q-Table patch, install the patch when it is complete.
+    Called from the paho thread and the main loop, serialized with the reloads by
+    action_table.table_lock.
+    Params:
+        chunk:bytes : Chunk received on QTABLE_PATCH_TOPIC or QTABLE_PATCH_PORT
+    """
+    global qtable_patches
+    #NumPy is only imported once a patch comes
+    import qtable_delta
+    with action_table.table_lock:
+        if qtable_patches is None:
+            qtable_patches = qtable_delta.PatchAssembler()
+        try:
+            patch = qtable_patches.add(chunk)
+            if patch is None:
+                return
+            if qtable_delta.install_patch(Q_TABLE_PATH,patch):
+                action_table.reload_policies()
+            else:
+                logging.info("Q-Table patch already applied")
+        except (ValueError,OSError) as error:
+            logging.error("Q-Table patch rejected : %s",error)
+
+def mqtt_on_patch(client:paho.Client,userdata:any,message:paho.MQTTMessage):
+    """
+    Call back function of QTABLE_PATCH_TOPIC, one chunk per message
+    """
+    receive_patch_chunk(message.payload)
+
 # #############################################################################
 #
 # Functions
 #
 
-def q_model(snr:int,tp:int):
+def q_model(snr:int,tp:int,q_table_path:str=Q_TABLE_PATH):
     """
     Function exploiting the Q-Table made by experimentations.
     Params:
         snr:int : Signal To Noise Ratio
         tp:int : PWRIDX from 1 to 5, representing differents power level
+        q_table_path:str : Q-Table to use
     Returns :
-        (datarate,transmission_power)
+        (datarate,transmission_power,version)
         datarate:int: Datarate for the module to use from 0 to 5
         transmission_power:int : Transmission power for the module to use
             from 1 to 5.
+        version:str : Version of the Q-Table that made the decision
+    """
+    #Greedy actions of the Q-Table, reloaded when the file changes
+    #(see action_table.QTablePolicy)
+    (q_value,version) = action_table.get_policy(q_table_path).decide(snr,tp)
+    logging.debug("SF:%s",action_table.ACTIONS[q_value][0])
+    logging.debug("TP:%s",action_table.ACTIONS[q_value][1])
+    transmission_power = action_table.MAPPING_TP[action_table.ACTIONS[q_value][1]]
+    datarate=action_table.ACTIONS[q_value][0]
+    return datarate , transmission_power, version
+
+
+def run_decision(run:campaign.Run,lsnr:float):
+    """
+    Decide the next parameters of a run from the aggregated LSNR.
+    Params:
+        run:campaign.Run : Run in progress, qtable or adr policy
+        lsnr:float : Aggregated LSNR
+    Returns:
+        (datarate,transmission_power,tag)
+        tag:str : What decided, the Q-Table version or the ADR
+    """
+    if run.policy == "adr":
+        import policies
+        (datarate,transmission_power) = policies.decide_one(run.controller,lsnr,
+                                                            run.selected_dr,run.selected_tp)
+        return datarate,transmission_power,run.controller.name
+
+    (sf,transmission_power,version)=q_model(lsnr,run.selected_tp,run.q_table)
+    return 12-sf,transmission_power,f"table {version}"
+
+def save_decision(filename:str,old_dr:int,new_dr:int,old_tp:int,new_tp:int,
+                  nb_transmissions:int,source:str):
     """
-    #Power levels in dbm
-    power_levels = [6, 8, 10, 12, 14]
-    #Available SF, 
-    sfs= [7, 8, 9, 10, 11, 12, 13]
-    #Space computed 0
-    snr_space = np.linspace(6.5 ,-20.5, int((6.5+20.5)*2 + 1))
-    actions = list(product(sfs, power_levels))
-    #Convert dbm to TP
-    mapping_tp = {6: 5, 8: 4, 10: 3, 12: 2, 14: 1}
-    #Use the Q-Table and load it 
-    with open(Q_TABLE_PATH, 'rb') as f:
-        q_table = pickle.load(f)
-
-    q_value = np.argmax(
-                q_table[min(np.digitize(snr, snr_space), 54),
-                np.digitize(tp, power_levels) -1,:]
-                )
-    logging.debug("SF:%s",actions[q_value][0])
-    logging.debug("TP:%s",actions[q_value][1])
-    transmission_power = mapping_tp[actions[q_value][1]]
-    datarate=actions[q_value][0]
-    return datarate , transmission_power
+    Log a change of the transmission parameters and save it to the data file.
+    Params:
+        filename:str : Data file of the experiment
+        old_dr:int, new_dr:int : Datarate before and after
+        old_tp:int, new_tp:int : PWRIDX before and after
+        nb_transmissions:int : Number of messages sent
+        source:str : What made the decision (best gateway and snr, downlink...)
+    """
+    if new_tp==old_tp and new_dr==old_dr:
+        return
 
+    logging.info("[DSF2R] Datarate %s to %s\t\tTransmission Power %s to %s",
+                    old_dr,new_dr,old_tp,new_tp)
+    with open(filename,"a",encoding="utf-8") as file:
+        t_time = datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
+        file.write(f"{t_time} :[DSF2R] Datarate {old_dr} to {new_dr}\t\t\
+Transmission Power {old_tp} to {new_tp} - Nb message : {nb_transmissions} - {source}\n")
+
+def settle_samples(aggregator:UplinkAggregator,datarate:int,payload:bytes,samples:list,
+                   response:list):
+    """
+    Count the samples of an aggregated uplink, or put them back if it was not transmitted.
+    Params:
+        aggregator:UplinkAggregator : Aggregator the samples were taken from
+        datarate:int : Datarate of the uplink
+        payload:bytes : Payload given to the module
+        samples:list : Samples it carried
+        response:list : Response of send_uplink
+    Returns:
+        bool : True if the module transmitted the uplink
+    """
+    if response and response[-1] == "invalid_data_len":
+        if not aggregator.too_long(datarate,payload,samples):
+            logging.warning("Dropped %s samples, payload too long at DR %s",
+                            len(samples),datarate)
+        return False
+    if len(response) < 2 or not response[1].startswith(("mac_tx_ok","mac_rx")):
+        #Not transmitted (mac_err, no_free_ch...), the samples go in the next uplink
+        aggregator.restore(samples)
+        return False
+    aggregator.sent(payload,samples)
+    return True
 
 # #############################################################################
 #
@@ -246,28 +417,53 @@ def q_model(snr:int,tp:int):
 
 def main():
     #Main function of the program
+    global uplink_run
 
-    # MQTT
-    #Connect to Broker
-    try :
-        mqtt_client = mqtt_connect()
-    except RuntimeError as error:
-        logging.critical("Could not connect to broker, %s",error)
+    control_sources = set(CONTROL_MODE.replace("both","mqtt,downlink").split(","))
+    if not control_sources or not control_sources.issubset(CONTROL_SOURCES):
+        logging.critical("Unknown CONTROL_MODE %s",CONTROL_MODE)
         return 1
-    mqtt_client.on_message = mqtt_on_message
-    logging.info("Connected to MQTT Broker.")
+    mqtt_feedback = "mqtt" in control_sources
+    downlink_feedback = "downlink" in control_sources
+    ack_feedback_on = "ack" in control_sources
+    linkcheck_on = "linkcheck" in control_sources
 
-    #Sub to topic
-    mqtt_client.subscribe(MQTT_TOPIC)
+    # MQTT
+    #Connect to Broker, the supervisor reconnects and resubscribes by itself
+    #The Q-Table topics are subscribed whatever the CONTROL_MODE, the feedback topic only
+    #with the mqtt source
+    mqtt_supervisor = None
+    mqtt_callbacks = {}
+    if QTABLE_RELOAD_TOPIC:
+        mqtt_callbacks[QTABLE_RELOAD_TOPIC] = mqtt_on_reload
+    if QTABLE_PATCH_TOPIC:
+        mqtt_callbacks[QTABLE_PATCH_TOPIC] = mqtt_on_patch
+    if mqtt_feedback or mqtt_callbacks:
+        mqtt_supervisor = MqttSupervisor(MQTT_SERVER,MQTT_PORT,
+                                         MQTT_TOPIC if mqtt_feedback else None,
+                                         MQTT_CLIENT_ID,MQTT_USERNAME,MQTT_PASSWORD,
+                                         qos=MQTT_QOS,min_delay=MQTT_RECONNECT_MIN,
+                                         max_delay=MQTT_RECONNECT_MAX,
+                                         on_message=mqtt_on_message if mqtt_feedback else None,
+                                         callbacks=mqtt_callbacks)
+        mqtt_supervisor.start()
+        if not mqtt_supervisor.wait_connected(MQTT_CONNECT_TIMEOUT):
+            logging.warning("Broker %s:%s not reachable yet, starting anyway",
+                            MQTT_SERVER,MQTT_PORT)
 
-    #Create an object
-    module = RN2483(PORT)
+    #Q-Table reloads
+    signal.signal(signal.SIGHUP,lambda signum,frame: action_table.reload_policies())
+    if QTABLE_WATCH_INTERVAL > 0:
+        action_table.start_watcher(QTABLE_WATCH_INTERVAL)
 
-    #Number of messages sent
-    nb_transmissions = 0
-    #Choose parameter
-    selected_dr=0
-    selected_tp=1
+    #Profiling on demand, SIGUSR1/SIGUSR2 and PROFILE_SOCKET (see profiling)
+    profiling.install()
+    profiling.register_timers("stages",cycle_trace.stage_timers)
+    if mqtt_supervisor is not None:
+        profiling.register_timers("mqtt",mqtt_supervisor.metrics)
+
+    #Create an object
+    module = RN2483Client(SERIAL_MUX_SOCKET) if SERIAL_MUX_SOCKET else RN2483(PORT)
 
     #Filename
     filename:str = f"./logs/exp-{START_EXP}_data.txt"
@@ -276,33 +472,140 @@ def main():
     with open(filename,"a+",encoding="utf-8") as file:
         file.write(f"Starting experimentation at time:{START_EXP}\n")
 
-    #Factory Reset
-    logging.info("Starting Factory Reset")
-    status_code=1
-    while status_code == 1:
-        (status_code,response) = module.factory_reset()
-        logging.info("Facto reset : %s,%s",status_code,response)
-
-    #Set parameters
-    #Config savable parameters
-    logging.info("Setting Savable Params ABP")
-    (status_code,response) = module.config_savable_parameters_abp(DEVADDR,NWKSKEY,
-                                                            APPSKEY,0,{0:0,1:0,2:0})
-    logging.info("Savable parameters response : %s,%s",status_code,response)
+    #Warm start, keep the module configuration if it is already the right one
+    warm_started = False
+    if WARM_START:
+        logging.info("Trying warm start")
+        (status_code,response) = module.warm_start_abp(DEVADDR,NWKSKEY,APPSKEY,0,
+                                                       CHANNELS_AND_DUTY)
+        logging.info("Warm start response : %s,%s",status_code,response)
+        warm_started = status_code == 0
+
+    if not warm_started:
+        #Factory Reset
+        logging.info("Starting Factory Reset")
+        status_code=1
+        while status_code == 1:
+            (status_code,response) = module.factory_reset()
+            logging.info("Facto reset : %s,%s",status_code,response)
+
+        #Set parameters
+        #Config savable parameters
+        logging.info("Setting Savable Params ABP")
+        (status_code,response) = module.config_savable_parameters_abp(DEVADDR,NWKSKEY,
+                                                                APPSKEY,0,CHANNELS_AND_DUTY)
+        logging.info("Savable parameters response : %s,%s",status_code,response)
+
+        #Fingerprint for the next warm start
+        if WARM_START and status_code == 0:
+            module.set_config_fingerprint(module.abp_fingerprint(DEVADDR,NWKSKEY,APPSKEY,0,
+                                                                 CHANNELS_AND_DUTY))
 
     #Join network
     logging.info("Join network ABP")
     (status_code,response) = module.join_network(True)
     logging.info("Savable parameters response : %s,%s",status_code,response)
 
+    #Confirmed uplinks
+    ack_sampler = None
+    ack_adapter = None
+    if ack_feedback_on:
+        (status_code,response) = module.set_cnf_retransmissions(ACK_RETRANSMISSIONS)
+        logging.info("Retransmissions response : %s,%s",status_code,response)
+        ack_sampler = ack_feedback.AckSampler(ACK_CONFIRMED_RATIO)
+        ack_adapter = ack_feedback.AckAdapter(ACK_STEP_UP_AFTER)
+
+    #Link check
+    linkcheck = None
+    if linkcheck_on:
+        linkcheck = LinkCheckFeedback(module,LINKCHECK_INTERVAL)
+        (status_code,response) = linkcheck.start()
+        logging.info("Link check response : %s,%s",status_code,response)
+
+    #Aggregation of the samples
+    aggregator = None
+    nb_samples = 0
+    if UPLINK_AGGREGATION:
+        aggregator = UplinkAggregator(AGGREGATION_MAX_DELAY)
+
+    #Runs of the campaign, a single run from the constants without CAMPAIGN_FILE
+    if CAMPAIGN_FILE:
+        (mode,block,runs) = campaign.load_scenario(CAMPAIGN_FILE,Q_TABLE_PATH)
+        logging.info("Campaign %s : %s runs, %s",CAMPAIGN_FILE,len(runs),mode)
+    else:
+        (mode,block,runs) = ("sequential",1,[campaign.Run(None,POLICY,MAX_TRANSMISSIONS,
+                                                          q_table=Q_TABLE_PATH)])
+
+    #Load the Q-Tables before the first decision
+    for run in runs:
+        if run.policy == "qtable":
+            action_table.get_policy(run.q_table)
+        elif run.policy == "adr":
+            #NumPy, only for the ADR baseline
+            import policies
+            run.controller = policies.Adr(run.adr_margin)
+
     # Main loop
-    while nb_transmissions<MAX_TRANSMISSIONS:
-        #Config transmission parameters
-        module_dr = -1
-        module_tp = -1
-        #While mqtt_queue is empty send messages
-        while mqtt_queue.empty() and nb_transmissions<MAX_TRANSMISSIONS:
-            #Send message
+    current_run = None
+
+    #Module asleep between the uplinks
+    power = None
+    if POWER_SAVE:
+        power = PowerManager(module,POWER_WAKE_MARGIN,POWER_MIN_SLEEP)
+
+    #Uplink slots, the feedback worker stages the decisions for the next slot
+    scheduler = None
+    staged = None
+    feedback_worker = None
+    feedback_lock = threading.Lock()
+    if UPLINK_PERIOD > 0:
+        scheduler = UplinkScheduler(UPLINK_PERIOD,UPLINK_JITTER,UPLINK_DEADLINE)
+        staged = StagedDecision()
+
+        def decide(mqtt_message:dict,coalesced:int):
+            #Runs in the worker thread, while the main loop may be transmitting
+            run = current_run
+            if run is None or not run.adaptive:
+                return None
+            if mqtt_message["uplink_run"] != run.index:
+                logging.debug("Feedback of run %s dropped",mqtt_message["uplink_run"])
+                return None
+            with feedback_lock:
+                if not run.feedback_windows.push(DEVADDR,
+                                                 float(mqtt_message['best_gw']['lsnr'])):
+                    logging.warning("Invalid LSNR %s ignored",mqtt_message['best_gw']['lsnr'])
+                    return None
+                lsnr = run.feedback_windows.aggregate(DEVADDR)
+            with cycle_trace.span("q_model"):
+                (new_dr,new_tp,tag)=run_decision(run,lsnr)
+            return (new_dr,new_tp,f"Best GW {mqtt_message['best_gw']['desc']}- snr : {lsnr}"
+                                  f" - {tag} - coalesced {coalesced}")
+
+        feedback_worker = FeedbackWorker(mqtt_mailbox,DEVADDR,decide,staged)
+        feedback_worker.start()
+
+    #Timers of the profiling dumps
+    profiling.register_timers("serial",module.counters.summary)
+    profiling.register_timers("qtable_patches",lambda: qtable_patches.metrics()
+                              if qtable_patches is not None else {})
+    if power is not None:
+        profiling.register_timers("power",power.metrics)
+    profiling.register_timers("mqtt_mailbox",mqtt_mailbox.metrics)
+    if ack_adapter is not None:
+        profiling.register_timers("ack",ack_adapter.metrics)
+    if linkcheck is not None:
+        profiling.register_timers("linkcheck",linkcheck.metrics)
+    if aggregator is not None:
+        profiling.register_timers("aggregation",aggregator.metrics)
+    if scheduler is not None:
+        profiling.register_timers("scheduler",lambda: {**scheduler.metrics(),
+                                                       **staged.metrics()})
+    if mqtt_archive is not None:
+        profiling.register_timers("archive",mqtt_archive.metrics)
+
+    def apply_parameters(run:campaign.Run):
+        #Reconfigure the module if the run selected other parameters
+        with cycle_trace.span("read parameters"):
             #Get datarate
             got_error=1
             while got_error == 1:
@@ -313,57 +616,256 @@ def main():
             while got_error == 1:
                 (got_error,module_tp) = module.get_pwridx()
 
-            if module_dr!=selected_dr or module_tp!=selected_tp:
-                #Config transmission parameters
-                logging.info("Setting Transmission parameters")
-                (status_code,response) = module.config_transmission_parameter(selected_dr,False,
-                                            selected_tp)
-                logging.info("Transmission parameters response : %s,%s",status_code,response)
-                if status_code == 1:
-                    raise RuntimeError("Invalid transmission parameters")
-
-            #Format data
-            data = {"DR":selected_dr,"TP":selected_tp,"N":nb_transmissions}
-            json_string = json.dumps(data)
-            logging.debug("%s",json_string)
-
-            logging.info("Sending %s",json_string)
-            #Send the datarate
-            (status_code,response,_) = module.send_uplink(json_string,False)
-
-            nb_transmissions+=1
-
-        #Check if we did enough transmissions
-        if nb_transmissions>=MAX_TRANSMISSIONS:
-            break
-
-        #We got a MQTT message
-        mqtt_message = mqtt_queue.get()
-        #Empty the queue
-        while not mqtt_queue.empty():
-            mqtt_queue.get()
-        #Get lsnr
-        lsnr = float(mqtt_message['best_gw']['lsnr'])
-        logging.debug("LSNR : %s",lsnr)
-
-        #Send lsnr and transmission power to the function
-        (sf,new_tp)=q_model(lsnr,selected_tp)
-        new_dr= 12-sf
-
-        #Save to file
-        if new_tp!=selected_tp or new_dr!=selected_dr:
-            logging.info("[DSF2R] Datarate %s to %s\t\tTransmission Power %s to %s",
-                            selected_dr,new_dr,selected_tp,new_tp)
-            logging.info("Best gateway : %s",mqtt_message['best_gw']["desc"])
-            with open(filename,"a",encoding="utf-8") as file:
-                t_time = datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-                file.write(f"{t_time} :[DSF2R] Datarate {selected_dr} to {new_dr}\t\t\
-Transmission Power {selected_tp} to {new_tp} - Nb message : {nb_transmissions} - \
-Best GW {mqtt_message['best_gw']['desc']}- snr : {lsnr}\n")
-
-        selected_tp=new_tp
-        selected_dr=new_dr
-
+        if module_dr!=run.selected_dr or module_tp!=run.selected_tp:
+            #Config transmission parameters
+            logging.info("Setting Transmission parameters")
+            with cycle_trace.span("reconfigure"):
+                (status_code,response) = module.config_transmission_parameter(
+                    run.selected_dr,False,run.selected_tp)
+            logging.info("Transmission parameters response : %s,%s",status_code,response)
+            if status_code == 1:
+                raise RuntimeError("Invalid transmission parameters")
+
+    def send_leftover_samples(run:campaign.Run):
+        #Samples still queued when a run stops, sent before the next run or the end
+        global uplink_run
+        while len(aggregator):
+            if scheduler is not None:
+                scheduler.wait_slot(power.idle if power is not None else None)
+            apply_parameters(run)
+            (uplink_data,samples) = aggregator.take_payload(run.selected_dr)
+            logging.info("Sending %s (end of run)",uplink_data)
+            uplink_run = run.index
+            (_,response,_) = module.send_uplink(uplink_data,False)
+            if not settle_samples(aggregator,run.selected_dr,uplink_data,samples,response):
+                logging.warning("%s samples left in the aggregator",len(aggregator))
+                return
+
+    for (run,target) in campaign.schedule(mode,block,runs):
+        if not run.started:
+            run.started = True
+            run.filename = filename
+            if run.name is not None:
+                run.filename = f"./logs/exp-{START_EXP}_{run.name}_data.txt"
+                with open(run.filename,"a+",encoding="utf-8") as file:
+                    file.write(f"Starting run {run.name} (R {run.index}, {run.policy}, "
+                               f"DR {run.initial_dr}, TP {run.initial_tp}) "
+                               f"at time:{START_EXP}\n")
+            #Windows of the SNR feedback
+            run.feedback_windows = FeedbackWindows(FEEDBACK_WINDOW,FEEDBACK_AGGREGATOR,
+                                                   FEEDBACK_EWMA_ALPHA)
+        if run is not current_run:
+            if current_run is not None:
+                logging.info("Switching to run %s",run.name)
+                #The pending feedback belongs to the previous run
+                mqtt_mailbox.clear(DEVADDR)
+                if staged is not None:
+                    staged.discard()
+            current_run = run
+
+        while run.nb_transmissions<target:
+            #While there is no feedback send messages
+            while (feedback_worker is not None or mqtt_mailbox.empty(DEVADDR)) and \
+                    run.nb_transmissions<target:
+                #Queue the sample until the uplink is full or its deadline, the slot and the
+                #parameters of the module are only needed for an uplink
+                alone = None
+                if aggregator is not None:
+                    nb_samples+=1
+                    sample = {"DR":run.selected_dr,"TP":run.selected_tp,
+                              "N":run.nb_transmissions,"S":nb_samples}
+                    if run.name is not None:
+                        sample["R"] = run.index
+                    sample = json.dumps(sample,separators=(",",":"))
+                    try:
+                        aggregator.add(sample.encode("utf-8"))
+                    except ValueError as error:
+                        #Sent alone instead
+                        logging.warning("Sample not aggregated : %s",error)
+                        alone = sample
+                    else:
+                        if not aggregator.should_flush(run.selected_dr):
+                            sleep(SAMPLE_PERIOD)
+                            continue
+
+                #Wait for the slot and apply the decision staged meanwhile
+                if scheduler is not None:
+                    scheduler.wait_slot(power.idle if power is not None else None)
+                    decision = staged.take()
+                    if decision is not None:
+                        (new_dr,new_tp,source) = decision
+                        save_decision(run.filename,run.selected_dr,new_dr,run.selected_tp,
+                                      new_tp,run.nb_transmissions,source)
+                        run.selected_dr = new_dr
+                        run.selected_tp = new_tp
+
+                #Send message
+                cycle_trace.set_cycle(run.nb_transmissions)
+                apply_parameters(run)
+
+                #Format data
+                samples = None
+                if alone is not None:
+                    uplink_data = alone
+                elif aggregator is not None:
+                    (uplink_data,samples) = aggregator.take_payload(run.selected_dr)
+                else:
+                    data = {"DR":run.selected_dr,"TP":run.selected_tp,"N":run.nb_transmissions}
+                    if run.name is not None:
+                        data["R"] = run.index
+                    uplink_data = json.dumps(data)
+
+                confirmed = ack_sampler is not None and ack_sampler.next()
+
+                logging.info("Sending %s",uplink_data)
+                #Send the datarate
+                uplink_dr = run.selected_dr
+                uplink_run = run.index
+                tx_start = perf_counter()
+                with cycle_trace.span("send_uplink"):
+                    (status_code,response,_) = module.send_uplink(uplink_data,confirmed)
+                tx_elapsed = perf_counter() - tx_start
+
+                if samples is not None:
+                    settle_samples(aggregator,uplink_dr,uplink_data,samples,response)
+
+                run.nb_transmissions+=1
+                if LOG_COUNTERS_EVERY and run.nb_transmissions % LOG_COUNTERS_EVERY == 0:
+                    logging.info("Serial counters : %s",module.counters.summary())
+                    if mqtt_supervisor is not None:
+                        logging.info("MQTT metrics : %s, feedback : %s",
+                                     mqtt_supervisor.metrics(),mqtt_mailbox.metrics())
+                    if ack_adapter is not None:
+                        logging.info("ACK metrics : %s",ack_adapter.metrics())
+                    if linkcheck is not None:
+                        logging.info("Link check metrics : %s",linkcheck.metrics())
+                    if aggregator is not None:
+                        logging.info("Aggregation metrics : %s",aggregator.metrics())
+                    if scheduler is not None:
+                        logging.info("Scheduler metrics : %s, %s",scheduler.metrics(),
+                                     staged.metrics())
+                    if power is not None:
+                        logging.info("Power metrics : %s",power.metrics())
+
+                #Parameters pushed by the network in a downlink
+                if downlink_feedback and run.adaptive and status_code == 0:
+                    command = downlink_control.command_from_response(response,
+                                                                     DOWNLINK_CONTROL_PORT)
+                    if command is not None and command.sequence != run.last_sequence:
+                        run.last_sequence = command.sequence
+                        save_decision(run.filename,run.selected_dr,command.datarate,
+                                      run.selected_tp,command.pwridx,run.nb_transmissions,
+                                      f"Downlink seq {command.sequence}")
+                        run.selected_dr = command.datarate
+                        run.selected_tp = command.pwridx
+
+                #Chunks of a Q-Table patch
+                if QTABLE_PATCH_PORT and status_code == 0:
+                    for line in response:
+                        rx = RN2483.parse_mac_rx(line)
+                        if rx is not None and rx[0] == QTABLE_PATCH_PORT:
+                            receive_patch_chunk(rx[1])
+
+                #Answer of a link check
+                if linkcheck is not None and status_code == 0:
+                    margin_snr = linkcheck.after_uplink(uplink_dr)
+                    if margin_snr is not None and run.adaptive:
+                        with feedback_lock:
+                            run.feedback_windows.push(DEVADDR,margin_snr)
+                            lsnr = run.feedback_windows.aggregate(DEVADDR)
+                        (new_dr,new_tp,tag)=run_decision(run,lsnr)
+                        save_decision(run.filename,run.selected_dr,new_dr,run.selected_tp,
+                                      new_tp,run.nb_transmissions,
+                                      f"LinkCheck {linkcheck.last_gateways} GW- snr : {lsnr}"
+                                      f" - {tag}")
+                        run.selected_dr = new_dr
+                        run.selected_tp = new_tp
+
+                #Outcome of a confirmed uplink
+                if confirmed:
+                    outcome = ack_feedback.uplink_outcome(response)
+                    if outcome is not None:
+                        attempts = ack_adapter.estimate_attempts(uplink_dr,tx_elapsed,outcome)
+                        (new_dr,new_tp) = ack_adapter.update(outcome,attempts,run.selected_dr,
+                                                             run.selected_tp)
+                        logging.debug("Confirmed uplink : %s after %s attempts, %s",outcome,
+                                      attempts,ack_adapter.metrics())
+                        if run.adaptive:
+                            save_decision(run.filename,run.selected_dr,new_dr,run.selected_tp,
+                                          new_tp,run.nb_transmissions,
+                                          f"ACK {outcome} attempts {attempts}")
+                            run.selected_dr = new_dr
+                            run.selected_tp = new_tp
+
+                #Time between two uplinks of the run
+                if run.interval:
+                    if power is not None:
+                        power.wait(run.interval)
+                    else:
+                        sleep(run.interval)
+
+            #Check if we did enough transmissions
+            if run.nb_transmissions>=target:
+                break
+
+            #We got a MQTT message, the newest one
+            with cycle_trace.span("queue pickup"):
+                (mqtt_message,coalesced,_) = mqtt_mailbox.get(DEVADDR)
+                if mqtt_message["uplink_run"] != run.index:
+                    logging.debug("Feedback of run %s dropped",mqtt_message["uplink_run"])
+                    continue
+                if not run.feedback_windows.push(DEVADDR,
+                                                 float(mqtt_message['best_gw']['lsnr'])):
+                    logging.warning("Invalid LSNR %s ignored",mqtt_message['best_gw']['lsnr'])
+                    continue
+            if coalesced:
+                logging.debug("%s older feedback frames coalesced",coalesced)
+            if not run.adaptive:
+                continue
+            #Get lsnr
+            lsnr = run.feedback_windows.aggregate(DEVADDR)
+            logging.debug("LSNR : %s (%s)",lsnr,FEEDBACK_AGGREGATOR)
+
+            #Send lsnr and transmission power to the function
+            with cycle_trace.span("q_model"):
+                (new_dr,new_tp,tag)=run_decision(run,lsnr)
+
+            #Save to file
+            if new_tp!=run.selected_tp or new_dr!=run.selected_dr:
+                logging.info("Best gateway : %s",mqtt_message['best_gw']["desc"])
+            save_decision(run.filename,run.selected_dr,new_dr,run.selected_tp,new_tp,
+                          run.nb_transmissions,
+                          f"Best GW {mqtt_message['best_gw']['desc']}- snr : {lsnr}"
+                          f" - {tag}")
+
+            run.selected_tp=new_tp
+            run.selected_dr=new_dr
+
+        if aggregator is not None:
+            send_leftover_samples(run)
+
+        if run.done and run.name is not None:
+            end_run = datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
+            with open(run.filename,"a",encoding="utf-8") as file:
+                file.write(f"End of run {run.name},time:{end_run}\n")
+            logging.info("Run %s done",run.name)
+
+    if feedback_worker is not None:
+        feedback_worker.stop()
+        feedback_worker.join()
+        logging.info("Scheduler metrics : %s, %s",scheduler.metrics(),staged.metrics())
+    if power is not None:
+        logging.info("Power metrics : %s",power.metrics())
+    logging.info("Serial counters : %s",module.counters.summary())
+    if mqtt_supervisor is not None:
+        logging.info("MQTT metrics : %s",mqtt_supervisor.metrics())
+        logging.info("MQTT feedback : %s",mqtt_mailbox.metrics())
+        mqtt_supervisor.stop()
+    if snr_store is not None and SNR_STORE_SNAPSHOT:
+        snr_store.save(SNR_STORE_SNAPSHOT)
+    if mqtt_archive is not None:
+        logging.info("MQTT archive : %s",mqtt_archive.metrics())
+        mqtt_archive.close()
     end_exp = datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
     with open(filename,"a",encoding="utf-8") as file:
         file.write(f"End of experimentation,time:{end_exp}")
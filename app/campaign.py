@@ -0,0 +1,187 @@
+"""
+    This module describes the experiment campaigns run on one joined session
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Campaign
+#
+# A campaign is a list of runs executed by app.main after a single reset and join, so
+# the testbed time is not spent restarting the node between two experiments.
+#
+# Scenario file (JSON, CAMPAIGN_FILE in the node env file) :
+#   {
+#     "mode": "sequential",         sequential : the runs one after the other
+#                                   interleaved : "block" uplinks of each run in turn
+#     "block": 5,
+#     "runs": [
+#       {"name": "q-rob", "policy": "qtable", "q_table": "./config/Q_model-LORA-rob.pkl",
+#        "transmissions": 50, "interval": 0, "dr": 0, "tp": 1},
+#       {"name": "fixed-sf7", "policy": "fixed", "dr": 5, "tp": 1, "transmissions": 50}
+#     ]
+#   }
+#
+# policy :
+#   qtable : the DR/PWRIDX follow the enabled CONTROL_MODE sources, q_model uses q_table
+#   adr    : same sources, decided by the network server ADR algorithm (see policies),
+#            "adr_margin" is its installation margin in dB (default 10)
+#   fixed  : dr/tp are kept for the whole run (baseline)
+#
+# ===
+# Notes
+#   - Each run writes its own exp-<start>_<name>_data.txt. The uplinks carry the index of
+#     the run in the scenario ("R"), the name would not fit in an aggregated sample.
+#   - In interleaved mode, the feedback received for the uplinks of the previous run is
+#     dropped when switching runs, and the feedback arriving after the switch is filtered
+#     on the run of the uplink it follows.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import json
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+POLICIES = ("qtable","fixed","adr")
+MODES = ("sequential","interleaved")
+#Keys of a run in the scenario file (parameters of Run)
+RUN_KEYS = ("name","policy","transmissions","interval","q_table","dr","tp","adr_margin")
+#Longest run name, it goes in the file names of the run
+MAX_NAME_LEN = 32
+
+# #############################################################################
+#
+# Class Run
+#
+
+class Run:
+    """
+    One experiment of a campaign, its parameters and its progress
+    (name None for the single run of a node started without CAMPAIGN_FILE)
+    """
+    def __init__(self,name:str,policy:str="qtable",transmissions:int=50,interval:float=0,
+                 q_table:str=None,dr:int=0,tp:int=1,adr_margin:float=10.0):
+        if name is not None and not (isinstance(name,str) and 0 < len(name) <= MAX_NAME_LEN):
+            raise ValueError(f"Invalid run name {name!r}, 1 to {MAX_NAME_LEN} characters")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy} for run {name}, expected one of {POLICIES}")
+        if not 0 <= dr <= 5 or not 1 <= tp <= 5:
+            raise ValueError(f"Invalid DR {dr} or PWRIDX {tp} for run {name}")
+        if transmissions < 1 or interval < 0:
+            raise ValueError(f"Invalid transmissions {transmissions} or interval {interval} "
+                             f"for run {name}")
+        self.name = name
+        #Index in the scenario, tag of the uplinks and of their feedback
+        self.index = 0
+        self.policy = policy
+        self.transmissions = transmissions
+        self.interval = interval
+        self.q_table = q_table
+        self.initial_dr = dr
+        self.initial_tp = tp
+        self.adr_margin = adr_margin
+        #Decision policy of the adr runs (policies.Adr), created when the run starts
+        self.controller = None
+
+        #Progress, kept between the slices of an interleaved campaign
+        self.nb_transmissions = 0
+        self.selected_dr = dr
+        self.selected_tp = tp
+        self.last_sequence = None
+        self.started = False
+        self.filename = None
+        self.feedback_windows = None
+
+    @property
+    def adaptive(self):
+        """
+        Returns:
+            bool : True if the feedback may change the parameters
+        """
+        return self.policy != "fixed"
+
+    @property
+    def done(self):
+        """
+        Returns:
+            bool : True if every transmission of the run was made
+        """
+        return self.nb_transmissions >= self.transmissions
+
+# #############################################################################
+#
+# Functions
+#
+
+def load_scenario(path:str,default_q_table:str=None):
+    """
+    Load a scenario file.
+    Params:
+        path:str : Path to the JSON scenario
+        default_q_table:str : Q-Table of the qtable runs that do not give one
+    Returns:
+        (mode,block,runs)
+        mode:str : sequential or interleaved
+        block:int : Number of uplinks of a run before switching, interleaved mode
+        runs:list[Run]
+    """
+    with open(path,encoding="utf-8") as file:
+        scenario = json.load(file)
+
+    mode = scenario.get("mode","sequential")
+    if mode not in MODES:
+        raise ValueError(f"Unknown campaign mode {mode}, expected one of {MODES}")
+    block = int(scenario.get("block",1))
+    if block < 1:
+        raise ValueError(f"Invalid block {block}")
+
+    runs = []
+    for (index,description) in enumerate(scenario["runs"]):
+        if not isinstance(description,dict):
+            raise ValueError(f"Run {index} of {path} is not an object")
+        unknown = sorted(set(description) - set(RUN_KEYS))
+        if unknown:
+            raise ValueError(f"Unknown keys {unknown} in run {index} of {path}, "
+                             f"expected some of {RUN_KEYS}")
+        description = dict(description)
+        description.setdefault("name",f"run{index}")
+        if description.get("policy","qtable") == "qtable":
+            description.setdefault("q_table",default_q_table)
+        try:
+            run = Run(**description)
+        except (TypeError,ValueError) as error:
+            raise ValueError(f"Run {index} of {path} : {error}") from error
+        run.index = index
+        runs.append(run)
+
+    names = [run.name for run in runs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicated run names in {path}")
+    return mode,block,runs
+
+def schedule(mode:str,block:int,runs:list):
+    """
+    Order the slices of a campaign.
+    Params:
+        mode:str : sequential or interleaved
+        block:int : Number of uplinks of a slice, interleaved mode
+        runs:list[Run] : Runs of the campaign
+    Yields:
+        (run,target) : Run to execute until its nb_transmissions reaches target
+    """
+    if mode == "sequential":
+        for run in runs:
+            yield run,run.transmissions
+        return
+
+    while not all(run.done for run in runs):
+        for run in runs:
+            if not run.done:
+                yield run,min(run.nb_transmissions + block,run.transmissions)
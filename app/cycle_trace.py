@@ -0,0 +1,303 @@
+"""
+    This module traces the stages of the adaptation cycle in the Chrome trace format
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Cycle trace
+#
+# Spans around the stages of one adaptation cycle (read the parameters, reconfigure,
+# send_uplink split in command ack and TX completion, MQTT arrival, queue pickup,
+# q_model), tagged with the uplink counter N. They are written as Chrome trace events,
+# open the files in chrome://tracing or https://ui.perfetto.dev.
+#
+# Usage :
+#   configure_tracing("./logs/trace")       (TRACE_FILE in the node env file)
+#   set_cycle(nb_transmissions)
+#   with span("send_uplink"):
+#       ...
+#
+# ===
+# Notes
+#   - Without a trace file and without stage timers (the default), span returns a shared
+#     no-op context manager : two global lookups per stage, no allocation, no lock.
+#   - The events are buffered and written by blocks, the files rotate after max_events
+#     events (trace.json, trace.json.1, ...) like logging.handlers.RotatingFileHandler.
+#   - The MQTT arrival runs in the paho thread, it is an instant event tagged with the N
+#     of the last uplink sent.
+#   - The stage timers (count, mean, max and last duration of each span) are kept with
+#     STAGE_TIMERS=1, even without a trace file. stage_timers() returns them for the
+#     profiling dumps, empty when they are off.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import atexit
+import json
+import os
+import threading
+import time
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Writer of the configured tracing, None when off
+_writer = None
+
+#Uplink counter of the current cycle
+_cycle = None
+
+#Durations per stage, name -> [count,total,max,last] in ns, None when off
+_timers = None
+_timers_lock = threading.Lock()
+
+# #############################################################################
+#
+# Spans
+#
+
+class _NullSpan:
+    """
+    Span used when tracing is off
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        return False
+
+NULL_SPAN = _NullSpan()
+
+class Span:
+    """
+    Complete event ("X") from the enter to the exit of the block
+    """
+    __slots__ = ("_writer","_timers","_name","_args","_start")
+
+    def __init__(self,writer,name:str,args:dict,timers:dict=None):
+        self._writer = writer
+        self._timers = timers
+        self._name = name
+        self._args = args
+        self._start = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        end = time.perf_counter_ns()
+        duration = end - self._start
+        if self._timers is not None:
+            with _timers_lock:
+                timer = self._timers.setdefault(self._name,[0,0,0,0])
+                timer[0] += 1
+                timer[1] += duration
+                timer[2] = max(timer[2],duration)
+                timer[3] = duration
+        if self._writer is None:
+            return False
+        if exc_type is not None:
+            self._args["error"] = exc_type.__name__
+        self._writer.add({"name":self._name,"ph":"X","ts":self._start//1000,
+                          "dur":duration//1000,"args":self._args})
+        return False
+
+# #############################################################################
+#
+# Class TraceWriter
+#
+
+class TraceWriter:
+    """
+    Buffered writer of trace events to rotating JSON array files
+    """
+    def __init__(self,path:str,max_events:int=100000,backup_count:int=5,
+                 flush_every:int=256):
+        self._path = path
+        self._max_events = max_events
+        self._backup_count = backup_count
+        self._flush_every = flush_every
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._threads = set()
+        self._file = None
+        self._file_events = 0
+        self.events = 0
+
+    def add(self,event:dict):
+        """
+        Queue an event, the pid/tid are added here.
+        Params:
+            event:dict : Trace event without pid and tid
+        """
+        thread = threading.current_thread()
+        event["pid"] = self._pid
+        event["tid"] = thread.ident
+        with self._lock:
+            if thread.ident not in self._threads:
+                self._threads.add(thread.ident)
+                self._buffer.append({"name":"thread_name","ph":"M","pid":self._pid,
+                                     "tid":thread.ident,"args":{"name":thread.name}})
+            self._buffer.append(event)
+            self.events += 1
+            if len(self._buffer) >= self._flush_every:
+                self._write()
+
+    def flush(self):
+        """
+        Write the buffered events.
+        """
+        with self._lock:
+            self._write()
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        """
+        Write the buffered events and close the array of the current file.
+        """
+        with self._lock:
+            self._write()
+            self._close_file()
+
+    def _write(self):
+        """
+        Write the buffer, rotating the file when it is full. Lock held.
+        """
+        for event in self._buffer:
+            if self._file is None or self._file_events >= self._max_events:
+                self._rotate()
+            self._file.write(("[\n" if self._file_events == 0 else ",\n") + json.dumps(event))
+            self._file_events += 1
+        self._buffer.clear()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.write("\n]\n")
+            self._file.close()
+            self._file = None
+
+    def _rotate(self):
+        """
+        Close the current file and shift the backups. Lock held.
+        """
+        if self._file is not None:
+            self._close_file()
+            for index in range(self._backup_count - 1,0,-1):
+                source = f"{self._path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source,f"{self._path}.{index + 1}")
+            if self._backup_count > 0:
+                os.replace(self._path,f"{self._path}.1")
+        self._file = open(self._path,"w",encoding="utf-8")
+        self._file_events = 0
+        #The thread names are repeated in each file
+        for thread in threading.enumerate():
+            if thread.ident in self._threads:
+                self._file.write(("[\n" if self._file_events == 0 else ",\n") + json.dumps(
+                    {"name":"thread_name","ph":"M","pid":self._pid,"tid":thread.ident,
+                     "args":{"name":thread.name}}))
+                self._file_events += 1
+
+# #############################################################################
+#
+# Functions
+#
+
+def configure_tracing(path:str=None,max_events:int=None,backup_count:int=None,
+                      stage_timers:bool=None):
+    """
+    Turn the tracing on, the arguments default to the environment. No trace file is
+    written if the path is empty.
+    Params:
+        path:str : TRACE_FILE, trace file (".json" is added)
+        max_events:int : TRACE_MAX_EVENTS, events per file before rotating
+        backup_count:int : TRACE_BACKUPS, number of rotated files kept
+        stage_timers:bool : STAGE_TIMERS, keep the durations per stage
+    """
+    global _writer, _timers
+
+    if stage_timers is None:
+        stage_timers = os.getenv('STAGE_TIMERS', '0') == '1'
+    if stage_timers and _timers is None:
+        _timers = {}
+
+    path = path if path is not None else os.getenv('TRACE_FILE', '')
+    if not path:
+        return
+    if max_events is None:
+        max_events = int(os.getenv('TRACE_MAX_EVENTS', '100000'))
+    if backup_count is None:
+        backup_count = int(os.getenv('TRACE_BACKUPS', '5'))
+
+    stop_tracing()
+    _writer = TraceWriter(f"{path}.json",max_events,backup_count)
+    atexit.register(stop_tracing)
+
+def stop_tracing():
+    """
+    Write the pending events and turn the tracing off.
+    """
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+def set_cycle(cycle:int):
+    """
+    Set the uplink counter given to the next spans.
+    Params:
+        cycle:int : Uplink counter N
+    """
+    global _cycle
+    _cycle = cycle
+
+def span(name:str):
+    """
+    Trace a stage.
+    Params:
+        name:str : Name of the stage
+    Returns:
+        context manager : Span, or NULL_SPAN when tracing is off
+    """
+    writer = _writer
+    timers = _timers
+    if writer is None and timers is None:
+        return NULL_SPAN
+    return Span(writer,name,{"N":_cycle},timers)
+
+def instant(name:str,**args):
+    """
+    Trace an event without duration.
+    Params:
+        name:str : Name of the event
+        args : Extra arguments of the event
+    """
+    writer = _writer
+    if writer is None:
+        return
+    args["N"] = _cycle
+    writer.add({"name":name,"ph":"i","s":"t","ts":time.perf_counter_ns()//1000,"args":args})
+
+def stage_timers():
+    """
+    Durations of the stages since the start.
+    Returns:
+        timers:dict : name -> {"count","mean_ms","max_ms","last_ms"}, empty when off
+    """
+    if _timers is None:
+        return {}
+    with _timers_lock:
+        return {name:{"count":count,"mean_ms":round(total/count/1e6,3),
+                      "max_ms":round(maximum/1e6,3),"last_ms":round(last/1e6,3)}
+                for (name,(count,total,maximum,last)) in _timers.items()}
@@ -0,0 +1,120 @@
+"""
+    This module encodes and decodes the DR/PWRIDX commands sent in downlinks
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Downlink control
+#
+# The network side decides the transmission parameters and sends them in a downlink on a
+# dedicated port, the device applies them for its next uplinks. No MQTT session nor
+# q_model is needed on the device.
+#
+# Command format (3 bytes) :
+#   byte 0 : version (high nibble, 1) | opcode (low nibble)
+#   opcode 1, SET_PARAMS :
+#       byte 1 : datarate (high nibble, 0 to 5) | PWRIDX (low nibble, 1 to 5)
+#       byte 2 : sequence number, a repeated sequence number is ignored
+#
+# Usage (network side) :
+#   python3 downlink_control.py 4 3 17      -> prints the hex payload to queue on the port
+#
+# ===
+# Notes
+#
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import logging
+import sys
+from collections import namedtuple
+
+from RN2483 import RN2483
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Default port of the control downlinks
+CONTROL_PORT = 201
+
+VERSION = 1
+OPCODE_SET_PARAMS = 1
+
+DownlinkCommand = namedtuple("DownlinkCommand",["opcode","datarate","pwridx","sequence"])
+
+# #############################################################################
+#
+# Functions
+#
+
+def encode_set_params(datarate:int,pwridx:int,sequence:int):
+    """
+    Encode a SET_PARAMS command.
+    Params:
+        datarate:int : Datarate from 0 (SF12) to 5 (SF7)
+        pwridx:int : PWRIDX from 1 (max) to 5 (min)
+        sequence:int : Sequence number from 0 to 255
+    Returns:
+        payload:bytes : 3 bytes command
+    """
+    if not 0 <= datarate <= 5 or not 1 <= pwridx <= 5 or not 0 <= sequence <= 255:
+        raise ValueError(f"Invalid parameters DR {datarate}, PWRIDX {pwridx}, seq {sequence}")
+    return bytes(((VERSION << 4) | OPCODE_SET_PARAMS,(datarate << 4) | pwridx,sequence))
+
+def decode_command(payload:bytes):
+    """
+    Decode a control command.
+    Params:
+        payload:bytes : Downlink payload
+    Returns:
+        command:DownlinkCommand
+    Raises:
+        ValueError : if the payload is not a valid command
+    """
+    if len(payload) < 1 or payload[0] >> 4 != VERSION:
+        raise ValueError(f"Unknown command version in {payload.hex()}")
+
+    opcode = payload[0] & 0x0F
+    if opcode == OPCODE_SET_PARAMS:
+        if len(payload) != 3:
+            raise ValueError(f"Invalid SET_PARAMS length in {payload.hex()}")
+        datarate = payload[1] >> 4
+        pwridx = payload[1] & 0x0F
+        if datarate > 5 or not 1 <= pwridx <= 5:
+            raise ValueError(f"Invalid SET_PARAMS values in {payload.hex()}")
+        return DownlinkCommand(opcode,datarate,pwridx,payload[2])
+
+    raise ValueError(f"Unknown opcode {opcode} in {payload.hex()}")
+
+def command_from_response(response:list,control_port:int=CONTROL_PORT):
+    """
+    Extract a control command from the response of RN2483.send_uplink.
+    Params:
+        response:list : Lines returned by send_uplink
+        control_port:int : Port of the control downlinks
+    Returns:
+        command:DownlinkCommand|None : None if there is no valid command
+    """
+    for line in reversed(response):
+        rx = RN2483.parse_mac_rx(line)
+        if rx is None:
+            continue
+        (port,payload) = rx
+        if port != control_port:
+            return None
+        try:
+            return decode_command(payload)
+        except ValueError as error:
+            logging.warning("Invalid control downlink : %s",error)
+            return None
+    return None
+
+if __name__ == "__main__":
+    print(encode_set_params(int(sys.argv[1]),int(sys.argv[2]),int(sys.argv[3])).hex().upper())
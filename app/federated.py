@@ -0,0 +1,346 @@
+"""
+    This module merges the Q-Table updates learned by the devices (server side)
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Federated Q-Table
+#
+# Each device learns locally from a base table and sends the entries it changed : the
+# delta to the base and the number of visits of each entry. The server merges the deltas
+# with a visit weighted average and publishes the merged table, which becomes the base of
+# the next round.
+#
+#   merged = base + sum(visits_d * delta_d) / sum(visits_d)     (entries visited at least once)
+#
+# Update format (binary, little endian) :
+#   header  : version (B), round (H), nb entries (H), scale (f)
+#   entries : flat indexes (nb x uint16), deltas (nb x int16, delta = value*scale),
+#             visits (nb x uint16)
+#   9 bytes + 6 bytes per changed entry, sent over MQTT (QFED_UPDATE_TOPIC/<devaddr>)
+#   or split in uplinks.
+#
+# Table format : version (B), round (H), then the zlib compressed float32 table.
+#
+# Usage (server) :
+#   python3 federated.py --table ./config/Q_model-LORA-rob.pkl --server localhost \
+#       --topic qfed/update/+ --publish-topic qfed/table --period 60
+#
+# ===
+# Notes
+#   - The server keeps the running sums of visits and visits x delta, a new update of a
+#     device replaces its previous one (its contribution is subtracted first). A merge is
+#     then O(table size) whatever the number of devices.
+#   - merge_updates does the same in one batch with np.bincount, for offline use.
+#   - An update made from another round than the current one is ignored. An update with
+#     a scale that is not finite and positive, or with an index given twice, is rejected.
+#   - The aggregator is shared by the paho thread (add) and the merge loop (next_round),
+#     its methods hold its lock.
+#   - A merged table that does not pass qtable.validate_q_table is not published : the
+#     updates of the round are dropped and the base table is kept.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import argparse
+import logging
+import math
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+import qtable
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+VERSION = 1
+
+UPDATE_HEADER = struct.Struct("<BHHf")
+TABLE_HEADER = struct.Struct("<BH")
+
+#Number of entries of a Q-Table
+TABLE_SIZE = int(np.prod(qtable.Q_TABLE_SHAPE))
+
+#Largest quantized delta
+QUANTIZATION_MAX = 32767
+
+TableUpdate = namedtuple("TableUpdate",["round","indexes","deltas","visits"])
+
+# #############################################################################
+#
+# Functions
+#
+
+def encode_update(base:np.ndarray,local:np.ndarray,visits:np.ndarray,round_id:int):
+    """
+    Encode the entries changed by a device (device side).
+    Params:
+        base:np.ndarray : Table of the round, shape Q_TABLE_SHAPE
+        local:np.ndarray : Table learned by the device, same shape
+        visits:np.ndarray : Number of visits of each entry, same shape
+        round_id:int : Round of the base table
+    Returns:
+        payload:bytes
+    """
+    delta = (np.asarray(local,dtype=np.float64) - base).ravel()
+    visits = np.minimum(np.asarray(visits).ravel(),np.iinfo(np.uint16).max)
+    indexes = np.flatnonzero((delta != 0) & (visits > 0))
+
+    largest = float(np.max(np.abs(delta[indexes]))) if len(indexes) else 0.0
+    scale = QUANTIZATION_MAX/largest if largest > 0 else 1.0
+    quantized = np.round(delta[indexes]*scale).astype("<i2")
+
+    return (UPDATE_HEADER.pack(VERSION,round_id,len(indexes),scale)
+            + indexes.astype("<u2").tobytes() + quantized.tobytes()
+            + visits[indexes].astype("<u2").tobytes())
+
+def decode_update(payload:bytes):
+    """
+    Decode an update.
+    Params:
+        payload:bytes : Output of encode_update
+    Returns:
+        update:TableUpdate : flat indexes, deltas (float64) and visits
+    Raises:
+        ValueError : if the payload is not a valid update
+    """
+    if len(payload) < UPDATE_HEADER.size:
+        raise ValueError("Truncated update header")
+    (version,round_id,count,scale) = UPDATE_HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise ValueError(f"Unknown update version {version}")
+    if not math.isfinite(scale) or scale <= 0:
+        raise ValueError(f"Invalid update scale {scale}")
+    if len(payload) != UPDATE_HEADER.size + 6*count:
+        raise ValueError(f"Invalid update length {len(payload)} for {count} entries")
+
+    offset = UPDATE_HEADER.size
+    indexes = np.frombuffer(payload,dtype="<u2",count=count,offset=offset).astype(np.intp)
+    deltas = np.frombuffer(payload,dtype="<i2",count=count,offset=offset + 2*count)/scale
+    visits = np.frombuffer(payload,dtype="<u2",count=count,offset=offset + 4*count)
+    if count and indexes.max() >= TABLE_SIZE:
+        raise ValueError("Update index out of the table")
+    if len(np.unique(indexes)) != count:
+        raise ValueError("Update index given twice")
+    return TableUpdate(round_id,indexes,deltas,visits.astype(np.float64))
+
+def merge_updates(base:np.ndarray,updates:list):
+    """
+    Merge a batch of updates.
+    Params:
+        base:np.ndarray : Table of the round
+        updates:list[TableUpdate] : One update per device
+    Returns:
+        merged:np.ndarray : Merged table, same shape as base
+    """
+    merged = np.array(base,dtype=np.float64)
+    if not updates:
+        return merged
+    indexes = np.concatenate([update.indexes for update in updates])
+    visits = np.concatenate([update.visits for update in updates])
+    deltas = np.concatenate([update.deltas for update in updates])
+    weight = np.bincount(indexes,weights=visits,minlength=TABLE_SIZE)
+    weighted = np.bincount(indexes,weights=visits*deltas,minlength=TABLE_SIZE)
+    visited = weight > 0
+    merged.ravel()[visited] += weighted[visited]/weight[visited]
+    return merged
+
+def encode_table(table:np.ndarray,round_id:int):
+    """
+    Encode a table for the devices.
+    Params:
+        table:np.ndarray : Table, shape Q_TABLE_SHAPE
+        round_id:int : Round of the table
+    Returns:
+        payload:bytes
+    """
+    return (TABLE_HEADER.pack(VERSION,round_id)
+            + zlib.compress(np.asarray(table,dtype="<f4").tobytes()))
+
+def decode_table(payload:bytes):
+    """
+    Decode a table published by the server (device side).
+    Params:
+        payload:bytes : Output of encode_table
+    Returns:
+        (round_id,table)
+    """
+    (version,round_id) = TABLE_HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise ValueError(f"Unknown table version {version}")
+    table = np.frombuffer(zlib.decompress(payload[TABLE_HEADER.size:]),dtype="<f4")
+    if table.size != TABLE_SIZE:
+        raise ValueError(f"Invalid table size {table.size}, expected {TABLE_SIZE}")
+    return round_id,table.astype(np.float64).reshape(qtable.Q_TABLE_SHAPE)
+
+# #############################################################################
+#
+# Class FederatedAggregator
+#
+
+class FederatedAggregator:
+    """
+    Running visit weighted merge of the device updates
+    """
+    def __init__(self,base:np.ndarray,round_id:int=0):
+        if np.shape(base) != qtable.Q_TABLE_SHAPE:
+            raise ValueError(f"Invalid Q-Table shape {np.shape(base)}")
+        self.base = np.array(base,dtype=np.float64)
+        self.round = round_id
+        self._weight = np.zeros(TABLE_SIZE)
+        self._weighted = np.zeros(TABLE_SIZE)
+        self._updates = {}
+        self._lock = threading.Lock()
+        self.ignored = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._updates)
+
+    def add(self,device:str,update:TableUpdate):
+        """
+        Add the update of a device, replacing its previous one of the round.
+        Params:
+            device:str : Device address
+            update:TableUpdate : Decoded update
+        Returns:
+            bool : False if the update is from another round
+        """
+        with self._lock:
+            if update.round != self.round:
+                self.ignored += 1
+                return False
+            previous = self._updates.get(device)
+            if previous is not None:
+                #The indexes of one update are unique (decode_update), fancy indexing is enough
+                self._weight[previous.indexes] -= previous.visits
+                self._weighted[previous.indexes] -= previous.visits*previous.deltas
+            self._weight[update.indexes] += update.visits
+            self._weighted[update.indexes] += update.visits*update.deltas
+            self._updates[device] = update
+            return True
+
+    def _merged(self):
+        """
+        Merge the updates, lock held.
+        """
+        merged = self.base.copy()
+        visited = self._weight > 0.5
+        merged.ravel()[visited] += self._weighted[visited]/self._weight[visited]
+        return merged
+
+    def merged(self):
+        """
+        Returns:
+            merged:np.ndarray : Base table plus the weighted average of the deltas
+        """
+        with self._lock:
+            return self._merged()
+
+    def _reset(self):
+        """
+        Drop the updates of the round, lock held.
+        """
+        self._weight[:] = 0
+        self._weighted[:] = 0
+        self._updates.clear()
+
+    def next_round(self):
+        """
+        Make the merged table the base of a new round.
+        Returns:
+            (round_id,table) : New round and its base table
+        Raises:
+            ValueError : if the merged table is invalid, the updates of the round are
+                         dropped and the base table is kept
+        """
+        with self._lock:
+            merged = self._merged()
+            try:
+                qtable.validate_q_table(merged)
+            except ValueError:
+                self._reset()
+                raise
+            self.base = merged
+            self.round = (self.round + 1) % 65536
+            self._reset()
+            return self.round,self.base
+
+# #############################################################################
+#
+# Server
+#
+
+def serve(args:argparse.Namespace):
+    """
+    Collect the updates from MQTT and publish the merged table every period.
+    Params:
+        args:argparse.Namespace : Command line arguments
+    """
+    from mqtt_supervisor import MqttSupervisor
+
+    aggregator = FederatedAggregator(qtable.load_q_table(args.table),args.round)
+
+    def on_message(client,userdata,message):
+        device = message.topic.rsplit("/",1)[-1]
+        try:
+            aggregator.add(device,decode_update(message.payload))
+        except ValueError as error:
+            logging.warning("Invalid update from %s : %s",device,error)
+
+    supervisor = MqttSupervisor(args.server,args.port,args.topic,args.client_id,
+                                args.username,args.password,on_message=on_message)
+    supervisor.start()
+    try:
+        while True:
+            time.sleep(args.period)
+            if len(aggregator) == 0:
+                continue
+            nb_devices = len(aggregator)
+            start = time.perf_counter()
+            try:
+                (round_id,table) = aggregator.next_round()
+            except ValueError as error:
+                logging.error("Round %s not published, %s updates dropped : %s",
+                              aggregator.round,nb_devices,error)
+                continue
+            payload = encode_table(table,round_id)
+            supervisor.client.publish(args.publish_topic,payload,qos=1,retain=True)
+            logging.info("Round %s : %s devices merged in %.3f s, %s bytes published",
+                         round_id,nb_devices,time.perf_counter() - start,len(payload))
+    finally:
+        supervisor.stop()
+
+def main():
+    """
+    Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--table",required=True,help="Q-Table of the first round")
+    parser.add_argument("--round",type=int,default=0,help="Round of the first table")
+    parser.add_argument("--server",required=True,help="MQTT broker")
+    parser.add_argument("--port",type=int,default=1883)
+    parser.add_argument("--username",default=None)
+    parser.add_argument("--password",default=None)
+    parser.add_argument("--client-id",default="qfed-server")
+    parser.add_argument("--topic",default="qfed/update/+",help="Updates, last level devaddr")
+    parser.add_argument("--publish-topic",default="qfed/table")
+    parser.add_argument("--period",type=float,default=60,help="Seconds between two merges")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve(args)
+
+if __name__ == "__main__":
+    main()
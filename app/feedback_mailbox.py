@@ -0,0 +1,138 @@
+"""
+    This module holds the newest feedback of each device, replacing the unbounded queue
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Feedback mailbox
+#
+# One slot per devaddr : put overwrites the slot in O(1) and counts the frames it
+# replaced, the consumer gets the newest feedback and how many older ones were coalesced
+# into it. Memory is bounded by the number of devices, whatever the burst.
+#
+# Usage :
+#   mailbox = FeedbackMailbox()
+#   mailbox.put(devaddr,message)                      (paho thread)
+#   item = mailbox.get(devaddr,timeout=0.5)           (consumer, None on timeout)
+#   (message,coalesced,received_at) = item
+#
+# ===
+# Notes
+#   - received_at is the time.monotonic() of the newest message, the decision latency
+#     is measured from the arrival of the feedback used.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import threading
+import time
+
+# #############################################################################
+#
+# Class FeedbackMailbox
+#
+
+class FeedbackMailbox:
+    """
+    Newest feedback per devaddr, with the count of the frames coalesced
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        #devaddr -> [message,coalesced,received_at]
+        self._slots = {}
+        self.received = 0
+        self.coalesced = 0
+        self.delivered = 0
+
+    def put(self,devaddr:str,message:dict):
+        """
+        Store the feedback of a device, replacing the one not consumed yet.
+        Params:
+            devaddr:str : Device of the feedback
+            message:dict : Feedback message
+        """
+        with self._condition:
+            slot = self._slots.get(devaddr)
+            if slot is None:
+                self._slots[devaddr] = [message,0,time.monotonic()]
+            else:
+                slot[0] = message
+                slot[1] += 1
+                slot[2] = time.monotonic()
+                self.coalesced += 1
+            self.received += 1
+            self._condition.notify_all()
+
+    def _pop(self,devaddr:str):
+        """
+        Take the slot of a device, or of any device if devaddr is None. Lock held.
+        """
+        if devaddr is None:
+            if not self._slots:
+                return None
+            devaddr = next(iter(self._slots))
+        slot = self._slots.pop(devaddr,None)
+        if slot is not None:
+            self.delivered += 1
+            return tuple(slot)
+        return None
+
+    def get(self,devaddr:str=None,timeout:float=None):
+        """
+        Wait for the feedback of a device.
+        Params:
+            devaddr:str : Device, None for any device
+            timeout:float : Maximum wait in seconds, None to wait forever
+        Returns:
+            (message,coalesced,received_at) | None : None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                item = self._pop(devaddr)
+                if item is not None:
+                    return item
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def take(self,devaddr:str=None):
+        """
+        Take the feedback of a device without waiting.
+        Returns:
+            (message,coalesced,received_at) | None
+        """
+        with self._condition:
+            return self._pop(devaddr)
+
+    def empty(self,devaddr:str=None):
+        """
+        Returns:
+            bool : True if there is no feedback for the device (any device if None)
+        """
+        with self._condition:
+            return not self._slots if devaddr is None else devaddr not in self._slots
+
+    def clear(self,devaddr:str=None):
+        """
+        Drop the feedback of a device, of every device if devaddr is None.
+        """
+        with self._condition:
+            if devaddr is None:
+                self._slots.clear()
+            else:
+                self._slots.pop(devaddr,None)
+
+    def metrics(self):
+        """
+        Returns:
+            metrics:dict : frames received, coalesced, delivered and pending devices
+        """
+        with self._condition:
+            return {"received":self.received,"coalesced":self.coalesced,
+                    "delivered":self.delivered,"pending":len(self._slots)}
@@ -0,0 +1,282 @@
+"""
+    This module keeps a window of the SNR feedback of each device
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Feedback window
+#
+# The LSNR of the last uplinks is kept in a fixed size ring buffer per device, an
+# aggregator (last, mean, ewma, median, min or a percentile) turns it into the SNR
+# given to the policy, so one noisy reading does not flip DR/TP.
+#
+# ===
+# Notes
+#   - The EWMA and the sum of the window are updated on each push, O(1). A feedback that
+#     is not finite (malformed LSNR) is rejected, it would stay in the sum and the EWMA.
+#   - The window is sorted once after a push, on the first order statistic asked, the
+#     median/percentiles are then O(1). The window size is fixed so the cost per
+#     feedback does not depend on the run length.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+from array import array
+import math
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Aggregators accepted by make_aggregator, pNN is a percentile (e.g. p25)
+AGGREGATORS = ("last","mean","ewma","median","min")
+
+# #############################################################################
+#
+# Class RingBuffer
+#
+
+class RingBuffer:
+    """
+    Fixed size ring buffer backed by an array of doubles
+    """
+    def __init__(self,size:int):
+        if size < 1:
+            raise ValueError(f"Invalid ring buffer size {size}")
+        self._data = array('d',bytes(8*size))
+        self._index = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self,value:float):
+        """
+        Add a value, overwriting the oldest one when the buffer is full.
+        Params:
+            value:float : Value to add
+        Returns:
+            evicted:float|None : Overwritten value, None if the buffer was not full
+        """
+        evicted = None
+        if self._count == len(self._data):
+            evicted = self._data[self._index]
+        self._data[self._index] = value
+        self._index = (self._index + 1) % len(self._data)
+        self._count = min(self._count + 1,len(self._data))
+        return evicted
+
+    def last(self):
+        """
+        Get the newest value.
+        Returns:
+            value:float|None : Newest value, None if the buffer is empty
+        """
+        if self._count == 0:
+            return None
+        return self._data[self._index - 1]
+
+    def values(self):
+        """
+        Get the values from the oldest to the newest.
+        Returns:
+            values:array : Copy of the values
+        """
+        if self._count < len(self._data):
+            return self._data[:self._count]
+        return self._data[self._index:] + self._data[:self._index]
+
+    def clear(self):
+        """
+        Remove every value.
+        """
+        self._index = 0
+        self._count = 0
+
+# #############################################################################
+#
+# Class FeedbackWindow
+#
+
+class FeedbackWindow:
+    """
+    Window of the last SNR feedbacks of one device
+    """
+    def __init__(self,size:int,alpha:float=0.3):
+        self._buffer = RingBuffer(size)
+        self._alpha = alpha
+        self._ewma = None
+        self._sum = 0.0
+        self._sorted = None
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def push(self,snr:float):
+        """
+        Add a feedback.
+        Params:
+            snr:float : LSNR of the uplink
+        Returns:
+            bool : False if the feedback is not finite, it is not added
+        """
+        if not math.isfinite(snr):
+            self.rejected += 1
+            return False
+        evicted = self._buffer.append(snr)
+        if evicted is not None:
+            self._sum -= evicted
+        self._sum += snr
+        if self._ewma is None:
+            self._ewma = snr
+        else:
+            self._ewma = self._alpha*snr + (1 - self._alpha)*self._ewma
+        self._sorted = None
+        return True
+
+    def last(self):
+        """
+        Returns:
+            snr:float|None : Newest feedback
+        """
+        return self._buffer.last()
+
+    def mean(self):
+        """
+        Returns:
+            snr:float|None : Mean of the window
+        """
+        if len(self._buffer) == 0:
+            return None
+        return self._sum/len(self._buffer)
+
+    def ewma(self):
+        """
+        Returns:
+            snr:float|None : Exponentially weighted moving average of the feedbacks
+        """
+        return self._ewma
+
+    def percentile(self,percent:float):
+        """
+        Get a percentile of the window, linear interpolation between the ranks.
+        Params:
+            percent:float : Percentile from 0 to 100
+        Returns:
+            snr:float|None : Percentile, None if the window is empty
+        """
+        if len(self._buffer) == 0:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self._buffer.values())
+        rank = percent/100.0*(len(self._sorted) - 1)
+        lower = int(rank)
+        upper = min(lower + 1,len(self._sorted) - 1)
+        return (self._sorted[lower]
+                + (rank - lower)*(self._sorted[upper] - self._sorted[lower]))
+
+    def median(self):
+        """
+        Returns:
+            snr:float|None : Median of the window
+        """
+        return self.percentile(50)
+
+    def minimum(self):
+        """
+        Returns:
+            snr:float|None : Lowest feedback of the window
+        """
+        return self.percentile(0)
+
+# #############################################################################
+#
+# Functions
+#
+
+def make_aggregator(name:str):
+    """
+    Build the function turning a window into the SNR given to the policy.
+    Params:
+        name:str : last, mean, ewma, median, min or pNN (percentile, e.g. p25)
+    Returns:
+        aggregator:Callable[[FeedbackWindow],float]
+    """
+    name = name.strip().lower()
+    if name == "last":
+        return FeedbackWindow.last
+    if name == "mean":
+        return FeedbackWindow.mean
+    if name == "ewma":
+        return FeedbackWindow.ewma
+    if name == "median":
+        return FeedbackWindow.median
+    if name == "min":
+        return FeedbackWindow.minimum
+    if name.startswith("p"):
+        try:
+            percent = float(name[1:])
+        except ValueError:
+            percent = -1
+        if 0 <= percent <= 100:
+            return lambda window: window.percentile(percent)
+
+    raise ValueError(f"Unknown feedback aggregator {name}, expected one of {AGGREGATORS} or pNN")
+
+# #############################################################################
+#
+# Class FeedbackWindows
+#
+
+class FeedbackWindows:
+    """
+    Feedback windows of several devices, created on their first feedback
+    """
+    def __init__(self,size:int,aggregator:str="last",alpha:float=0.3):
+        self._size = size
+        self._alpha = alpha
+        self._aggregate = make_aggregator(aggregator)
+        self._windows = {}
+
+    def push(self,devaddr:str,snr:float):
+        """
+        Add a feedback to the window of a device.
+        Params:
+            devaddr:str : Device address
+            snr:float : LSNR of the uplink
+        Returns:
+            bool : False if the feedback is not finite, it is not added
+        """
+        window = self._windows.get(devaddr)
+        if window is None:
+            window = FeedbackWindow(self._size,self._alpha)
+            self._windows[devaddr] = window
+        return window.push(snr)
+
+    def window(self,devaddr:str):
+        """
+        Params:
+            devaddr:str : Device address
+        Returns:
+            window:FeedbackWindow|None : Window of the device
+        """
+        return self._windows.get(devaddr)
+
+    def aggregate(self,devaddr:str):
+        """
+        Get the SNR to give to the policy for a device.
+        Params:
+            devaddr:str : Device address
+        Returns:
+            snr:float|None : Aggregated SNR, None if the device has no feedback
+        """
+        window = self._windows.get(devaddr)
+        if window is None or len(window) == 0:
+            return None
+        return self._aggregate(window)
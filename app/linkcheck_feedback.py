@@ -0,0 +1,120 @@
+"""
+    This module gets the SNR feedback from the LoRaWAN Link Check, without the MQTT backend
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# LinkCheck feedback
+#
+# The module adds a LinkCheckReq to the next uplink once the link check interval has
+# expired (mac set linkchk). The network server answers in the RX windows with a
+# LinkCheckAns holding the demodulation margin and the number of gateways, read with
+# mac get mrgn / mac get gwnb. The margin is relative to the demodulation floor of the
+# datarate used, so SNR = margin + required SNR of the SF (README Table I).
+#
+# ===
+# Notes
+#   - The module only keeps the values of the last LinkCheckAns. They are read after the
+#     first uplink following the expiry of the interval, and ignored when no gateway is
+#     reported.
+#   - If the answer is lost the module returns the values of the previous answer again,
+#     and they are relative to the datarate of that answer. The module gives no freshness
+#     flag, and on a steady link real answers often repeat exactly. A repeat is only
+#     taken as stale when the datarate changed since the last accepted answer (a real
+#     margin moves with the SF) : it is counted apart and not returned, so a margin is
+#     never converted with the datarate of another uplink.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import logging
+import time
+
+import lora_phy
+
+# #############################################################################
+#
+# Class LinkCheckFeedback
+#
+
+class LinkCheckFeedback:
+    """
+    Schedule the link checks and convert their answer into the SNR used by q_model
+    """
+    def __init__(self,module,interval:int):
+        if not 1 <= interval <= 65535:
+            raise ValueError(f"Invalid link check interval {interval}")
+        self._module = module
+        self._interval = interval
+        self._armed_at = None
+        self.checks = 0
+        self.answers = 0
+        self.stale = 0
+        self.last_margin = None
+        self.last_gateways = None
+        #Datarate of the uplink of the last accepted answer
+        self.last_datarate = None
+
+    def start(self):
+        """
+        Enable the periodic link check on the module.
+        Returns:
+            (status_code, response) : see RN2483.set_linkchk
+        """
+        (status_code,response) = self._module.set_linkchk(self._interval)
+        if status_code == 0:
+            self._armed_at = time.monotonic()
+        return (status_code,response)
+
+    def after_uplink(self,datarate:int):
+        """
+        To call after each uplink, read the answer of the link check it carried, if any.
+        Params:
+            datarate:int : Datarate of the uplink
+        Returns:
+            snr:float|None : SNR of the uplink at the best gateway, None if no answer
+        """
+        if self._armed_at is None:
+            return None
+        if time.monotonic() - self._armed_at < self._interval:
+            return None
+
+        #This uplink carried the LinkCheckReq, the interval restarts
+        self._armed_at = time.monotonic()
+        self.checks += 1
+
+        (status_code,gateways) = self._module.get_gateway_count()
+        if status_code != 0 or gateways == 0:
+            logging.debug("No Link Check Answer (%s,%s)",status_code,gateways)
+            return None
+        (status_code,margin) = self._module.get_margin()
+        if status_code != 0:
+            return None
+        if (margin,gateways) == (self.last_margin,self.last_gateways) and \
+                datarate != self.last_datarate:
+            self.stale += 1
+            logging.debug("Link check : margin %s dB, %s gateways read again (DR %s), "
+                          "ignored",margin,gateways,self.last_datarate)
+            return None
+
+        self.answers += 1
+        self.last_margin = margin
+        self.last_gateways = gateways
+        self.last_datarate = datarate
+        snr = margin + lora_phy.REQUIRED_SNR[lora_phy.datarate_to_sf(datarate)]
+        logging.debug("Link check : margin %s dB, %s gateways, SNR %s",margin,gateways,snr)
+        return snr
+
+    def metrics(self):
+        """
+        Returns:
+            metrics:dict : checks, answers, stale readings, last margin, gateway count
+                           and datarate
+        """
+        return {"checks":self.checks,"answers":self.answers,"stale":self.stale,
+                "last_margin":self.last_margin,"last_gateways":self.last_gateways,
+                "last_datarate":self.last_datarate}
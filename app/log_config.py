@@ -0,0 +1,174 @@
+"""
+    This module configures the logging of the application
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Logging configuration
+#
+# Environment (from the node env file) :
+#   LOG_LEVEL        : DEBUG, INFO, WARNING, ... (default DEBUG)
+#   LOG_MODE         : sync, records are written by the calling thread (default)
+#                      queue, records go through a QueueHandler and are written by a
+#                      QueueListener thread, the hot loops never wait on the output
+#   LOG_FORMAT       : full, with file, function, line and thread (default)
+#                      light, time, level and message only, the thread and process
+#                      are not looked up
+#   LOG_TRACE_RATE   : Max number of per command trace records per second, 0 for no limit
+#   LOG_TRACE_SAMPLE : Keep one per command trace record out of N (default 1)
+#
+# ===
+# Notes
+#   The per command traces of the RN2483 class use the TRACE_LOGGER logger so they can
+#   be limited without touching the other records.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Logger of the per command traces
+TRACE_LOGGER = "RN2483.trace"
+
+FORMATS = {
+    "full":'%(asctime)s,%(msecs)03d %(levelname)-8s - [%(filename)s.%(funcName)-10s:\
+%(lineno)-3d.] - %(threadName)s - %(message)s',
+    "light":'%(asctime)s,%(msecs)03d %(levelname)-8s - %(message)s',
+}
+
+#Listener of the queue mode
+_listener = None
+
+# #############################################################################
+#
+# Filters
+#
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket filter, let at most rate records per second go through
+    """
+    def __init__(self,rate:float,burst:int=None):
+        super().__init__()
+        self._rate = rate
+        self._burst = burst if burst is not None else max(int(rate),1)
+        self._tokens = float(self._burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def filter(self,record:logging.LogRecord):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst,self._tokens + (now - self._last)*self._rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.dropped += 1
+            return False
+
+class SampleFilter(logging.Filter):
+    """
+    Let one record out of every N go through
+    """
+    def __init__(self,every:int):
+        super().__init__()
+        self._every = every
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def filter(self,record:logging.LogRecord):
+        with self._lock:
+            keep = self._count % self._every == 0
+            self._count += 1
+            return keep
+
+# #############################################################################
+#
+# Functions
+#
+
+def configure_logging(level:str=None,mode:str=None,log_format:str=None,
+                      trace_rate:float=None,trace_sample:int=None):
+    """
+    Configure the root logger, the arguments default to the environment.
+    Params:
+        level:str : LOG_LEVEL
+        mode:str : LOG_MODE, sync or queue
+        log_format:str : LOG_FORMAT, full or light
+        trace_rate:float : LOG_TRACE_RATE, per command trace records per second
+        trace_sample:int : LOG_TRACE_SAMPLE, keep one per command trace out of N
+    """
+    global _listener
+
+    level = (level or os.getenv('LOG_LEVEL', 'DEBUG')).upper()
+    mode = (mode or os.getenv('LOG_MODE', 'sync')).lower()
+    log_format = (log_format or os.getenv('LOG_FORMAT', 'full')).lower()
+    if trace_rate is None:
+        trace_rate = float(os.getenv('LOG_TRACE_RATE', '0'))
+    if trace_sample is None:
+        trace_sample = int(os.getenv('LOG_TRACE_SAMPLE', '1'))
+
+    if log_format not in FORMATS:
+        raise ValueError(f"Unknown LOG_FORMAT {log_format}, expected one of {list(FORMATS)}")
+
+    #The light format does not print the thread/process, do not look them up (public
+    #switches of the logging module, restored by a later full configuration). The caller
+    #is still resolved, other handlers may print it.
+    lookups = log_format != "light"
+    logging.logThreads = lookups
+    logging.logProcesses = lookups
+    logging.logMultiprocessing = lookups
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(FORMATS[log_format],datefmt='%Y-%m-%d %H:%M:%S'))
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.setLevel(level)
+
+    if mode == "queue":
+        log_queue = queue.SimpleQueue()
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue,handler,
+                                                   respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+    elif mode == "sync":
+        root.addHandler(handler)
+    else:
+        raise ValueError(f"Unknown LOG_MODE {mode}, expected sync or queue")
+
+    trace_logger = logging.getLogger(TRACE_LOGGER)
+    for old_filter in trace_logger.filters[:]:
+        trace_logger.removeFilter(old_filter)
+    if trace_sample > 1:
+        trace_logger.addFilter(SampleFilter(trace_sample))
+    if trace_rate > 0:
+        trace_logger.addFilter(RateLimitFilter(trace_rate))
+
+def stop_logging():
+    """
+    Flush and stop the queue listener, if any.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,120 @@
+"""
+    This module gathers the LoRa physical layer figures used by the tooling
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# LoRa PHY
+#
+# Required SNR per SF (README Table I), PWRIDX to dBm mapping, time on air.
+#
+# ===
+# Notes
+#   The time on air follows the Semtech SX1276 datasheet formula (125 kHz, explicit
+#   header, CRC on, coding rate 4/5, low data rate optimisation for SF11 and SF12).
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import math
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Available spreading factors on EU868 / 125 kHz
+SPREADING_FACTORS = [7, 8, 9, 10, 11, 12]
+
+#Required SNR [dB] for the demodulation (README Table I)
+REQUIRED_SNR = {7: -7.5, 8: -10.0, 9: -12.5, 10: -15.0, 11: -17.5, 12: -20.0}
+
+#Sensitivity [dBm] (README Table I)
+SENSITIVITY = {7: -126.5, 8: -127.25, 9: -131.25, 10: -132.75, 11: -133.25, 12: -134.5}
+
+#PWRIDX of the RN2483 to transmission power in dBm (see RN2483.set_pwridx)
+PWRIDX_TO_DBM = {1: 14, 2: 12, 3: 10, 4: 8, 5: 6}
+
+#Maximum application payload per datarate (see RN2483.send_uplink)
+MAX_PAYLOAD = {0: 51, 1: 51, 2: 51, 3: 115, 4: 222, 5: 222}
+
+#LoRaWAN MAC overhead added to the application payload (MHDR, FHDR, FPort, MIC)
+LORAWAN_OVERHEAD = 13
+
+#Bandwidth [Hz]
+BANDWIDTH = 125e3
+
+# #############################################################################
+#
+# Functions
+#
+
+def datarate_to_sf(datarate:int):
+    """
+    Convert a RN2483 datarate (0 to 5) to its spreading factor.
+    Params:
+        datarate:int : Datarate from 0 (SF12) to 5 (SF7)
+    Returns:
+        sf:int : Spreading factor
+    """
+    return 12 - datarate
+
+def sf_to_datarate(sf:int):
+    """
+    Convert a spreading factor to the RN2483 datarate.
+    Params:
+        sf:int : Spreading factor from 7 to 12
+    Returns:
+        datarate:int : Datarate from 0 (SF12) to 5 (SF7)
+    """
+    return 12 - sf
+
+def time_on_air(sf:int,payload_len:int,preamble_len:int=8,coding_rate:int=1):
+    """
+    Compute the time on air of a LoRaWAN frame.
+    Params:
+        sf:int : Spreading factor from 7 to 12
+        payload_len:int : Application payload length in bytes (LoRaWAN overhead is added)
+        preamble_len:int : Number of preamble symbols
+        coding_rate:int : 1 for 4/5 up to 4 for 4/8
+    Returns:
+        toa:float : Time on air in seconds
+    """
+    t_sym = (2**sf)/BANDWIDTH
+    low_dr_optimize = 1 if sf >= 11 else 0
+    phy_len = payload_len + LORAWAN_OVERHEAD
+    #Explicit header (0) and CRC on (16 bits)
+    nb_symbols = 8 + max(
+        math.ceil((8*phy_len - 4*sf + 28 + 16)/(4*(sf - 2*low_dr_optimize)))*(coding_rate + 4),
+        0)
+    return (preamble_len + 4.25)*t_sym + nb_symbols*t_sym
+
+def dbm_to_mw(power_dbm:float):
+    """
+    Convert a power in dBm to mW.
+    Params:
+        power_dbm:float : Power in dBm
+    Returns:
+        power_mw:float : Power in mW
+    """
+    return 10**(power_dbm/10.0)
+
+def datarate_lookups(payload_len:int):
+    """
+    Build the per datarate and per PWRIDX lookups used by the vectorized tooling.
+    Params:
+        payload_len:int : Application payload length in bytes
+    Returns:
+        (required_snr,airtime,power_dbm)
+        required_snr:list : Required SNR [dB] indexed by datarate (0 to 5)
+        airtime:list : Time on air [s] indexed by datarate (0 to 5)
+        power_dbm:list : TX power [dBm] indexed by PWRIDX (1 to 5, index 0 unused)
+    """
+    required_snr = [REQUIRED_SNR[datarate_to_sf(dr)] for dr in range(6)]
+    airtime = [time_on_air(datarate_to_sf(dr),payload_len) for dr in range(6)]
+    power_dbm = [0] + [PWRIDX_TO_DBM[pwridx] for pwridx in range(1,6)]
+    return required_snr, airtime, power_dbm
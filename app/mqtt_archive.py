@@ -0,0 +1,263 @@
+"""
+    This module archives the MQTT messages in rotating compressed segments with a time index
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# MQTT archive
+#
+# Replaces the plain exp-<start>_mqtt.txt : the messages are grouped in blocks, each
+# block is compressed on its own (zlib) and appended to the current segment file. The
+# segments rotate on size and age. A sidecar index has one line per block, with its
+# segment, offset, length, time range and devaddrs. A query reads the index and only
+# decompresses the blocks of the device and time range asked.
+#
+# Files (directory/prefix) :
+#   <prefix>-00000.seg, <prefix>-00001.seg, ...  compressed blocks
+#   <prefix>.index                               JSON lines, one per block
+#       {"seg": "<prefix>-00000.seg", "off": 0, "len": 1834, "t0": ..., "t1": ...,
+#        "dev": [...]}
+#   A block holds lines "<timestamp> <message json>".
+#
+# Usage :
+#   python3 mqtt_archive.py ./logs/exp-XXX --devaddr 260B1234 --start 1730000000 --end ...
+#
+# ===
+# Notes
+#   - A block is written when it holds block_records messages or is block_seconds old,
+#     at most one block is lost if the node stops abruptly.
+#   - A segment is a concatenation of zlib streams, a block is read with one seek and
+#     one decompress.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import argparse
+import json
+import os
+import threading
+import time
+import zlib
+
+# #############################################################################
+#
+# Class ArchiveWriter
+#
+
+class ArchiveWriter:
+    """
+    Writer of rotating compressed segments and their index
+    """
+    def __init__(self,base:str,max_segment_bytes:int=4*1024*1024,
+                 max_segment_seconds:float=3600,block_records:int=256,
+                 block_seconds:float=60,level:int=6):
+        """
+        Params:
+            base:str : Directory and prefix of the files
+        """
+        self._base = base
+        self._max_segment_bytes = max_segment_bytes
+        self._max_segment_seconds = max_segment_seconds
+        self._block_records = block_records
+        self._block_seconds = block_seconds
+        self._level = level
+        self._lock = threading.Lock()
+
+        self._lines = []
+        self._devices = set()
+        self._t0 = None
+        self._t1 = None
+        self._block_started = None
+
+        self._segment_index = self._next_segment_index()
+        self._segment = None
+        self._segment_name = None
+        self._segment_size = 0
+        self._segment_started = None
+        self._index = open(f"{base}.index","a",encoding="utf-8")
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    def _next_segment_index(self):
+        """
+        First free segment number, an archive can be reopened.
+        """
+        directory = os.path.dirname(self._base) or "."
+        prefix = os.path.basename(self._base) + "-"
+        numbers = [int(name[len(prefix):-4]) for name in os.listdir(directory)
+                   if name.startswith(prefix) and name.endswith(".seg")
+                   and name[len(prefix):-4].isdigit()]
+        return max(numbers,default=-1) + 1
+
+    def write(self,devaddr:str,payload,timestamp:float=None):
+        """
+        Archive a message.
+        Params:
+            devaddr:str : Device of the message, None if unknown
+            payload:str|bytes : Message as received (JSON)
+            timestamp:float : Reception time (time.time()), default now
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(payload,bytes):
+            payload = payload.decode("utf-8",errors="replace")
+        line = f"{timestamp:.3f} {payload.strip()}\n"
+        with self._lock:
+            if not self._lines:
+                self._t0 = timestamp
+                self._block_started = time.monotonic()
+            self._lines.append(line)
+            self._t1 = timestamp
+            if devaddr is not None:
+                self._devices.add(devaddr)
+            if (len(self._lines) >= self._block_records
+                    or time.monotonic() - self._block_started >= self._block_seconds):
+                self._write_block()
+
+    def _write_block(self):
+        """
+        Compress the pending block and index it. Lock held.
+        """
+        if not self._lines:
+            return
+        if self._segment is None or self._segment_full():
+            self._rotate()
+
+        raw = "".join(self._lines).encode("utf-8")
+        block = zlib.compress(raw,self._level)
+        offset = self._segment_size
+        self._segment.write(block)
+        self._segment.flush()
+        self._segment_size += len(block)
+        self.raw_bytes += len(raw)
+        self.compressed_bytes += len(block)
+
+        self._index.write(json.dumps({"seg":self._segment_name,"off":offset,"len":len(block),
+                                      "t0":self._t0,"t1":self._t1,
+                                      "dev":sorted(self._devices)}) + "\n")
+        self._index.flush()
+        self._lines = []
+        self._devices = set()
+
+    def _segment_full(self):
+        return (self._segment_size >= self._max_segment_bytes
+                or time.monotonic() - self._segment_started >= self._max_segment_seconds)
+
+    def _rotate(self):
+        """
+        Close the current segment and open the next one. Lock held.
+        """
+        if self._segment is not None:
+            self._segment.close()
+        self._segment_name = f"{os.path.basename(self._base)}-{self._segment_index:05d}.seg"
+        directory = os.path.dirname(self._base)
+        self._segment = open(os.path.join(directory,self._segment_name),"ab")
+        self._segment_index += 1
+        self._segment_size = 0
+        self._segment_started = time.monotonic()
+
+    def flush(self):
+        """
+        Write the pending block.
+        """
+        with self._lock:
+            self._write_block()
+
+    def close(self):
+        """
+        Write the pending block and close the files.
+        """
+        with self._lock:
+            self._write_block()
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+            self._index.close()
+
+    def metrics(self):
+        """
+        Returns:
+            metrics:dict : raw and compressed bytes written, compression ratio
+        """
+        with self._lock:
+            ratio = self.raw_bytes/self.compressed_bytes if self.compressed_bytes else 0.0
+            return {"raw_bytes":self.raw_bytes,"compressed_bytes":self.compressed_bytes,
+                    "ratio":round(ratio,2)}
+
+# #############################################################################
+#
+# Class ArchiveReader
+#
+
+class ArchiveReader:
+    """
+    Time and device queries on an archive
+    """
+    def __init__(self,base:str):
+        self._base = base
+        self._directory = os.path.dirname(base)
+        self.blocks = []
+        with open(f"{base}.index",encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    self.blocks.append(json.loads(line))
+
+    def _read_block(self,block:dict):
+        with open(os.path.join(self._directory,block["seg"]),"rb") as file:
+            file.seek(block["off"])
+            return zlib.decompress(file.read(block["len"])).decode("utf-8")
+
+    def query(self,devaddr:str=None,start:float=None,end:float=None):
+        """
+        Get the messages of a device in a time range.
+        Params:
+            devaddr:str : Device, None for every device
+            start:float, end:float : Range [start, end], None for no bound
+        Yields:
+            (timestamp,message) : message is the decoded JSON
+        """
+        for block in self.blocks:
+            if start is not None and block["t1"] < start:
+                continue
+            if end is not None and block["t0"] > end:
+                continue
+            if devaddr is not None and devaddr not in block["dev"]:
+                continue
+            for line in self._read_block(block).splitlines():
+                (timestamp,_,payload) = line.partition(" ")
+                timestamp = float(timestamp)
+                if (start is not None and timestamp < start) or \
+                        (end is not None and timestamp > end):
+                    continue
+                try:
+                    message = json.loads(payload)
+                except ValueError:
+                    continue
+                if devaddr is not None and \
+                        (not isinstance(message,dict) or message.get("devaddr") != devaddr):
+                    continue
+                yield timestamp,message
+
+# #############################################################################
+#
+# Main
+#
+
+def main():
+    #Command line entry point, print the messages as JSON lines
+    parser = argparse.ArgumentParser(description="Query an MQTT archive")
+    parser.add_argument("base",help="Directory and prefix of the archive")
+    parser.add_argument("--devaddr",default=None)
+    parser.add_argument("--start",type=float,default=None,help="Unix time")
+    parser.add_argument("--end",type=float,default=None,help="Unix time")
+    args = parser.parse_args()
+
+    for (_,message) in ArchiveReader(args.base).query(args.devaddr,args.start,args.end):
+        print(json.dumps(message))
+
+if __name__ == "__main__":
+    main()
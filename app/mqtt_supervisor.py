@@ -0,0 +1,164 @@
+"""
+    This module supervises the MQTT connection to the broker
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# MQTT supervisor
+#
+# Wraps the paho client : asynchronous connection, automatic reconnection with an
+# exponential backoff, persistent session (clean_session off, QoS 1 subscription) so the
+# messages queued by the broker while we were away are delivered after the reconnection.
+#
+# ===
+# Notes
+#   - The paho network thread (loop_start) does the reconnections, reconnect_delay_set
+#     gives the backoff (min_delay doubled up to max_delay).
+#   - A persistent session needs a stable client id, one per node.
+#   - The callbacks use the paho callback API version 1, available in paho 1.x and 2.x.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import logging
+import threading
+import time
+
+import paho.mqtt.client as paho
+
+# #############################################################################
+#
+# Class MqttSupervisor
+#
+
+class MqttSupervisor:
+    """
+    Keep a paho client connected and subscribed, and measure the connection gaps
+    """
+    def __init__(self,server:str,port:int,topic:str,client_id:str,username:str=None,
+                 password:str=None,qos:int=1,min_delay:int=1,max_delay:int=60,
+                 on_message=None,callbacks:dict=None):
+        """
+        Params:
+            topic:str : Topic of on_message, None to only publish
+            callbacks:dict : Other topics to subscribe, topic -> on_message callback
+        """
+        self._server = server
+        self._port = port
+        self._topic = topic
+        self._qos = qos
+        self._callbacks = dict(callbacks or {})
+
+        if hasattr(paho,"CallbackAPIVersion"):
+            self.client = paho.Client(paho.CallbackAPIVersion.VERSION1,client_id=client_id,
+                                      clean_session=False)
+        else:
+            self.client = paho.Client(client_id=client_id,clean_session=False)
+        if username:
+            self.client.username_pw_set(username=username,password=password)
+        self.client.reconnect_delay_set(min_delay=min_delay,max_delay=max_delay)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        if on_message is not None:
+            self.client.on_message = on_message
+        for (extra_topic,callback) in self._callbacks.items():
+            self.client.message_callback_add(extra_topic,callback)
+
+        self._connected = threading.Event()
+        self._lock = threading.Lock()
+        self._gap_start = None
+        self.connections = 0
+        self.disconnections = 0
+        self.total_gap = 0.0
+        self.longest_gap = 0.0
+        self.last_gap = 0.0
+
+    def start(self):
+        """
+        Start the connection in the background, never blocks.
+        """
+        with self._lock:
+            self._gap_start = time.monotonic()
+        self.client.connect_async(self._server,port=self._port)
+        self.client.loop_start()
+
+    def stop(self):
+        """
+        Disconnect and stop the network thread.
+        """
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def wait_connected(self,timeout:float=None):
+        """
+        Wait for the connection.
+        Params:
+            timeout:float : Max time to wait in seconds, None to wait forever
+        Returns:
+            bool : True if connected
+        """
+        return self._connected.wait(timeout)
+
+    def is_connected(self):
+        """
+        Returns:
+            bool : True if connected
+        """
+        return self._connected.is_set()
+
+    def metrics(self):
+        """
+        Get the connection metrics.
+        Returns:
+            metrics:dict : connected, connections, disconnections, total/longest/last gap
+                and current gap in seconds
+        """
+        with self._lock:
+            current_gap = 0.0
+            if self._gap_start is not None:
+                current_gap = time.monotonic() - self._gap_start
+            return {"connected":self._connected.is_set(),"connections":self.connections,
+                    "disconnections":self.disconnections,
+                    "total_gap":round(self.total_gap + current_gap,3),
+                    "longest_gap":round(max(self.longest_gap,current_gap),3),
+                    "last_gap":round(self.last_gap,3),"current_gap":round(current_gap,3)}
+
+    def _on_connect(self,client:paho.Client,userdata:any,flags:dict,rc:int):
+        """
+        paho on_connect callback, (re)subscribe and close the gap
+        """
+        if rc != 0:
+            logging.error("MQTT connection refused, code %s",rc)
+            return
+
+        with self._lock:
+            self.connections += 1
+            if self._gap_start is not None:
+                self.last_gap = time.monotonic() - self._gap_start
+                self.total_gap += self.last_gap
+                self.longest_gap = max(self.longest_gap,self.last_gap)
+                self._gap_start = None
+
+        if self._topic:
+            client.subscribe(self._topic,qos=self._qos)
+        for extra_topic in self._callbacks:
+            client.subscribe(extra_topic,qos=self._qos)
+        self._connected.set()
+        logging.info("Connected to MQTT Broker (session present : %s, gap %.1f s)",
+                     flags.get("session present"),self.last_gap)
+
+    def _on_disconnect(self,client:paho.Client,userdata:any,rc:int):
+        """
+        paho on_disconnect callback, open a gap, paho reconnects by itself
+        """
+        self._connected.clear()
+        with self._lock:
+            self.disconnections += 1
+            if self._gap_start is None:
+                self._gap_start = time.monotonic()
+        if rc != 0:
+            logging.warning("Lost the MQTT connection (code %s), reconnecting",rc)
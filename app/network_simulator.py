@@ -0,0 +1,368 @@
+"""
+    This module simulates a LoRaWAN network of many end devices running the q_model policy
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Network simulator
+#
+# N end devices share G gateways. Each device sends periodic uplinks, the network server
+# answers with the LSNR of the best gateway and the device picks its next (SF,TP) with
+# the Q-Table, as main() does with the MQTT feedback.
+#
+# Usage :
+#   python3 network_simulator.py --devices 10000 --gateways 3 --duration 86400
+#   python3 network_simulator.py --devices 100000 --seeds 1 2 3 4 --workers 4
+#
+# ===
+# Notes
+#   - Path loss is log-distance with a static log-normal shadowing per link and an
+#     optional per frame fading.
+#   - A frame is demodulated by a gateway if its SNR is above the SF threshold (README
+#     Table I). Frames using the same SF on the same channel collide when they overlap,
+#     the strongest one survives if it is CAPTURE_THRESHOLD dB above every interferer.
+#   - The time is processed by windows shorter than the minimum uplink gap, so each
+#     device sends at most one frame per window and the device state stays in arrays
+#     indexed by device. Frames of the previous window still on air are kept : they
+#     interfere with the new frames, and their own outcome is recomputed with the new
+#     frames as interferers (a frame counted delivered becomes a collision).
+#   - The strongest interferer of each frame is a range maximum over the frames sorted
+#     by (channel,SF,start), so a window costs O(n log n) whatever the load.
+#   - The feedback is applied at the end of the window, the policy uses it for the next
+#     uplink like main() does. A carried frame found collided in the next window keeps
+#     the decision already taken from it.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import argparse
+import json
+import logging
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import lora_phy
+import qtable
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Thermal noise on 125 kHz with a 6 dB noise figure [dBm]
+NOISE_FLOOR = -174 + 10*math.log10(lora_phy.BANDWIDTH) + 6
+
+#Log-distance path loss, suburban fit at 868 MHz (reference distance in meters)
+PATH_LOSS_D0 = 1000.0
+PATH_LOSS_L0 = 128.95
+PATH_LOSS_EXPONENT = 2.32
+SHADOWING_STD = 3.57
+
+#Power difference needed for the strongest frame to survive a collision [dB]
+CAPTURE_THRESHOLD = 6.0
+
+#Default EU868 channels and duty cycle
+NB_CHANNELS = 3
+DUTY_CYCLE = 0.01
+
+#Q-Table used by default
+Q_TABLE_PATH = './config/Q_model-LORA-rob.pkl'
+
+# #############################################################################
+#
+# Topology
+#
+
+def place_nodes(nb_devices:int,nb_gateways:int,radius:float,rng:np.random.Generator):
+    """
+    Place the devices uniformly in a disk and the gateways on a centered ring.
+    Params:
+        nb_devices:int : Number of end devices
+        nb_gateways:int : Number of gateways
+        radius:float : Radius of the area in meters
+        rng:np.random.Generator : Random generator
+    Returns:
+        distances:np.ndarray : Device to gateway distances of shape (nb_devices,nb_gateways)
+    """
+    distance = radius*np.sqrt(rng.random(nb_devices))
+    angle = 2*np.pi*rng.random(nb_devices)
+    devices = np.stack((distance*np.cos(angle),distance*np.sin(angle)),axis=1)
+
+    if nb_gateways == 1:
+        gateways = np.zeros((1,2))
+    else:
+        gw_angle = 2*np.pi*np.arange(nb_gateways)/nb_gateways
+        gateways = radius/2*np.stack((np.cos(gw_angle),np.sin(gw_angle)),axis=1)
+
+    distances = np.linalg.norm(devices[:,None,:] - gateways[None,:,:],axis=2)
+    return np.maximum(distances,1.0)
+
+def path_loss(distances:np.ndarray,rng:np.random.Generator,shadowing_std:float=SHADOWING_STD):
+    """
+    Log-distance path loss with log-normal shadowing.
+    Params:
+        distances:np.ndarray : Distances in meters
+        rng:np.random.Generator : Random generator
+        shadowing_std:float : Standard deviation of the shadowing in dB
+    Returns:
+        loss:np.ndarray : Path loss in dB, same shape as distances
+    """
+    loss = PATH_LOSS_L0 + 10*PATH_LOSS_EXPONENT*np.log10(distances/PATH_LOSS_D0)
+    return loss + rng.normal(0,shadowing_std,distances.shape)
+
+# #############################################################################
+#
+# Collisions
+#
+
+def range_max(values:np.ndarray,low:np.ndarray,high:np.ndarray):
+    """
+    Maximum of values over the ranges [low,high) using a sparse table, O(n log n) to
+    build and O(1) per range.
+    Params:
+        values:np.ndarray : Array of shape (n,nb_gateways)
+        low:np.ndarray : First index of each range
+        high:np.ndarray : Index after the last one of each range
+    Returns:
+        maximum:np.ndarray : Array of shape (len(low),nb_gateways), -inf for empty ranges
+    """
+    maximum = np.full((len(low),values.shape[1]),-np.inf)
+    length = high - low
+    level = np.zeros(len(low),dtype=int)
+    non_empty = length > 0
+    level[non_empty] = np.floor(np.log2(length[non_empty])).astype(int)
+
+    table = values
+    for k in range(int(level.max(initial=0)) + 1):
+        if k > 0:
+            half = 1 << (k - 1)
+            table = np.maximum(table[:-half],table[half:])
+        query = non_empty & (level == k)
+        if query.any():
+            maximum[query] = np.maximum(table[low[query]],table[high[query] - (1 << k)])
+
+    return maximum
+
+def strongest_interferer(start:np.ndarray,end:np.ndarray,group:np.ndarray,rssi:np.ndarray):
+    """
+    Compute, for each frame and gateway, the power of the strongest overlapping frame
+    of the same group (same channel and SF).
+    Params:
+        start:np.ndarray : Start time of the frames
+        end:np.ndarray : End time of the frames
+        group:np.ndarray : Channel and SF key of the frames
+        rssi:np.ndarray : Received power of shape (nb_frames,nb_gateways)
+    Returns:
+        interference:np.ndarray : Same shape as rssi, -inf when there is no overlap
+    """
+    #Frames sorted by group then start time, the groups are spaced by more than the
+    #simulated time so one key orders both
+    spacing = 2*(end.max(initial=0) - start.min(initial=0)) + 1
+    key = group*spacing + (start - start.min(initial=0))
+    order = np.argsort(key)
+    sorted_key = key[order]
+    duration = (end - start)[order]
+    sorted_rssi = rssi[order]
+
+    #Frames of a group have the same duration, the overlapping ones are the neighbours
+    #starting less than one duration before or after
+    position = np.arange(len(order))
+    low = np.searchsorted(sorted_key,sorted_key - duration,side='right')
+    high = np.searchsorted(sorted_key,sorted_key + duration,side='left')
+
+    interference = np.empty(rssi.shape)
+    interference[order] = np.maximum(range_max(sorted_rssi,low,position),
+                                     range_max(sorted_rssi,position + 1,high))
+    return interference
+
+# #############################################################################
+#
+# Simulation
+#
+
+def simulate(nb_devices:int=1000,nb_gateways:int=3,radius:float=5000.0,
+             duration:float=86400.0,period:float=600.0,jitter:float=0.1,
+             payload_len:int=26,fading_std:float=2.0,duty_cycle:float=DUTY_CYCLE,
+             initial_dr:int=0,initial_tp:int=1,q_table_path:str=Q_TABLE_PATH,seed:int=None):
+    """
+    Run the simulation.
+    Params:
+        nb_devices:int : Number of end devices
+        nb_gateways:int : Number of gateways
+        radius:float : Radius of the area in meters
+        duration:float : Simulated time in seconds
+        period:float : Mean time between two uplinks of a device in seconds
+        jitter:float : Relative jitter of the period, from 0 to 1 (excluded)
+        payload_len:int : Application payload length in bytes
+        fading_std:float : Standard deviation of the per frame fading in dB
+        duty_cycle:float : Duty cycle per device, from 0 to 1
+        initial_dr:int : Datarate at the start
+        initial_tp:int : PWRIDX at the start
+        q_table_path:str : Q-Table of the devices
+        seed:int : Seed of the random generator
+    Returns:
+        results:Dict[str,float|list] : Network wide counters
+    """
+    rng = np.random.default_rng(seed)
+    action_table = qtable.best_actions(qtable.load_q_table(q_table_path))
+    (required_snr,airtime,power_dbm) = (np.array(lookup)
+                                        for lookup in lora_phy.datarate_lookups(payload_len))
+    power_mw = lora_phy.dbm_to_mw(power_dbm)
+
+    loss = path_loss(place_nodes(nb_devices,nb_gateways,radius,rng),rng)
+
+    #Device state
+    datarate = np.full(nb_devices,initial_dr,dtype=int)
+    pwridx = np.full(nb_devices,initial_tp,dtype=int)
+    next_tx = period*rng.random(nb_devices)
+    counters = {name:np.zeros(nb_devices) for name in
+                ("uplinks","delivered","outages","collisions","reconfigurations",
+                 "invalid_decisions","energy_mj","airtime_s")}
+
+    #Frames still on air at the end of the previous window
+    carried = {"start":np.empty(0),"end":np.empty(0),"group":np.empty(0,dtype=int),
+               "rssi":np.empty((0,nb_gateways)),"device":np.empty(0,dtype=int),
+               "demodulated":np.empty((0,nb_gateways),dtype=bool),
+               "delivered":np.empty(0,dtype=bool),
+               "interference":np.empty((0,nb_gateways))}
+
+    window = period*(1 - jitter)
+    window_start = 0.0
+    while window_start < duration:
+        window_end = min(window_start + window,duration)
+        device = np.flatnonzero(next_tx < window_end)
+
+        frame_dr = datarate[device]
+        frame_tp = pwridx[device]
+        start = next_tx[device]
+        end = start + airtime[frame_dr]
+        group = rng.integers(0,NB_CHANNELS,len(device))*16 + frame_dr
+        rssi = (power_dbm[frame_tp][:,None] - loss[device]
+                + rng.normal(0,fading_std,(len(device),nb_gateways)))
+
+        interference = strongest_interferer(
+            np.concatenate((carried["start"],start)),np.concatenate((carried["end"],end)),
+            np.concatenate((carried["group"],group)),np.concatenate((carried["rssi"],rssi)))
+        #Outcome of the carried frames with the frames of this window as interferers
+        carried_interference = np.maximum(carried["interference"],
+                                          interference[:len(carried["start"])])
+        lost = carried["delivered"] & ~(carried["demodulated"] & (
+            carried["rssi"] - carried_interference >= CAPTURE_THRESHOLD)).any(axis=1)
+        counters["delivered"][carried["device"]] -= lost
+        counters["collisions"][carried["device"]] += lost
+        interference = interference[len(carried["start"]):]
+
+        snr = rssi - NOISE_FLOOR
+        demodulated = snr >= required_snr[frame_dr][:,None]
+        received = demodulated & (rssi - interference >= CAPTURE_THRESHOLD)
+        delivered = received.any(axis=1)
+        best_snr = np.where(received,snr,-np.inf).max(axis=1)
+
+        counters["uplinks"][device] += 1
+        counters["delivered"][device] += delivered
+        counters["outages"][device] += ~demodulated.any(axis=1)
+        counters["collisions"][device] += demodulated.any(axis=1) & ~delivered
+        counters["airtime_s"][device] += airtime[frame_dr]
+        counters["energy_mj"][device] += airtime[frame_dr]*power_mw[frame_tp]
+
+        #Feedback of the best gateway, same decision as q_model
+        (_,new_dr,new_tp) = qtable.lookup(action_table,np.where(delivered,best_snr,0),frame_tp)
+        invalid = delivered & (new_dr < 0)
+        apply = delivered & ~invalid
+        changed = apply & ((new_dr != frame_dr) | (new_tp != frame_tp))
+        counters["invalid_decisions"][device] += invalid
+        counters["reconfigurations"][device] += changed
+        datarate[device] = np.where(apply,new_dr,frame_dr)
+        pwridx[device] = np.where(apply,new_tp,frame_tp)
+
+        #Next uplink, respecting the duty cycle
+        gap = np.maximum(period*(1 + jitter*rng.uniform(-1,1,len(device))),
+                         airtime[frame_dr]/duty_cycle)
+        next_tx[device] = start + gap
+
+        on_air = end > window_end
+        carried = {"start":start[on_air],"end":end[on_air],"group":group[on_air],
+                   "rssi":rssi[on_air],"device":device[on_air],
+                   "demodulated":demodulated[on_air],"delivered":delivered[on_air],
+                   "interference":interference[on_air]}
+        window_start = window_end
+
+    results = {name:float(values.sum()) for name,values in counters.items()}
+    results["delivery_ratio"] = results["delivered"]/max(results["uplinks"],1)
+    results["final_datarate_distribution"] = np.bincount(datarate,minlength=6).tolist()
+    results["final_pwridx_distribution"] = np.bincount(pwridx,minlength=6)[1:].tolist()
+    results["seed"] = seed
+    return results
+
+def _simulate_task(options:dict):
+    """
+    Process pool entry point.
+    Params:
+        options:dict : Keyword arguments of simulate
+    Returns:
+        results:dict : Output of simulate
+    """
+    return simulate(**options)
+
+def simulate_seeds(seeds:list,nb_workers:int=None,**options):
+    """
+    Run the same simulation with several seeds across processes.
+    Params:
+        seeds:list : Seeds to run
+        nb_workers:int : Number of processes
+        options : Forwarded to simulate
+    Returns:
+        results:list : Output of simulate for each seed
+    """
+    tasks = [dict(options,seed=seed) for seed in seeds]
+    if nb_workers == 1 or len(tasks) == 1:
+        return [_simulate_task(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=nb_workers) as executor:
+        return list(executor.map(_simulate_task,tasks))
+
+# #############################################################################
+#
+# Main
+#
+
+def main():
+    #Command line entry point
+    parser = argparse.ArgumentParser(description="Simulate a LoRaWAN network using q_model")
+    parser.add_argument("--devices",type=int,default=1000)
+    parser.add_argument("--gateways",type=int,default=3)
+    parser.add_argument("--radius",type=float,default=5000.0,help="Area radius in meters")
+    parser.add_argument("--duration",type=float,default=86400.0,help="Simulated seconds")
+    parser.add_argument("--period",type=float,default=600.0,help="Uplink period in seconds")
+    parser.add_argument("--payload-len",type=int,default=26)
+    parser.add_argument("--table",default=Q_TABLE_PATH,help="Q-Table pickle")
+    parser.add_argument("--seeds",type=int,nargs="+",default=[0])
+    parser.add_argument("--workers",type=int,default=None)
+    parser.add_argument("--output",default=None,help="Write the results as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)-8s - %(message)s')
+
+    results = simulate_seeds(args.seeds,args.workers,nb_devices=args.devices,
+                             nb_gateways=args.gateways,radius=args.radius,
+                             duration=args.duration,period=args.period,
+                             payload_len=args.payload_len,q_table_path=args.table)
+    for result in results:
+        logging.info("seed %s : delivery %.3f, outages %d, collisions %d, reconfigurations %d, \
+energy %.1f mJ, final DR %s",result["seed"],result["delivery_ratio"],result["outages"],
+                     result["collisions"],result["reconfigurations"],result["energy_mj"],
+                     result["final_datarate_distribution"])
+
+    if args.output:
+        with open(args.output,"w",encoding="utf-8") as file:
+            json.dump(results,file,indent=2)
+
+    return 0
+
+if __name__ == "__main__":
+    main()
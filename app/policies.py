@@ -0,0 +1,209 @@
+"""
+    This module holds the DR/PWRIDX decision policies shared by main() and the replay tools
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Policies
+#
+# A policy gets the SNR feedback of the uplinks and returns the next datarate and PWRIDX.
+# Every method works on arrays (one entry per device/trace), main() uses arrays of one.
+#
+#   qtable:<path>       greedy action of a Q-Table, as q_model
+#   fixed:<dr>:<pwridx> parameters never change (baseline)
+#   adr[:<margin>]      network server ADR : SNR margin over the last 20 frames, each 3 dB
+#                       of margin raises the datarate then lowers the power by one step,
+#                       a negative margin raises the power
+#
+# ===
+# Notes
+#   - The ADR follows the algorithm of the LoRaWAN network servers (Semtech
+#     recommendation, also used by ChirpStack) : margin = max SNR of the history
+#     - required SNR of the datarate - installation margin (10 dB by default).
+#   - As in main(), the qtable policy is given the PWRIDX as its TP state, and its SF13
+#     decisions (datarate -1) are returned as they are, the caller counts them as invalid.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import numpy as np
+
+import lora_phy
+import qtable
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Required SNR indexed by datarate
+REQUIRED_SNR_BY_DR = np.array([lora_phy.REQUIRED_SNR[lora_phy.datarate_to_sf(datarate)]
+                               for datarate in range(6)])
+
+MAX_DATARATE = 5
+#PWRIDX 1 is the maximum power (14 dBm), 5 the minimum (6 dBm)
+MAX_POWER_PWRIDX = 1
+MIN_POWER_PWRIDX = 5
+
+# #############################################################################
+#
+# Class Policy
+#
+
+class Policy:
+    """
+    Interface of the policies
+    """
+    name = "policy"
+
+    def reset(self,nb_devices:int):
+        """
+        Forget the state, for nb_devices devices.
+        Params:
+            nb_devices:int : Number of devices/traces decided together
+        """
+
+    def initial(self,datarate:int,pwridx:int):
+        """
+        Parameters of the first uplink.
+        Params:
+            datarate:int, pwridx:int : Parameters asked by the caller
+        Returns:
+            (datarate,pwridx)
+        """
+        return datarate,pwridx
+
+    def decide(self,snr:np.ndarray,datarate:np.ndarray,pwridx:np.ndarray,
+               received:np.ndarray):
+        """
+        Decide the parameters of the next uplinks.
+        Params:
+            snr:np.ndarray : SNR of the last uplink (any value where not received)
+            datarate:np.ndarray : Datarate in use
+            pwridx:np.ndarray : PWRIDX in use
+            received:np.ndarray : True where a feedback came back
+        Returns:
+            (datarate,pwridx) : np.ndarray, unchanged where no feedback came back
+        """
+        raise NotImplementedError
+
+# #############################################################################
+#
+# Implementations
+#
+
+class QTableGreedy(Policy):
+    """
+    Greedy action of a Q-Table
+    """
+    def __init__(self,path:str=None,action_table:np.ndarray=None):
+        if action_table is None:
+            action_table = qtable.best_actions(qtable.load_q_table(path))
+        self._action_table = action_table
+        self.name = f"qtable:{path}" if path else "qtable"
+
+    def decide(self,snr,datarate,pwridx,received):
+        (_,new_dr,new_tp) = qtable.lookup(self._action_table,np.where(received,snr,0),pwridx)
+        return np.where(received,new_dr,datarate),np.where(received,new_tp,pwridx)
+
+class Fixed(Policy):
+    """
+    Constant parameters
+    """
+    def __init__(self,datarate:int,pwridx:int):
+        self._datarate = datarate
+        self._pwridx = pwridx
+        self.name = f"fixed:{datarate}:{pwridx}"
+
+    def initial(self,datarate,pwridx):
+        return self._datarate,self._pwridx
+
+    def decide(self,snr,datarate,pwridx,received):
+        return (np.full(np.shape(datarate),self._datarate),
+                np.full(np.shape(pwridx),self._pwridx))
+
+class Adr(Policy):
+    """
+    Network server ADR, from the maximum SNR of the last history_size frames
+    """
+    def __init__(self,margin_db:float=10.0,history_size:int=20,step_db:float=3.0):
+        self._margin_db = margin_db
+        self._history_size = history_size
+        self._step_db = step_db
+        self.name = f"adr:{margin_db:g}"
+        self.reset(1)
+
+    def reset(self,nb_devices:int):
+        self._history = np.full((nb_devices,self._history_size),np.nan)
+        self._index = np.zeros(nb_devices,dtype=int)
+        self._count = np.zeros(nb_devices,dtype=int)
+
+    def decide(self,snr,datarate,pwridx,received):
+        rows = np.flatnonzero(received)
+        self._history[rows,self._index[rows]] = np.asarray(snr)[rows]
+        self._index[rows] = (self._index[rows] + 1) % self._history_size
+        self._count[rows] += 1
+
+        new_dr = np.array(datarate,dtype=int)
+        new_tp = np.array(pwridx,dtype=int)
+        ready = received & (self._count >= self._history_size)
+        if not ready.any():
+            return new_dr,new_tp
+
+        max_snr = np.max(self._history,axis=1)
+        margin = max_snr - REQUIRED_SNR_BY_DR[np.clip(new_dr,0,MAX_DATARATE)] - self._margin_db
+        steps = np.where(ready,np.floor(margin/self._step_db),0).astype(int)
+
+        #Positive steps : datarate up first, then power down
+        dr_steps = np.clip(np.minimum(steps,MAX_DATARATE - new_dr),0,None)
+        new_dr += dr_steps
+        steps -= dr_steps
+        tp_down = np.clip(np.minimum(steps,MIN_POWER_PWRIDX - new_tp),0,None)
+        new_tp += tp_down
+        steps -= tp_down
+        #Negative steps : power up
+        tp_up = np.clip(np.minimum(-steps,new_tp - MAX_POWER_PWRIDX),0,None)
+        new_tp -= tp_up
+        return new_dr,new_tp
+
+# #############################################################################
+#
+# Functions
+#
+
+def make_policy(spec:str):
+    """
+    Build a policy from its description.
+    Params:
+        spec:str : qtable:<path>, fixed:<dr>:<pwridx> or adr[:<margin>]
+    Returns:
+        policy:Policy
+    """
+    (kind,_,argument) = spec.partition(":")
+    if kind == "qtable":
+        return QTableGreedy(argument)
+    if kind == "fixed":
+        (datarate,_,pwridx) = argument.partition(":")
+        return Fixed(int(datarate),int(pwridx))
+    if kind == "adr":
+        return Adr(float(argument)) if argument else Adr()
+    raise ValueError(f"Unknown policy {spec}, expected qtable:<path>, fixed:<dr>:<pwridx> "
+                     "or adr[:<margin>]")
+
+def decide_one(policy:Policy,snr:float,datarate:int,pwridx:int):
+    """
+    Decide for a single device, as main() does on each feedback.
+    Params:
+        policy:Policy : Policy reset for one device
+        snr:float : SNR of the feedback
+        datarate:int, pwridx:int : Parameters in use
+    Returns:
+        (datarate,pwridx) : int
+    """
+    (new_dr,new_tp) = policy.decide(np.array([snr]),np.array([datarate]),np.array([pwridx]),
+                                    np.array([True]))
+    return int(new_dr[0]),int(new_tp[0])
@@ -0,0 +1,351 @@
+"""
+    This module replays the q_model decision loop over recorded or synthetic SNR traces
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Policy evaluator
+#
+# Replays a policy (Q-Table, fixed parameters, ADR, see policies) over LSNR traces. Each
+# step of a trace is an uplink: the SNR is corrected by the TP chosen by the policy, the
+# frame is lost if the SNR is below the threshold of the SF in use (README Table I),
+# otherwise the feedback reaches the policy which picks the next (SF,TP) like main() does.
+#
+# Usage :
+#   python3 policy_evaluator.py --table ./config/Q_model-LORA-rob.pkl \
+#       --mqtt-log ./logs/exp-XXX_mqtt.txt --devaddr 260B1234
+#   python3 policy_evaluator.py --table a.pkl --table b.pkl --synthetic 5000 --length 8760
+#   python3 policy_evaluator.py --table a.pkl --policy adr --policy fixed:0:1 --synthetic 5000
+#
+# ===
+# Notes
+#   - The state arrays hold one entry per trace, the time loop is the only Python loop.
+#   - Traces are split in chunks replayed by a process pool, one task per (table,chunk).
+#   - Energy is the radiated energy (time on air x TX power), a proxy of the module
+#     consumption good enough to compare tables.
+#   - As in main(), q_model receives the PWRIDX as its TP state.
+#   - The table was trained with SF13 (datarate -1) which the RN2483 refuses, such a
+#     decision is counted as invalid and the previous parameters are kept.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import argparse
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import lora_phy
+import policies
+from mqtt_archive import ArchiveReader
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Payload of the experiment uplinks ({"DR":0,"TP":1,"N":0})
+DEFAULT_PAYLOAD_LEN = 26
+
+#Number of traces replayed by one task of the process pool
+DEFAULT_CHUNK_SIZE = 1024
+
+#Counters returned for each trace
+RESULT_FIELDS = ("uplinks","delivered","outages","reconfigurations","invalid_decisions",
+                 "energy_mj","airtime_s")
+
+# #############################################################################
+#
+# Traces
+#
+
+def load_mqtt_traces(filenames:list,devaddr:str=None):
+    """
+    Extract the LSNR traces from the MQTT logs written by mqtt_on_message.
+    Params:
+        filenames:list : List of exp-*_mqtt.txt files, read in order
+        devaddr:str : If set, only keep this device
+    Returns:
+        traces:Dict[str,np.ndarray] : LSNR of the best gateway for each devaddr
+    """
+    traces = {}
+    for filename in filenames:
+        with open(filename,"r",encoding="utf-8") as file:
+            for line in file:
+                try:
+                    json_data = json.loads(line)
+                    lsnr = float(json_data["best_gw"]["lsnr"])
+                    message_devaddr = json_data["devaddr"]
+                except (ValueError,KeyError,TypeError):
+                    continue
+                if devaddr is not None and message_devaddr != devaddr:
+                    continue
+                traces.setdefault(message_devaddr,[]).append(lsnr)
+
+    return {key:np.array(value,dtype=float) for key,value in traces.items()}
+
+def load_archive_traces(bases:list,devaddr:str=None):
+    """
+    Extract the LSNR traces from MQTT archives (see mqtt_archive).
+    Params:
+        bases:list : Directory and prefix of each archive, read in order
+        devaddr:str : If set, only keep this device (only its blocks are read)
+    Returns:
+        traces:Dict[str,np.ndarray] : LSNR of the best gateway for each devaddr
+    """
+    traces = {}
+    for base in bases:
+        for (_,json_data) in ArchiveReader(base).query(devaddr):
+            try:
+                lsnr = float(json_data["best_gw"]["lsnr"])
+                message_devaddr = json_data["devaddr"]
+            except (ValueError,KeyError,TypeError):
+                continue
+            traces.setdefault(message_devaddr,[]).append(lsnr)
+
+    return {key:np.array(value,dtype=float) for key,value in traces.items()}
+
+def synthetic_traces(nb_traces:int,length:int,mean_snr:float=-5.0,std_snr:float=4.0,
+                     correlation:float=0.9,seed:int=None):
+    """
+    Generate synthetic LSNR traces, a first order autoregressive process around a mean
+    drawn for each trace.
+    Params:
+        nb_traces:int : Number of traces
+        length:int : Number of uplinks per trace
+        mean_snr:float : Mean of the per trace SNR
+        std_snr:float : Standard deviation of the SNR around the trace mean
+        correlation:float : Correlation between two consecutive uplinks, from 0 to 1
+        seed:int : Seed of the generator
+    Returns:
+        traces:np.ndarray : Array of shape (nb_traces,length)
+    """
+    rng = np.random.default_rng(seed)
+    trace_mean = rng.normal(mean_snr,std_snr,nb_traces)
+    innovation_std = std_snr*np.sqrt(1 - correlation**2)
+
+    traces = np.empty((nb_traces,length))
+    deviation = rng.normal(0,std_snr,nb_traces)
+    for step in range(length):
+        traces[:,step] = trace_mean + deviation
+        deviation = correlation*deviation + rng.normal(0,innovation_std,nb_traces)
+
+    return np.round(traces*4)/4
+
+def pad_traces(traces:list):
+    """
+    Stack traces of different lengths, the missing uplinks are NaN.
+    Params:
+        traces:list : List of 1D arrays
+    Returns:
+        padded:np.ndarray : Array of shape (len(traces),max_length)
+    """
+    length = max((len(trace) for trace in traces),default=0)
+    padded = np.full((len(traces),length),np.nan)
+    for (index,trace) in enumerate(traces):
+        padded[index,:len(trace)] = trace
+    return padded
+
+# #############################################################################
+#
+# Replay
+#
+
+def replay(policy,traces:np.ndarray,reference_tp:int=1,initial_dr:int=0,
+           initial_tp:int=1,payload_len:int=DEFAULT_PAYLOAD_LEN):
+    """
+    Replay the decision loop over a batch of traces.
+    Params:
+        policy:policies.Policy|np.ndarray : Policy, or greedy actions (qtable.best_actions)
+        traces:np.ndarray : LSNR of shape (nb_traces,length), NaN when there is no uplink
+        reference_tp:int : PWRIDX used when the traces were recorded
+        initial_dr:int : Datarate at the start, as selected_dr in main()
+        initial_tp:int : PWRIDX at the start, as selected_tp in main()
+        payload_len:int : Application payload length, used for the time on air
+    Returns:
+        results:Dict[str,np.ndarray] : One array of length nb_traces per RESULT_FIELDS
+    """
+    traces = np.atleast_2d(traces)
+    nb_traces = traces.shape[0]
+
+    #Lookups indexed by datarate and PWRIDX
+    (required_snr,airtime,power_dbm) = (np.array(lookup)
+                                        for lookup in lora_phy.datarate_lookups(payload_len))
+    power_mw = lora_phy.dbm_to_mw(power_dbm)
+
+    if isinstance(policy,np.ndarray):
+        policy = policies.QTableGreedy(action_table=policy)
+    policy.reset(nb_traces)
+    (initial_dr,initial_tp) = policy.initial(initial_dr,initial_tp)
+
+    #State
+    datarate = np.full(nb_traces,initial_dr,dtype=int)
+    pwridx = np.full(nb_traces,initial_tp,dtype=int)
+    results = {field:np.zeros(nb_traces) for field in RESULT_FIELDS}
+
+    for step in range(traces.shape[1]):
+        recorded_snr = traces[:,step]
+        sent = ~np.isnan(recorded_snr)
+        snr = recorded_snr + power_dbm[pwridx] - power_dbm[reference_tp]
+        received = sent & (snr >= required_snr[datarate])
+
+        results["uplinks"] += sent
+        results["delivered"] += received
+        results["outages"] += sent & ~received
+        results["airtime_s"] += sent*airtime[datarate]
+        results["energy_mj"] += sent*airtime[datarate]*power_mw[pwridx]
+
+        #Feedback only comes back for the received uplinks
+        (new_dr,new_tp) = policy.decide(snr,datarate,pwridx,received)
+        invalid = received & (new_dr < 0)
+        apply = received & ~invalid
+        changed = apply & ((new_dr != datarate) | (new_tp != pwridx))
+
+        results["invalid_decisions"] += invalid
+        results["reconfigurations"] += changed
+        datarate = np.where(apply,new_dr,datarate)
+        pwridx = np.where(apply,new_tp,pwridx)
+
+    return results
+
+def policy_spec(name:str):
+    """
+    Get the policy description of a candidate, a bare path is a Q-Table.
+    Params:
+        name:str : Policy description (see policies.make_policy) or Q-Table path
+    Returns:
+        spec:str
+    """
+    if name.split(":")[0] in ("qtable","fixed","adr"):
+        return name
+    return f"qtable:{name}"
+
+def _replay_task(task:tuple):
+    """
+    Process pool entry point, replay one chunk of traces with one policy.
+    Params:
+        task:tuple : (policy_name,traces,options)
+    Returns:
+        (policy_name,results)
+    """
+    (policy_name,traces,options) = task
+    return policy_name, replay(policies.make_policy(policy_spec(policy_name)),traces,**options)
+
+def evaluate(policy_names:list,traces:np.ndarray,nb_workers:int=None,
+             chunk_size:int=DEFAULT_CHUNK_SIZE,**options):
+    """
+    Replay several policies over the same traces using a process pool.
+    Params:
+        policy_names:list : Q-Table paths or policy descriptions (see policies.make_policy)
+        traces:np.ndarray : LSNR of shape (nb_traces,length)
+        nb_workers:int : Number of processes, 1 to run in this process
+        chunk_size:int : Number of traces per task
+        options : Forwarded to replay
+    Returns:
+        results:Dict[str,Dict[str,np.ndarray]] : Per trace results for each policy
+    """
+    traces = np.atleast_2d(traces)
+    tasks = [(name,traces[start:start+chunk_size],options)
+             for name in policy_names
+             for start in range(0,traces.shape[0],chunk_size)]
+
+    if nb_workers == 1:
+        outputs = map(_replay_task,tasks)
+    else:
+        executor = ProcessPoolExecutor(max_workers=nb_workers)
+        outputs = executor.map(_replay_task,tasks)
+
+    results = {name:{field:[] for field in RESULT_FIELDS} for name in policy_names}
+    for (name,chunk_results) in outputs:
+        for field in RESULT_FIELDS:
+            results[name][field].append(chunk_results[field])
+
+    if nb_workers != 1:
+        executor.shutdown()
+
+    return {name:{field:np.concatenate(values) for field,values in fields.items()}
+            for name,fields in results.items()}
+
+def summarize(results:dict):
+    """
+    Aggregate the per trace results of one table.
+    Params:
+        results:Dict[str,np.ndarray] : Output of replay for one table
+    Returns:
+        summary:Dict[str,float]
+    """
+    summary = {field:float(np.sum(values)) for field,values in results.items()}
+    uplinks = max(summary["uplinks"],1)
+    summary["delivery_ratio"] = summary["delivered"]/uplinks
+    summary["energy_mj_per_uplink"] = summary["energy_mj"]/uplinks
+    return summary
+
+# #############################################################################
+#
+# Main
+#
+
+def main():
+    #Command line entry point
+    parser = argparse.ArgumentParser(description="Replay policies over SNR traces")
+    parser.add_argument("--table",action="append",default=[],help="Q-Table pickle")
+    parser.add_argument("--policy",action="append",default=[],
+                        help="qtable:<path>, fixed:<dr>:<pwridx> or adr[:<margin>]")
+    parser.add_argument("--mqtt-log",action="append",default=[],help="exp-*_mqtt.txt file")
+    parser.add_argument("--archive",action="append",default=[],
+                        help="MQTT archive, directory and prefix (see mqtt_archive)")
+    parser.add_argument("--devaddr",default=None,help="Only replay this device")
+    parser.add_argument("--synthetic",type=int,default=0,help="Number of synthetic traces")
+    parser.add_argument("--length",type=int,default=1000,help="Length of synthetic traces")
+    parser.add_argument("--seed",type=int,default=None)
+    parser.add_argument("--reference-tp",type=int,default=1,
+                        help="PWRIDX used when the traces were recorded")
+    parser.add_argument("--payload-len",type=int,default=DEFAULT_PAYLOAD_LEN)
+    parser.add_argument("--workers",type=int,default=None)
+    parser.add_argument("--chunk-size",type=int,default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--output",default=None,help="Write the summaries as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)-8s - %(message)s')
+
+    traces = []
+    if args.mqtt_log:
+        traces.extend(load_mqtt_traces(args.mqtt_log,args.devaddr).values())
+    if args.archive:
+        traces.extend(load_archive_traces(args.archive,args.devaddr).values())
+    if args.synthetic:
+        traces.extend(synthetic_traces(args.synthetic,args.length,seed=args.seed))
+    if not traces:
+        parser.error("No trace, use --mqtt-log, --archive and/or --synthetic")
+    candidates = args.table + args.policy
+    if not candidates:
+        parser.error("No policy, use --table and/or --policy")
+    traces = pad_traces(traces)
+    logging.info("Replaying %s traces of up to %s uplinks",traces.shape[0],traces.shape[1])
+
+    results = evaluate(candidates,traces,nb_workers=args.workers,chunk_size=args.chunk_size,
+                       reference_tp=args.reference_tp,payload_len=args.payload_len)
+
+    summaries = {name:summarize(policy_results) for name,policy_results in results.items()}
+    width = max(len(name) for name in summaries)
+    logging.info("%s  delivery  outages  reconfigurations  energy [mJ]  airtime [s]",
+                 "policy".ljust(width))
+    for (name,summary) in summaries.items():
+        logging.info("%s  %8.3f  %7d  %16d  %11.1f  %11.1f",name.ljust(width),
+                     summary["delivery_ratio"],summary["outages"],summary["reconfigurations"],
+                     summary["energy_mj"],summary["airtime_s"])
+
+    if args.output:
+        with open(args.output,"w",encoding="utf-8") as file:
+            json.dump(summaries,file,indent=2)
+
+    return 0
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+    This module puts the RN2483 in Sleep mode between the uplinks and measures the saving
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Power manager
+#
+# Between two uplinks the module waits in receive-ready idle. The gap given by the uplink
+# scheduler (or the interval of the run) is spent in sys sleep instead, minus a wake
+# margin so that the module is awake and resynchronized before the next slot.
+#
+#   wait_slot -> idle(gap) -> sys sleep <gap - margin> ... ok -> remaining wait -> send
+#
+# If the ok of the wake up does not come, the module is woken up by a break and 0x55
+# (autobaud) and the serial link is checked (RN2483.wake_up).
+#
+# Usage :
+#   power = PowerManager(module)
+#   scheduler.wait_slot(power.idle)     or     power.wait(run.interval)
+#   power.metrics()
+#
+# ===
+# Notes
+#   - The energy saved is an estimate from the datasheet currents (RN2483 DS50002346) :
+#     idle current times the time asleep, minus the sleep current.
+#   - The duty is the time asleep over the time since the manager was created, the
+#     transmissions and the receive windows count as awake.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import logging
+import time
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Currents of the module in mA and supply voltage
+IDLE_CURRENT_MA = 2.8
+SLEEP_CURRENT_MA = 0.0016
+SUPPLY_VOLTAGE = 3.3
+
+#Limits of sys sleep in ms
+MIN_SLEEP_MS = 100
+MAX_SLEEP_MS = 4294967296
+
+# #############################################################################
+#
+# Class PowerManager
+#
+
+class PowerManager:
+    """
+    Sleep the RN2483 for the idle gaps
+    """
+    def __init__(self,module,wake_margin:float=0.1,min_sleep:float=0.5,
+                 idle_current_ma:float=IDLE_CURRENT_MA,
+                 sleep_current_ma:float=SLEEP_CURRENT_MA,voltage:float=SUPPLY_VOLTAGE):
+        """
+        Params:
+            module:RN2483 : Module to sleep
+            wake_margin:float : Seconds kept awake before the end of the gap
+            min_sleep:float : Shorter gaps are spent awake
+        """
+        self._module = module
+        self._wake_margin = wake_margin
+        self._min_sleep = max(min_sleep,MIN_SLEEP_MS/1000)
+        self._idle_current_ma = idle_current_ma
+        self._sleep_current_ma = sleep_current_ma
+        self._voltage = voltage
+        self._started = time.monotonic()
+        self.sleeps = 0
+        self.sleep_time = 0.0
+        self.skipped = 0
+        self.forced_wakes = 0
+        self.wake_failures = 0
+
+    def idle(self,seconds:float):
+        """
+        Sleep the module for a gap, returns when it is awake.
+        Params:
+            seconds:float : Gap until the module is needed
+        Returns:
+            bool : True if the module slept
+        """
+        length = seconds - self._wake_margin
+        if length < self._min_sleep:
+            self.skipped += 1
+            return False
+        length_ms = min(int(length*1000),MAX_SLEEP_MS)
+
+        start = time.monotonic()
+        (status_code,response) = self._module.sleep(length_ms)
+        if status_code == 1:
+            logging.warning("sys sleep %s refused : %s",length_ms,response)
+            return False
+        if status_code == 3:
+            #No ok : wake it up ourselves
+            self.forced_wakes += 1
+            (status_code,response) = self._module.wake_up()
+            if status_code != 0:
+                self.wake_failures += 1
+                logging.error("Module not resynchronized after sleep : %s",response)
+        self.sleeps += 1
+        self.sleep_time += min(time.monotonic() - start,length_ms/1000)
+        return True
+
+    def wait(self,seconds:float):
+        """
+        Wait, with the module asleep for most of the time.
+        Params:
+            seconds:float : Time to wait
+        """
+        deadline = time.monotonic() + seconds
+        self.idle(seconds)
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def metrics(self):
+        """
+        Returns:
+            metrics:dict : sleeps, time asleep, sleep duty, estimated energy saved in mJ,
+                skipped gaps, forced wake ups and failed resyncs
+        """
+        elapsed = time.monotonic() - self._started
+        duty = self.sleep_time/elapsed if elapsed > 0 else 0.0
+        saved = self.sleep_time*(self._idle_current_ma - self._sleep_current_ma)*self._voltage
+        return {"sleeps":self.sleeps,"sleep_time":round(self.sleep_time,1),
+                "duty":round(duty,4),"energy_saved_mj":round(saved,1),
+                "skipped":self.skipped,"forced_wakes":self.forced_wakes,
+                "wake_failures":self.wake_failures}
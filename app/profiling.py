@@ -0,0 +1,276 @@
+"""
+    This module gives on demand profiling controls to a running node
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Profiling
+#
+# Nothing runs until a capture is asked, by a signal or on the local command socket :
+#   SIGUSR1              cProfile of the main thread for PROFILE_SECONDS seconds
+#   SIGUSR2              stacks of every thread and dump of the timers, right now
+#   socket commands      (one line, Unix socket PROFILE_SOCKET, e.g. with socat)
+#       profile <seconds>            cProfile of the main thread
+#       sample <seconds> [interval]  stack sampler over every thread (main, paho,
+#                                    serial, ...), collapsed stacks for flamegraph.pl
+#       timers                       dump of the registered timers and counters
+#       stacks                       current stack of every thread
+#
+# Outputs in ./logs : profile-<time>.prof (pstats) and .txt, samples-<time>.txt,
+# timers-<time>.json, stacks-<time>.txt. The socket answers with the file name.
+#
+# Usage :
+#   echo "sample 30 0.01" | socat - UNIX-CONNECT:./logs/profiling.sock
+#   kill -USR1 <pid>
+#
+# ===
+# Notes
+#   - cProfile only sees the thread that enables it. The capture is started and stopped in
+#     the main thread : the socket thread sends SIGUSR1 to the process and the end is a
+#     SIGALRM (setitimer). main() must not use SIGALRM for something else.
+#   - The stack sampler is a thread reading sys._current_frames, it only exists while
+#     sampling.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Where the captures are written
+OUTPUT_DIR = "./logs"
+
+#Functions returning a dict, dumped by the timers command
+_timer_sources = {}
+
+#cProfile capture in progress and duration of the next one
+_profiler = None
+_profile_seconds = 30.0
+_profile_lock = threading.Lock()
+
+# #############################################################################
+#
+# Functions
+#
+
+def _output_path(kind:str,extension:str):
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(OUTPUT_DIR,f"{kind}-{stamp}.{extension}")
+
+def register_timers(name:str,source):
+    """
+    Register a source of timers/counters for the timers dump.
+    Params:
+        name:str : Name in the dump
+        source:Callable[[],dict] : Returns the current values
+    """
+    _timer_sources[name] = source
+
+def dump_timers():
+    """
+    Write the registered timers.
+    Returns:
+        path:str : File written
+    """
+    timers = {}
+    for (name,source) in list(_timer_sources.items()):
+        try:
+            timers[name] = source()
+        except Exception as error:
+            timers[name] = f"error : {error}"
+    path = _output_path("timers","json")
+    with open(path,"w",encoding="utf-8") as file:
+        json.dump(timers,file,indent=2,default=str)
+    return path
+
+def dump_stacks():
+    """
+    Write the current stack of every thread.
+    Returns:
+        path:str : File written
+    """
+    names = {thread.ident:thread.name for thread in threading.enumerate()}
+    path = _output_path("stacks","txt")
+    with open(path,"w",encoding="utf-8") as file:
+        for (ident,frame) in sys._current_frames().items():
+            file.write(f"Thread {names.get(ident,ident)}\n")
+            file.write("".join(traceback.format_stack(frame)))
+            file.write("\n")
+    return path
+
+def sample_stacks(seconds:float,interval:float=0.01):
+    """
+    Sample the stacks of every thread, runs in the calling thread.
+    Params:
+        seconds:float : Duration of the sampling
+        interval:float : Time between two samples
+    Returns:
+        path:str : File written, "thread;caller;...;callee count" lines
+    """
+    own = threading.get_ident()
+    stacks = Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        names = {thread.ident:thread.name for thread in threading.enumerate()}
+        for (ident,frame) in sys._current_frames().items():
+            if ident == own:
+                continue
+            functions = []
+            while frame is not None:
+                code = frame.f_code
+                functions.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                                 f":{frame.f_lineno})")
+                frame = frame.f_back
+            stacks[";".join([names.get(ident,str(ident))] + functions[::-1])] += 1
+        time.sleep(interval)
+
+    path = _output_path("samples","txt")
+    with open(path,"w",encoding="utf-8") as file:
+        for (stack,count) in stacks.most_common():
+            file.write(f"{stack} {count}\n")
+    return path
+
+# #############################################################################
+#
+# cProfile of the main thread
+#
+
+def _start_profile(signum=None,frame=None):
+    """
+    SIGUSR1 handler, start a cProfile capture of the main thread.
+    """
+    global _profiler
+    with _profile_lock:
+        if _profiler is not None:
+            return
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    signal.setitimer(signal.ITIMER_REAL,_profile_seconds)
+    logging.info("cProfile started for %s s",_profile_seconds)
+
+def _stop_profile(signum=None,frame=None):
+    """
+    SIGALRM handler, stop the capture and write it.
+    """
+    global _profiler
+    with _profile_lock:
+        profiler = _profiler
+        _profiler = None
+    if profiler is None:
+        return
+    profiler.disable()
+    path = _output_path("profile","prof")
+    profiler.dump_stats(path)
+    text = io.StringIO()
+    pstats.Stats(profiler,stream=text).sort_stats("cumulative").print_stats(40)
+    with open(path[:-len("prof")] + "txt","w",encoding="utf-8") as file:
+        file.write(text.getvalue())
+    logging.info("cProfile written to %s",path)
+
+def request_profile(seconds:float):
+    """
+    Ask a cProfile capture of the main thread, from any thread.
+    Params:
+        seconds:float : Duration of the capture
+    """
+    global _profile_seconds
+    _profile_seconds = seconds
+    signal.pthread_kill(threading.main_thread().ident,signal.SIGUSR1)
+
+def _dump_all(signum=None,frame=None):
+    """
+    SIGUSR2 handler, dump the stacks and the timers.
+    """
+    logging.info("Stacks : %s, timers : %s",dump_stacks(),dump_timers())
+
+# #############################################################################
+#
+# Command socket
+#
+
+def _handle_command(line:str):
+    """
+    Run a command of the socket.
+    Params:
+        line:str : Command line
+    Returns:
+        answer:str
+    """
+    words = line.split()
+    if not words:
+        return "empty command"
+    try:
+        if words[0] == "profile":
+            seconds = float(words[1]) if len(words) > 1 else _profile_seconds
+            request_profile(seconds)
+            return f"profiling the main thread for {seconds} s, see {OUTPUT_DIR}"
+        if words[0] == "sample":
+            seconds = float(words[1]) if len(words) > 1 else 10.0
+            interval = float(words[2]) if len(words) > 2 else 0.01
+            return sample_stacks(seconds,interval)
+        if words[0] == "timers":
+            return dump_timers()
+        if words[0] == "stacks":
+            return dump_stacks()
+    except ValueError as error:
+        return f"invalid argument : {error}"
+    return f"unknown command {words[0]}, expected profile, sample, timers or stacks"
+
+def _serve(server:socket.socket):
+    while True:
+        (connection,_) = server.accept()
+        with connection:
+            try:
+                line = connection.makefile("r",encoding="utf-8").readline()
+                connection.sendall((_handle_command(line) + "\n").encode("utf-8"))
+            except OSError as error:
+                logging.warning("Profiling socket : %s",error)
+
+def install(socket_path:str=None,profile_seconds:float=None):
+    """
+    Install the signal handlers and start the command socket, the arguments default to
+    the environment. Must be called from the main thread.
+    Params:
+        socket_path:str : PROFILE_SOCKET, Unix socket of the commands, none if empty
+        profile_seconds:float : PROFILE_SECONDS, duration of a SIGUSR1 capture
+    """
+    global _profile_seconds
+
+    if profile_seconds is None:
+        profile_seconds = float(os.getenv('PROFILE_SECONDS', '30'))
+    _profile_seconds = profile_seconds
+    socket_path = socket_path if socket_path is not None else os.getenv('PROFILE_SOCKET', '')
+
+    signal.signal(signal.SIGUSR1,_start_profile)
+    signal.signal(signal.SIGALRM,_stop_profile)
+    signal.signal(signal.SIGUSR2,_dump_all)
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(1)
+        threading.Thread(target=_serve,args=(server,),name="ProfilingSocket",
+                         daemon=True).start()
+        logging.info("Profiling commands on %s",socket_path)
@@ -0,0 +1,121 @@
+"""
+    This module holds the Q-Table grids and the lookup used by q_model
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Q-Table
+#
+# The state is (SNR, TP) and the action is (SF, TP), see README "Model Training".
+#
+# ===
+# Notes
+#   - The lookup accepts scalars or NumPy arrays so the same code serves q_model and
+#     the offline tooling (policy_evaluator).
+#   - This is the NumPy side, for the tooling. The node decides with action_table (the
+#     greedy actions precomputed from the pickle, stdlib only), which also holds the
+#     reloadable QTablePolicy. The grid constants are defined there.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import pickle
+
+import numpy as np
+
+from action_table import (POWER_LEVELS, MAX_SNR_INDEX, ACTIONS, MAPPING_TP,
+                          SNR_TOP_HALF_DB)
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#SNR grid, from 6.5 to -20.5 dB by 0.5 dB steps
+SNR_SPACE = np.linspace(SNR_TOP_HALF_DB/2, (SNR_TOP_HALF_DB - MAX_SNR_INDEX)/2,
+                        MAX_SNR_INDEX + 1)
+
+#Expected shape of a Q-Table
+Q_TABLE_SHAPE = (len(SNR_SPACE), len(POWER_LEVELS), len(ACTIONS))
+
+#Per action lookups, datarate (12-SF) and PWRIDX
+ACTION_DATARATE = np.array([12-sf for (sf,_) in ACTIONS])
+ACTION_PWRIDX = np.array([MAPPING_TP[power] for (_,power) in ACTIONS])
+
+# #############################################################################
+#
+# Functions
+#
+
+def load_q_table(path:str):
+    """
+    Load a pickled Q-Table.
+    Params:
+        path:str : Path to the pickle file
+    Returns:
+        q_table:np.ndarray : Q-Table of shape Q_TABLE_SHAPE
+    """
+    with open(path, 'rb') as f:
+        q_table = pickle.load(f)
+
+    if np.shape(q_table) != Q_TABLE_SHAPE:
+        raise ValueError(f"Invalid Q-Table shape {np.shape(q_table)}, expected {Q_TABLE_SHAPE}")
+
+    return q_table
+
+def state_index(snr,tp):
+    """
+    Compute the Q-Table state indexes, as done by q_model.
+    Params:
+        snr:float|np.ndarray : Signal To Noise Ratio
+        tp:int|np.ndarray : Transmission power given to q_model
+    Returns:
+        (snr_index,tp_index)
+    """
+    snr_index = np.minimum(np.digitize(snr, SNR_SPACE), MAX_SNR_INDEX)
+    tp_index = np.digitize(tp, POWER_LEVELS) - 1
+    return snr_index, tp_index
+
+def best_actions(q_table:np.ndarray):
+    """
+    Precompute the greedy action of every state.
+    Params:
+        q_table:np.ndarray : Q-Table of shape Q_TABLE_SHAPE
+    Returns:
+        action_table:np.ndarray : Action index for each (snr_index,tp_index)
+    """
+    return np.argmax(q_table, axis=2)
+
+def lookup(action_table:np.ndarray,snr,tp):
+    """
+    Get the action of the policy for one or many states.
+    Params:
+        action_table:np.ndarray : Output of best_actions
+        snr:float|np.ndarray : Signal To Noise Ratio
+        tp:int|np.ndarray : Transmission power given to q_model
+    Returns:
+        (action,datarate,transmission_power)
+        action:int|np.ndarray : Index in ACTIONS
+        datarate:int|np.ndarray : 12-SF
+        transmission_power:int|np.ndarray : PWRIDX from 1 to 5
+    """
+    (snr_index,tp_index) = state_index(snr,tp)
+    action = action_table[snr_index,tp_index]
+    return action, ACTION_DATARATE[action], ACTION_PWRIDX[action]
+
+def validate_q_table(q_table:np.ndarray):
+    """
+    Check a Q-Table before using it.
+    Params:
+        q_table:np.ndarray : Loaded table
+    Raises:
+        ValueError : if the shape is wrong or the table holds NaN/inf
+    """
+    if np.shape(q_table) != Q_TABLE_SHAPE:
+        raise ValueError(f"Invalid Q-Table shape {np.shape(q_table)}, expected {Q_TABLE_SHAPE}")
+    if not np.all(np.isfinite(q_table)):
+        raise ValueError("Q-Table holds NaN or infinite values")
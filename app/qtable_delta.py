@@ -0,0 +1,407 @@
+"""
+    This module distributes the Q-Table updates as small checksummed patches
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Q-Table delta
+#
+# The server diffs two versions of a Q-Table and sends the difference instead of the
+# pickle, in chunks small enough for a LoRa downlink (or MQTT messages). The device
+# reassembles the chunks, checks them, applies the patch to its table and swaps the file.
+#
+# Patch modes :
+#   argmax : the states whose greedy action changed, (state, action) pairs, 3 bytes each.
+#            The device raises the new action ARGMAX_MARGIN above the row maximum, its
+#            greedy policy is then the one of the new table.
+#   values : the sparse quantized value deltas, as federated.py (int16, one scale per
+#            patch), 4 bytes per entry. Deltas under the tolerance are not sent.
+#
+# Patch format (little endian) :
+#   header : version (B), mode (B, bit 7 : zlib body), base digest (I), result digest (I),
+#            scale (f), nb entries (H)
+#   body   : argmax : states (nb x uint16, snr_index*5 + tp_index), actions (nb x uint8)
+#            values : flat indexes (nb x uint16), deltas (nb x int16, delta*scale)
+# The digests are CRC32 of the float64 table (table_digest). The patch only applies to
+# the base table and must give the result table, the device table is unchanged otherwise.
+#
+# Chunk format : version (B), patch id (H), index (B), nb chunks (B), then a slice of
+# CRC32(patch) + patch. The id is the low 16 bits of the result digest.
+#
+# Usage (server) :
+#   python3 qtable_delta.py old.pkl new.pkl --mode argmax --device-table device.pkl
+#       prints one hex chunk per line (to queue as downlinks on QTABLE_PATCH_PORT),
+#       or publishes them with --server and --topic (QTABLE_PATCH_TOPIC of the nodes)
+#   device.pkl is the table the devices have after the patch, the base of the next diff
+#
+# ===
+# Notes
+#   - In argmax mode the values of the device table differ from the new table, only the
+#     greedy actions match : keep the --device-table output as the next base.
+#   - A patch already applied (the table digest is the result digest) is ignored.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import argparse
+import logging
+import os
+import pickle
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+import action_table
+import qtable
+from RN2483 import RN2483
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+VERSION = 1
+
+MODE_ARGMAX = 1
+MODE_VALUES = 2
+MODES = {"argmax":MODE_ARGMAX,"values":MODE_VALUES}
+#Bit of the mode byte set when the body is zlib compressed
+COMPRESSED = 0x80
+
+PATCH_HEADER = struct.Struct("<BBIIfH")
+CHUNK_HEADER = struct.Struct("<BHBB")
+
+#Number of (SNR,TP) states and of entries of a Q-Table
+NB_STATES = qtable.Q_TABLE_SHAPE[0]*qtable.Q_TABLE_SHAPE[1]
+TABLE_SIZE = NB_STATES*qtable.Q_TABLE_SHAPE[2]
+
+#Largest quantized delta
+QUANTIZATION_MAX = 32767
+
+#Gap between the new greedy action and the rest of its row (argmax mode)
+ARGMAX_MARGIN = 1.0
+
+#Largest LoRaWAN downlink payload at DR0 (EU868)
+DEFAULT_CHUNK_SIZE = 51
+
+#Default port of the patch downlinks
+PATCH_PORT = 202
+
+# #############################################################################
+#
+# Patches
+#
+
+def table_digest(q_table:np.ndarray):
+    """
+    Identify a table by its content.
+    Params:
+        q_table:np.ndarray : Q-Table
+    Returns:
+        digest:int : CRC32 of the float64 values
+    """
+    return zlib.crc32(np.ascontiguousarray(q_table,dtype="<f8").tobytes())
+
+def _apply(q_table:np.ndarray,mode:int,scale:float,body:bytes,count:int):
+    """
+    Apply a decoded body to a copy of the table.
+    Raises:
+        ValueError : if the body does not match its header
+    """
+    table = np.array(q_table,dtype=np.float64)
+    if mode == MODE_ARGMAX:
+        if len(body) != 3*count:
+            raise ValueError(f"Invalid argmax body length {len(body)} for {count} states")
+        states = np.frombuffer(body,dtype="<u2",count=count).astype(np.intp)
+        actions = np.frombuffer(body,dtype="u1",count=count,offset=2*count).astype(np.intp)
+        if count and (states.max() >= NB_STATES or actions.max() >= qtable.Q_TABLE_SHAPE[2]):
+            raise ValueError("Patch state or action out of the table")
+        rows = table.reshape(NB_STATES,-1)
+        rows[states,actions] = rows[states].max(axis=1) + ARGMAX_MARGIN
+    elif mode == MODE_VALUES:
+        if len(body) != 4*count:
+            raise ValueError(f"Invalid values body length {len(body)} for {count} entries")
+        indexes = np.frombuffer(body,dtype="<u2",count=count).astype(np.intp)
+        deltas = np.frombuffer(body,dtype="<i2",count=count,offset=2*count)
+        if count and indexes.max() >= TABLE_SIZE:
+            raise ValueError("Patch index out of the table")
+        table.ravel()[indexes] += deltas/np.float64(scale)
+    else:
+        raise ValueError(f"Unknown patch mode {mode}")
+    return table
+
+def make_patch(base:np.ndarray,new:np.ndarray,mode:str="argmax",tolerance:float=0.0):
+    """
+    Diff two tables (server side).
+    Params:
+        base:np.ndarray : Table of the devices
+        new:np.ndarray : Retrained table
+        mode:str : argmax or values
+        tolerance:float : Smallest value delta sent (values mode)
+    Returns:
+        (patch,device_table)
+        patch:bytes : Patch to chunk and send
+        device_table:np.ndarray : Table of the devices once patched
+    """
+    qtable.validate_q_table(base)
+    qtable.validate_q_table(new)
+    base = np.asarray(base,dtype=np.float64)
+    scale = np.float32(1.0)
+    if mode == "argmax":
+        base_actions = qtable.best_actions(base).ravel()
+        new_actions = qtable.best_actions(new).ravel()
+        states = np.flatnonzero(base_actions != new_actions)
+        body = states.astype("<u2").tobytes() + new_actions[states].astype("u1").tobytes()
+        count = len(states)
+    elif mode == "values":
+        delta = (np.asarray(new,dtype=np.float64) - base).ravel()
+        indexes = np.flatnonzero(np.abs(delta) > tolerance)
+        largest = float(np.max(np.abs(delta[indexes]))) if len(indexes) else 0.0
+        scale = np.float32(QUANTIZATION_MAX/largest if largest > 0 else 1.0)
+        quantized = np.round(delta[indexes]*np.float64(scale)).astype("<i2")
+        kept = quantized != 0
+        body = indexes[kept].astype("<u2").tobytes() + quantized[kept].tobytes()
+        count = int(np.count_nonzero(kept))
+    else:
+        raise ValueError(f"Unknown patch mode {mode}, expected argmax or values")
+
+    mode_byte = MODES[mode]
+    device_table = _apply(base,mode_byte,scale,body,count)
+    compressed = zlib.compress(body,9)
+    if len(compressed) < len(body):
+        (body,mode_byte) = (compressed,mode_byte | COMPRESSED)
+    header = PATCH_HEADER.pack(VERSION,mode_byte,table_digest(base),
+                               table_digest(device_table),scale,count)
+    return header + body,device_table
+
+def apply_patch(q_table:np.ndarray,patch:bytes):
+    """
+    Apply a patch (device side).
+    Params:
+        q_table:np.ndarray : Current table of the device
+        patch:bytes : Reassembled patch
+    Returns:
+        table:np.ndarray|None : Patched table, None if the patch is already applied
+    Raises:
+        ValueError : if the patch is invalid, or made for another table
+    """
+    if len(patch) < PATCH_HEADER.size:
+        raise ValueError("Truncated patch header")
+    (version,mode,base_digest,result_digest,scale,count) = PATCH_HEADER.unpack_from(patch)
+    if version != VERSION:
+        raise ValueError(f"Unknown patch version {version}")
+    digest = table_digest(q_table)
+    if digest == result_digest:
+        return None
+    if digest != base_digest:
+        raise ValueError(f"Patch made for table {base_digest:08x}, current is {digest:08x}")
+
+    body = patch[PATCH_HEADER.size:]
+    if mode & COMPRESSED:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as error:
+            raise ValueError(f"Invalid patch body : {error}") from error
+    table = _apply(q_table,mode & ~COMPRESSED,scale,body,count)
+    if table_digest(table) != result_digest:
+        raise ValueError(f"Patched table does not match {result_digest:08x}")
+    return table
+
+def install_patch(path:str,patch:bytes):
+    """
+    Apply a patch to a table file, replacing the file in one rename, under
+    action_table.table_lock. The policies still have to be reloaded
+    (action_table.reload_policies or the watcher).
+    Params:
+        path:str : Pickle file of the table
+        patch:bytes : Reassembled patch
+    Returns:
+        bool : True if the file changed, False if the patch was already applied
+    Raises:
+        ValueError : if the patch does not apply, the file is unchanged
+    """
+    with action_table.table_lock:
+        table = apply_patch(qtable.load_q_table(path),patch)
+        if table is None:
+            return False
+        content = pickle.dumps(table)
+        #Action table first, the node reloads it without reducing the pickle
+        action_table.write_action_table(action_table.actions_path(path),
+                                        qtable.best_actions(table).astype("u1").tobytes(),
+                                        zlib.crc32(content))
+        temporary = f"{path}.tmp"
+        with open(temporary,'wb') as f:
+            f.write(content)
+        os.replace(temporary,path)
+        return True
+
+# #############################################################################
+#
+# Chunks
+#
+
+def chunk_patch(patch:bytes,chunk_size:int=DEFAULT_CHUNK_SIZE):
+    """
+    Split a patch in messages.
+    Params:
+        patch:bytes : Output of make_patch
+        chunk_size:int : Max size of a message, header included
+    Returns:
+        chunks:list[bytes]
+    """
+    (_,_,_,result_digest,_,_) = PATCH_HEADER.unpack_from(patch)
+    data = zlib.crc32(patch).to_bytes(4,"little") + patch
+    size = chunk_size - CHUNK_HEADER.size
+    if size <= 0:
+        raise ValueError(f"Chunk size {chunk_size} too small")
+    total = -(-len(data)//size)
+    if total > 255:
+        raise ValueError(f"Patch of {len(patch)} bytes needs {total} chunks, max 255")
+    patch_id = result_digest & 0xFFFF
+    return [CHUNK_HEADER.pack(VERSION,patch_id,index,total) + data[index*size:(index + 1)*size]
+            for index in range(total)]
+
+class PatchAssembler:
+    """
+    Reassembly of the chunks of the patches (device side)
+    """
+    def __init__(self,max_pending:int=2):
+        """
+        Params:
+            max_pending:int : Patches being reassembled at once, the oldest is dropped
+        """
+        self._max_pending = max_pending
+        #patch id -> (nb chunks, {index:data})
+        self._pending = {}
+        self.chunks = 0
+        self.duplicates = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def add(self,chunk:bytes):
+        """
+        Add a chunk.
+        Params:
+            chunk:bytes : Message received
+        Returns:
+            patch:bytes|None : The patch when its last chunk arrives
+        Raises:
+            ValueError : if the chunk is invalid or the patch checksum is wrong
+        """
+        if len(chunk) <= CHUNK_HEADER.size:
+            self.rejected += 1
+            raise ValueError("Truncated chunk")
+        (version,patch_id,index,total) = CHUNK_HEADER.unpack_from(chunk)
+        if version != VERSION or index >= total:
+            self.rejected += 1
+            raise ValueError(f"Invalid chunk version {version}, {index}/{total}")
+        self.chunks += 1
+
+        (expected,parts) = self._pending.get(patch_id,(total,{}))
+        if expected != total:
+            #Same id, other patch : start again
+            parts = {}
+        if index in parts:
+            self.duplicates += 1
+        parts[index] = chunk[CHUNK_HEADER.size:]
+        self._pending.pop(patch_id,None)
+        self._pending[patch_id] = (total,parts)
+        while len(self._pending) > self._max_pending:
+            del self._pending[next(iter(self._pending))]
+        if len(parts) < total:
+            return None
+
+        del self._pending[patch_id]
+        data = b"".join(parts[index] for index in range(total))
+        patch = data[4:]
+        if len(data) < 4 or zlib.crc32(patch) != int.from_bytes(data[:4],"little"):
+            self.rejected += 1
+            raise ValueError(f"Checksum error in patch {patch_id:04x}")
+        self.completed += 1
+        return patch
+
+    def metrics(self):
+        """
+        Returns:
+            metrics:dict : chunks received, duplicates, patches completed, rejected
+        """
+        return {"chunks":self.chunks,"duplicates":self.duplicates,
+                "completed":self.completed,"rejected":self.rejected,
+                "pending":len(self._pending)}
+
+def chunks_from_response(response:list,patch_port:int=PATCH_PORT):
+    """
+    Extract the patch chunks from the response of RN2483.send_uplink.
+    Params:
+        response:list : Lines returned by send_uplink
+        patch_port:int : Port of the patch downlinks
+    Returns:
+        chunks:list[bytes]
+    """
+    chunks = []
+    for line in response:
+        rx = RN2483.parse_mac_rx(line)
+        if rx is not None and rx[0] == patch_port:
+            chunks.append(rx[1])
+    return chunks
+
+# #############################################################################
+#
+# Main
+#
+
+def main():
+    #Command line entry point, diff two tables and print or publish the chunks
+    parser = argparse.ArgumentParser(description="Diff two Q-Tables into patch chunks")
+    parser.add_argument("base",help="Table of the devices")
+    parser.add_argument("new",help="Retrained table")
+    parser.add_argument("--mode",choices=tuple(MODES),default="argmax")
+    parser.add_argument("--tolerance",type=float,default=0.0,
+                        help="Smallest value delta sent (values mode)")
+    parser.add_argument("--chunk-size",type=int,default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--device-table",default=None,
+                        help="Write the table of the devices once patched (next base)")
+    parser.add_argument("--server",default=None,help="MQTT broker to publish the chunks")
+    parser.add_argument("--port",type=int,default=1883)
+    parser.add_argument("--username",default=None)
+    parser.add_argument("--password",default=None)
+    parser.add_argument("--topic",default=None,help="QTABLE_PATCH_TOPIC of the nodes")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    (patch,device_table) = make_patch(qtable.load_q_table(args.base),
+                                      qtable.load_q_table(args.new),args.mode,args.tolerance)
+    chunks = chunk_patch(patch,args.chunk_size)
+    (_,_,_,_,_,count) = PATCH_HEADER.unpack_from(patch)
+    logging.info("%s patch : %s entries, %s bytes in %s chunks",args.mode,count,len(patch),
+                 len(chunks))
+    if args.device_table:
+        with open(args.device_table,'wb') as f:
+            pickle.dump(device_table,f)
+
+    if args.server is None:
+        for chunk in chunks:
+            print(chunk.hex().upper())
+        return 0
+
+    from mqtt_supervisor import MqttSupervisor
+    supervisor = MqttSupervisor(args.server,args.port,None,"qtable-delta",args.username,
+                                args.password)
+    supervisor.start()
+    if not supervisor.wait_connected(10):
+        logging.error("Broker %s:%s not reachable",args.server,args.port)
+        supervisor.stop()
+        return 1
+    for chunk in chunks:
+        supervisor.client.publish(args.topic,chunk,qos=1).wait_for_publish()
+    supervisor.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
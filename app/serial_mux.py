@@ -0,0 +1,601 @@
+"""
+    This module shares the RN2483 serial port between processes through a local daemon
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Serial multiplexer
+#
+# Only one process can open the serial port. The daemon owns it and serves the commands
+# of its clients on a Unix socket, one at a time, by priority :
+#  -1 - wake    break + 0x55, ahead of everything
+#   0 - TX      mac tx, mac join, radio tx/rx
+#   1 - config  mac set, sys, mac save, ...
+#   2 - diag    mac get, sys get, radio get
+# A command with a second response (mac tx, mac join) keeps the port until the second
+# response, no other command can come in between and get busy. The lines no command
+# expects (late mac_tx_ok, mac_rx, ...) are sent to every subscribed client.
+#
+# Protocol : JSON lines on the socket
+#   -> {"id": 1, "command": "mac get dr", "timeout": 1, "priority": null}
+#   <- {"id": 1, "stage": 1, "status": 0, "response": ["5"]}
+#   <- {"id": 1, "stage": 2, ...}                 second response, if the command has one
+#   -> {"id": 2, "op": "wake"}                    break + 0x55, see RN2483.wake_up
+#   -> {"id": 3, "op": "metrics"}                 <- {"id": 3, "metrics": {...}}
+#   -> {"op": "subscribe"}                        <- {"unsolicited": "mac_rx 1 AB"}
+#
+# Usage :
+#   python3 serial_mux.py serve --port /dev/ttyACM0 --socket ./logs/rn2483.sock
+#   python3 serial_mux.py command --socket ./logs/rn2483.sock "mac get dr"
+#   python3 serial_mux.py listen --socket ./logs/rn2483.sock
+#   In app.py : SERIAL_MUX_SOCKET=./logs/rn2483.sock, main() then uses RN2483Client
+#
+# ===
+# Notes
+#   - RN2483Client is an RN2483 whose send_command, read_second_response and wake_up go
+#     through the daemon, every other method is unchanged. Its serial port is never
+#     opened : port, is_open, in_waiting and repr describe the daemon connection, and the
+#     direct reads and writes raise NotImplementedError.
+#   - The unsolicited lines received by a client are routed to its handlers in the
+#     thread calling the module, as with the direct serial port.
+#   - sys sleep does not hold the worker : the command is sent, and its ok (the end of
+#     the sleep) is answered to the client when it comes. A wake, TX or config request
+#     arriving meanwhile wakes the module first (RN2483.wake_up) and the sleeper gets the
+#     result of the wake up, a diagnostic waits for the end of the sleep. POWER_SAVE and
+#     the daemon can then be combined.
+#   - A request that waited in the queue longer than its queue_timeout is dropped, its
+#     client has already given up (status 3).
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+from RN2483 import (RN2483, CommandCounters, FIRST_RESPONSE_TOKENS, command_grammar,
+                    parse_line)
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+PRIORITY_WAKE = -1
+PRIORITY_TX = 0
+PRIORITY_CONFIG = 1
+PRIORITY_DIAG = 2
+
+#Commands of the TX priority
+TX_COMMANDS = ("mac tx","mac join","radio tx","radio rx")
+
+#Max wait of a second response in the daemon, as send_uplink and join_network
+SECOND_RESPONSE_TIMEOUT = 20
+
+#Command answered at the end of the sleep, and wait for its refusal (invalid_param)
+SLEEP_COMMAND = "sys sleep"
+SLEEP_REFUSAL_TIMEOUT = 0.1
+
+# #############################################################################
+#
+# Functions
+#
+
+def command_priority(command:str):
+    """
+    Default priority of a command.
+    Params:
+        command:str : Command of the module
+    Returns:
+        priority:int : PRIORITY_TX, PRIORITY_CONFIG or PRIORITY_DIAG
+    """
+    if command.startswith(TX_COMMANDS):
+        return PRIORITY_TX
+    words = command.split()
+    if len(words) > 1 and words[1] == "get":
+        return PRIORITY_DIAG
+    return PRIORITY_CONFIG
+
+def _send(connection:socket.socket,lock:threading.Lock,message:dict):
+    with lock:
+        connection.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+# #############################################################################
+#
+# Class SerialMux
+#
+
+class _Client:
+    """
+    Connection of a client to the daemon
+    """
+    def __init__(self,connection:socket.socket):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.subscribed = False
+        self.closed = False
+
+    def send(self,message:dict):
+        if self.closed:
+            return
+        try:
+            _send(self.connection,self.lock,message)
+        except OSError:
+            self.closed = True
+
+class SerialMux:
+    """
+    Daemon owning the module, serving its clients by priority
+    """
+    def __init__(self,module:RN2483,socket_path:str):
+        """
+        Params:
+            module:RN2483 : Module on the serial port
+            socket_path:str : Unix socket of the clients
+        """
+        self._module = module
+        self._socket_path = socket_path
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._clients = []
+        self._clients_lock = threading.Lock()
+        self._stop = threading.Event()
+        #(client,request,deadline,start) of the sys sleep in progress, worker only
+        self._sleeper = None
+        self.requests = collections.Counter()
+        self.wait_time = collections.Counter()
+        self.fanned_out = 0
+        self.expired = 0
+        self.sleeps = 0
+        self.interrupted_sleeps = 0
+        module.add_unsolicited_handler(self._fan_out)
+
+    def _fan_out(self,reply):
+        #Unsolicited line of the module, runs in the worker
+        with self._clients_lock:
+            clients = [client for client in self._clients if client.subscribed]
+        for client in clients:
+            client.send({"unsolicited":reply.line})
+        self.fanned_out += 1
+
+    def _serve_client(self,client:_Client):
+        """
+        Read the requests of a client and queue them.
+        """
+        try:
+            for line in client.connection.makefile("r",encoding="utf-8"):
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    client.send({"error":f"not JSON : {line.strip()}"})
+                    continue
+                if request.get("op") == "subscribe":
+                    client.subscribed = True
+                elif request.get("op") == "metrics":
+                    client.send({"id":request.get("id"),"metrics":self.metrics()})
+                elif request.get("op") == "wake":
+                    self._queue.put((PRIORITY_WAKE,next(self._sequence),time.monotonic(),
+                                     client,request))
+                elif "command" in request:
+                    priority = request.get("priority")
+                    if priority is None:
+                        priority = command_priority(request["command"])
+                    self._queue.put((priority,next(self._sequence),time.monotonic(),
+                                     client,request))
+                else:
+                    client.send({"id":request.get("id"),"error":"unknown request"})
+        except OSError:
+            pass
+        finally:
+            client.closed = True
+            with self._clients_lock:
+                self._clients.remove(client)
+            client.connection.close()
+
+    def _start_sleep(self,client:_Client,request:dict):
+        """
+        Send a sys sleep, the worker is released until its ok.
+        """
+        command = request["command"]
+        start = time.perf_counter()
+        self._module.write((command.rstrip()+"\x0d\x0a").encode())
+        reply = self._module.read_reply(FIRST_RESPONSE_TOKENS,
+                                        time.monotonic() + SLEEP_REFUSAL_TIMEOUT)
+        self._sleeper = (client,request,time.monotonic() + float(request.get("timeout",10)),
+                         start)
+        self.sleeps += 1
+        if reply is not None:
+            #Refused, or already over
+            self._end_sleep(0 if reply.status is None else reply.status,[reply.line])
+
+    def _end_sleep(self,status_code:int,response:list):
+        """
+        Answer the client of the sys sleep in progress.
+        """
+        (client,request,_,start) = self._sleeper
+        self._sleeper = None
+        self._module.counters.record(request["command"],status_code,len(response),
+                                     time.perf_counter() - start)
+        client.send({"id":request["id"],"stage":1,"status":status_code,"response":response})
+
+    def _watch_sleep(self):
+        """
+        Read the ok of the sleeping module, give up at the deadline of the sys sleep.
+        """
+        reply = None
+        if self._module.in_waiting:
+            reply = self._module.read_reply(FIRST_RESPONSE_TOKENS,time.monotonic() + 0.05)
+        if reply is not None:
+            self._end_sleep(0 if reply.status is None else reply.status,[reply.line])
+        elif time.monotonic() > self._sleeper[2]:
+            self._end_sleep(3,[])
+
+    def _interrupt_sleep(self):
+        """
+        Wake the module up before a request, the sleeper gets the result of the wake up.
+        Returns:
+            (status_code,response)|None : Result of the wake up, None if it was awake
+        """
+        self._watch_sleep()
+        if self._sleeper is None:
+            return None
+        (status_code,response) = self._module.wake_up()
+        self.interrupted_sleeps += 1
+        self._end_sleep(0 if status_code == 0 else 3,response)
+        return (status_code,response)
+
+    def _execute(self,client:_Client,request:dict):
+        """
+        Run a request on the module and answer the client.
+        """
+        woken = self._interrupt_sleep() if self._sleeper is not None else None
+        if request.get("op") == "wake":
+            (status_code,response) = woken if woken is not None else self._module.wake_up()
+            client.send({"id":request["id"],"stage":1,"status":status_code,
+                         "response":response})
+            return
+        command = request["command"]
+        if command.startswith(SLEEP_COMMAND):
+            self._start_sleep(client,request)
+            return
+        (status_code,response) = self._module.send_command(command,
+                                                           float(request.get("timeout",10)))
+        client.send({"id":request["id"],"stage":1,"status":status_code,"response":response})
+        (_,second) = command_grammar(command)
+        if second is not None and status_code == 0:
+            #The port is kept until the second response
+            (status_code,response) = self._module.read_second_response(
+                command,SECOND_RESPONSE_TIMEOUT)
+            client.send({"id":request["id"],"stage":2,"status":status_code,
+                         "response":response})
+
+    def _work(self):
+        """
+        Execute the requests one at a time, read the unsolicited lines meanwhile.
+        """
+        #Diagnostics arrived during a sys sleep, queued again at its end
+        deferred = []
+        while not self._stop.is_set():
+            if deferred and self._sleeper is None:
+                for item in deferred:
+                    self._queue.put(item)
+                deferred.clear()
+            try:
+                item = self._queue.get(timeout=0.2)
+            except queue.Empty:
+                if self._sleeper is not None:
+                    self._watch_sleep()
+                elif self._module.in_waiting:
+                    #Every line is unsolicited here
+                    self._module.read_reply((),time.monotonic() + 0.05)
+                continue
+            (priority,_,queued_at,client,request) = item
+            if client.closed:
+                continue
+            queue_timeout = request.get("queue_timeout")
+            if queue_timeout is not None and time.monotonic() - queued_at > queue_timeout:
+                self.expired += 1
+                continue
+            if priority >= PRIORITY_DIAG and self._sleeper is not None:
+                #A diagnostic does not wake the module, it waits for the end of the sleep
+                self._watch_sleep()
+                if self._sleeper is not None:
+                    deferred.append(item)
+                    continue
+            self.requests[priority] += 1
+            self.wait_time[priority] += time.monotonic() - queued_at
+            try:
+                self._execute(client,request)
+            except Exception:
+                logging.exception("Request %s failed",request)
+                if self._sleeper is not None and self._sleeper[0] is client:
+                    self._sleeper = None
+                client.send({"id":request.get("id"),"stage":1,"status":1,"response":[]})
+
+    def serve_forever(self):
+        """
+        Accept the clients and execute their requests until stop.
+        """
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        server.bind(self._socket_path)
+        server.listen()
+        server.settimeout(0.5)
+        worker = threading.Thread(target=self._work,name="SerialMuxWorker",daemon=True)
+        worker.start()
+        logging.info("Serving %s on %s",self._module.port,self._socket_path)
+        try:
+            while not self._stop.is_set():
+                try:
+                    (connection,_) = server.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                client = _Client(connection)
+                with self._clients_lock:
+                    self._clients.append(client)
+                threading.Thread(target=self._serve_client,args=(client,),
+                                 name="SerialMuxClient",daemon=True).start()
+        finally:
+            self._stop.set()
+            server.close()
+            worker.join()
+            os.unlink(self._socket_path)
+
+    def stop(self):
+        """
+        Stop serve_forever.
+        """
+        self._stop.set()
+
+    def metrics(self):
+        """
+        Returns:
+            metrics:dict : clients, requests and mean queue wait per priority, queued
+                requests, expired requests, sleeps and sleeps interrupted, unsolicited
+                lines fanned out, serial counters
+        """
+        with self._clients_lock:
+            clients = len(self._clients)
+        mean_wait = {priority:round(self.wait_time[priority]/count,4)
+                     for (priority,count) in self.requests.items()}
+        return {"clients":clients,"requests":dict(self.requests),"mean_wait":mean_wait,
+                "queued":self._queue.qsize(),"expired":self.expired,"sleeps":self.sleeps,
+                "interrupted_sleeps":self.interrupted_sleeps,"fanned_out":self.fanned_out,
+                "serial":self._module.counters.summary()}
+
+# #############################################################################
+#
+# Class MuxClient
+#
+
+class MuxClient:
+    """
+    Connection to the daemon
+    """
+    def __init__(self,socket_path:str,subscribe:bool=True):
+        self._connection = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self._connection.connect(socket_path)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._replies = {}
+        self._replies_lock = threading.Lock()
+        #Unsolicited lines and late second responses, taken by the caller
+        self.unsolicited = collections.deque()
+        self._reader = threading.Thread(target=self._read,name="MuxClientReader",
+                                        daemon=True)
+        self._reader.start()
+        if subscribe:
+            _send(self._connection,self._lock,{"op":"subscribe"})
+
+    def _read(self):
+        try:
+            for line in self._connection.makefile("r",encoding="utf-8"):
+                message = json.loads(line)
+                if "unsolicited" in message:
+                    self.unsolicited.append(message["unsolicited"])
+                    continue
+                with self._replies_lock:
+                    replies = self._replies.get(message.get("id"))
+                if replies is not None:
+                    replies.put(message)
+                elif message.get("stage") == 2:
+                    #Nobody waits anymore, as a late line on the serial port
+                    self.unsolicited.extend(message["response"])
+        except (OSError,ValueError):
+            pass
+
+    def request(self,message:dict):
+        """
+        Send a request.
+        Params:
+            message:dict : Request without its id
+        Returns:
+            id:int : Id of the replies, see reply and release
+        """
+        request_id = next(self._ids)
+        with self._replies_lock:
+            self._replies[request_id] = queue.Queue()
+        _send(self._connection,self._lock,{**message,"id":request_id})
+        return request_id
+
+    def reply(self,request_id:int,timeout:float):
+        """
+        Wait for the next reply of a request.
+        Returns:
+            reply:dict|None : None on timeout
+        """
+        with self._replies_lock:
+            replies = self._replies.get(request_id)
+        if replies is None:
+            return None
+        try:
+            return replies.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self,request_id:int):
+        """
+        Stop waiting for the replies of a request.
+        """
+        with self._replies_lock:
+            self._replies.pop(request_id,None)
+
+    def close(self):
+        self._connection.close()
+
+# #############################################################################
+#
+# Class RN2483Client
+#
+
+class RN2483Client(RN2483):
+    """
+    RN2483 using the port of the daemon
+    """
+    def __init__(self,socket_path:str,queue_timeout:float=30):
+        """
+        Params:
+            socket_path:str : Unix socket of the daemon
+            queue_timeout:float : Extra wait for the commands queued behind others
+        """
+        self.socket_path = socket_path
+        self.counters = CommandCounters()
+        self.unsolicited_handlers = []
+        self._partial = b''
+        self._queue_timeout = queue_timeout
+        self._client = MuxClient(socket_path)
+        self._second = None
+
+    @property
+    def port(self):
+        #The serial port belongs to the daemon
+        return self.socket_path
+
+    @property
+    def is_open(self):
+        return getattr(self,"_client",None) is not None
+
+    @property
+    def in_waiting(self):
+        #The lines of the module come through the daemon, nothing waits here
+        return 0
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}<socket={self.socket_path!r}, open={self.is_open}>"
+
+    def read_line(self,deadline:float):
+        raise NotImplementedError("RN2483Client reads the module through the daemon, "
+                                  "use send_command")
+
+    def write(self,data:bytes):
+        raise NotImplementedError("RN2483Client writes to the module through the daemon, "
+                                  "use send_command")
+
+    def _route_pending(self):
+        while self._client.unsolicited:
+            self._route_unsolicited(parse_line(self._client.unsolicited.popleft()))
+
+    def send_command(self,data:str,timeout:float=10):
+        self._route_pending()
+        start_counter = time.perf_counter()
+        request_id = self._client.request({"command":data.rstrip(),"timeout":timeout,
+                                           "queue_timeout":self._queue_timeout})
+        reply = self._client.reply(request_id,timeout + self._queue_timeout)
+        (status_code,response) = (3,[]) if reply is None else (reply["status"],
+                                                               reply["response"])
+        (_,second) = command_grammar(data)
+        if second is not None and status_code == 0:
+            self._second = request_id
+        else:
+            self._client.release(request_id)
+        self.counters.record(data,status_code,len(response),time.perf_counter() - start_counter)
+        self._route_pending()
+        return (status_code,response)
+
+    def read_second_response(self,data:str,timeout:float=20):
+        request_id = self._second
+        self._second = None
+        if request_id is None:
+            return (3,[])
+        reply = self._client.reply(request_id,timeout)
+        self._client.release(request_id)
+        self._route_pending()
+        if reply is None:
+            return (3,[])
+        return (reply["status"],reply["response"])
+
+    def wake_up(self,break_duration:float=0.01):
+        request_id = self._client.request({"op":"wake","queue_timeout":self._queue_timeout})
+        reply = self._client.reply(request_id,2 + self._queue_timeout)
+        self._client.release(request_id)
+        if reply is None:
+            return (3,[])
+        return (reply["status"],reply["response"])
+
+    def close(self):
+        if getattr(self,"_client",None) is not None:
+            self._client.close()
+            self._client = None
+
+# #############################################################################
+#
+# Main
+#
+
+def main():
+    #Command line entry point
+    parser = argparse.ArgumentParser(description="RN2483 serial port multiplexer")
+    parser.add_argument("mode",choices=("serve","command","listen"))
+    parser.add_argument("--socket",default="./logs/rn2483.sock",help="Unix socket")
+    parser.add_argument("--port",default="/dev/ttyACM0",help="Serial port (serve)")
+    parser.add_argument("--baudrate",type=int,default=57600)
+    parser.add_argument("--priority",type=int,default=None,help="Priority (command)")
+    parser.add_argument("--timeout",type=float,default=10)
+    parser.add_argument("command",nargs="*",help="Command of the module (command)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.mode == "serve":
+        mux = SerialMux(RN2483(args.port,args.baudrate),args.socket)
+        try:
+            mux.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        logging.info("Metrics : %s",mux.metrics())
+    elif args.mode == "command":
+        client = MuxClient(args.socket,subscribe=False)
+        request_id = client.request({"command":" ".join(args.command),"timeout":args.timeout,
+                                     "priority":args.priority})
+        while True:
+            reply = client.reply(request_id,args.timeout + SECOND_RESPONSE_TIMEOUT)
+            if reply is None:
+                break
+            print(reply["status"]," ".join(reply["response"]))
+            if reply["status"] != 0 or \
+                    command_grammar(" ".join(args.command))[1] is None or reply["stage"] == 2:
+                break
+    else:
+        client = MuxClient(args.socket)
+        try:
+            while True:
+                while client.unsolicited:
+                    print(client.unsolicited.popleft())
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
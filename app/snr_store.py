@@ -0,0 +1,423 @@
+"""
+    This module keeps the recent SNR history of every device and gateway in memory
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# SNR store
+#
+# Time series of the LSNR received from the broker, one series per (devaddr, gateway).
+# Each series is a ring buffer bounded in size and age, the samples are in time order so
+# a time range is found by binary search. Rollups per bucket (count, sum, sum of squares,
+# min, max) answer the statistics of long ranges without reading the samples.
+#
+# Usage :
+#   store = SnrStore(retention=3600)
+#   store.add("260B1234","gw-irit",time.time(),-7.5)
+#   store.values("260B1234","gw-irit",t1,t2)       -> array of the LSNR
+#   store.stats("260B1234","gw-irit",t1,t2)        -> count, mean, std, min, max
+#
+# Snapshot format (zlib compressed) :
+#   header : magic "SNRS", version (B), nb series (I)
+#   series : devaddr and gateway (length (B) + utf-8), nb samples (I),
+#            timestamps (float64), lsnr (float32)
+#
+# ===
+# Notes
+#   - The samples of a series must come in time order (they come from one MQTT session),
+#     a late sample is stored with the time of the newest one.
+#   - The rollups are buckets aligned on multiples of rollup_period, only the two partial
+#     buckets at the edges of a range (and the bucket of the oldest sample, which may
+#     have lost samples) are read from the samples.
+#   - Thread safe, the MQTT thread adds while the main loop queries.
+#   - The arrays of a series start small and double up to size. Every rollup_period, add
+#     expires every series and removes the empty ones, so a device that is not heard any
+#     more is forgotten after retention.
+#   - Stdlib arrays (float64 times, float32 LSNR), the node runs without NumPy.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+from array import array
+import math
+import struct
+import sys
+import threading
+import zlib
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+SNAPSHOT_MAGIC = b"SNRS"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sBI")
+
+#Samples of a new series, doubled when it is full up to its size
+INITIAL_CAPACITY = 16
+
+# #############################################################################
+#
+# Class Series
+#
+
+class Series:
+    """
+    Ring buffer of (timestamp, lsnr) of one device on one gateway, with its rollups
+    """
+    def __init__(self,size:int,rollup_period:float):
+        self._size = size
+        capacity = min(size,INITIAL_CAPACITY)
+        self._times = array('d',bytes(8*capacity))
+        self._values = array('f',bytes(4*capacity))
+        self._start = 0
+        self._count = 0
+        self._rollup_period = rollup_period
+        #bucket -> [count, sum, sum of squares, min, max]
+        self._rollups = {}
+
+    def __len__(self):
+        return self._count
+
+    def _position(self,index:int):
+        """
+        Position in the arrays of the index-th oldest sample.
+        """
+        return (self._start + index) % len(self._times)
+
+    def append(self,timestamp:float,value:float):
+        """
+        Add a sample, overwriting the oldest one when the buffer is full.
+        Params:
+            timestamp:float : Time of the sample (time.time())
+            value:float : LSNR
+        """
+        if self._count and timestamp < self.newest():
+            timestamp = self.newest()
+        if self._count == len(self._times):
+            if self._count < self._size:
+                self._grow()
+            else:
+                self._drop_oldest()
+        position = self._position(self._count)
+        self._times[position] = timestamp
+        self._values[position] = value
+        self._count += 1
+
+        bucket = int(timestamp//self._rollup_period)
+        rollup = self._rollups.get(bucket)
+        if rollup is None:
+            self._rollups[bucket] = [1,value,value*value,value,value]
+        else:
+            rollup[0] += 1
+            rollup[1] += value
+            rollup[2] += value*value
+            rollup[3] = min(rollup[3],value)
+            rollup[4] = max(rollup[4],value)
+
+    def _grow(self):
+        """
+        Double the arrays, up to size, the samples are moved to the start.
+        """
+        capacity = min(2*len(self._times),self._size)
+        (times,values) = self.arrays()
+        self._times = times + array('d',bytes(8*(capacity - len(times))))
+        self._values = values + array('f',bytes(4*(capacity - len(values))))
+        self._start = 0
+
+    def _drop_oldest(self):
+        """
+        Remove the oldest sample, and its bucket once it has no sample left.
+        """
+        bucket = int(self._times[self._start]//self._rollup_period)
+        self._start = (self._start + 1) % len(self._times)
+        self._count -= 1
+        if self._count == 0 or int(self._times[self._start]//self._rollup_period) != bucket:
+            self._rollups.pop(bucket,None)
+
+    def expire(self,oldest:float):
+        """
+        Remove the samples older than a time.
+        Params:
+            oldest:float : Oldest time kept
+        """
+        while self._count and self._times[self._start] < oldest:
+            self._drop_oldest()
+
+    def newest(self):
+        """
+        Returns:
+            timestamp:float|None : Time of the newest sample
+        """
+        if self._count == 0:
+            return None
+        return self._times[self._position(self._count - 1)]
+
+    def bisect(self,timestamp:float):
+        """
+        Binary search in time order, O(log n).
+        Params:
+            timestamp:float : Time searched
+        Returns:
+            index:int : Number of samples older than timestamp
+        """
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low + high)//2
+            if self._times[self._position(middle)] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _slice(self,first:int,last:int):
+        """
+        Samples from the index first (included) to last (excluded), oldest first.
+        """
+        size = len(self._times)
+        if last <= first:
+            return array('d'),array('f')
+        begin = self._position(first)
+        end = begin + last - first
+        if end <= size:
+            return self._times[begin:end],self._values[begin:end]
+        return (self._times[begin:] + self._times[:end - size],
+                self._values[begin:] + self._values[:end - size])
+
+    def range(self,start:float,end:float):
+        """
+        Get the samples of a time range.
+        Params:
+            start:float, end:float : Range [start, end)
+        Returns:
+            (times,values) : array, oldest first
+        """
+        return self._slice(self.bisect(start),self.bisect(end))
+
+    def stats(self,start:float,end:float):
+        """
+        Get the statistics of a time range, from the rollups for the complete buckets.
+        Params:
+            start:float, end:float : Range [start, end)
+        Returns:
+            (count,total,squares,minimum,maximum)
+        """
+        if self._count == 0:
+            return _reduce(())
+        period = self._rollup_period
+        first_bucket = int(-(-start//period))
+        #The bucket of the oldest sample may have lost samples, it is read from them
+        first_bucket = max(first_bucket,int(self._times[self._start]//period) + 1)
+        last_bucket = int(end//period)
+        if first_bucket >= last_bucket:
+            return _reduce(self.range(start,end)[1])
+
+        parts = [_reduce(self.range(start,first_bucket*period)[1]),
+                 _reduce(self.range(last_bucket*period,end)[1])]
+        for (bucket,rollup) in self._rollups.items():
+            if first_bucket <= bucket < last_bucket:
+                parts.append(tuple(rollup))
+        return _combine(parts)
+
+    def arrays(self):
+        """
+        Returns:
+            (times,values) : Every sample, oldest first
+        """
+        return self._slice(0,self._count)
+
+# #############################################################################
+#
+# Functions
+#
+
+def _reduce(values):
+    """
+    Statistics of an array of samples.
+    Returns:
+        (count,total,squares,minimum,maximum)
+    """
+    if len(values) == 0:
+        return (0,0.0,0.0,math.inf,-math.inf)
+    return (len(values),math.fsum(values),math.fsum(value*value for value in values),
+            min(values),max(values))
+
+def _little_endian(values:array):
+    """
+    Bytes of an array in little endian, the snapshot byte order.
+    """
+    if sys.byteorder == "big":
+        values = array(values.typecode,values)
+        values.byteswap()
+    return values.tobytes()
+
+def _from_little_endian(typecode:str,data:bytes):
+    """
+    Array from little endian bytes.
+    """
+    values = array(typecode,data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+def _combine(parts:list):
+    """
+    Combine statistics of disjoint parts.
+    Returns:
+        (count,total,squares,minimum,maximum)
+    """
+    return (sum(part[0] for part in parts),sum(part[1] for part in parts),
+            sum(part[2] for part in parts),min(part[3] for part in parts),
+            max(part[4] for part in parts))
+
+# #############################################################################
+#
+# Class SnrStore
+#
+
+class SnrStore:
+    """
+    SNR series of every (devaddr, gateway), bounded in size and age
+    """
+    def __init__(self,retention:float=3600,size:int=1024,rollup_period:float=60):
+        self._retention = retention
+        self._size = size
+        self._rollup_period = rollup_period
+        self._series = {}
+        self._lock = threading.Lock()
+        self._next_sweep = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._series)
+
+    def add(self,devaddr:str,gateway:str,timestamp:float,lsnr:float):
+        """
+        Add a sample.
+        Params:
+            devaddr:str : Device address
+            gateway:str : Gateway that received the uplink
+            timestamp:float : Time of reception (time.time())
+            lsnr:float : LSNR
+        """
+        with self._lock:
+            series = self._series.get((devaddr,gateway))
+            if series is None:
+                series = Series(self._size,self._rollup_period)
+                self._series[(devaddr,gateway)] = series
+            series.append(timestamp,lsnr)
+            series.expire(timestamp - self._retention)
+            if self._next_sweep is None or timestamp >= self._next_sweep:
+                self._sweep(timestamp)
+
+    def _sweep(self,now:float):
+        """
+        Expire every series and remove the empty ones, lock held.
+        Params:
+            now:float : Time of the newest sample
+        """
+        for (key,series) in list(self._series.items()):
+            series.expire(now - self._retention)
+            if len(series) == 0:
+                del self._series[key]
+        self._next_sweep = now + self._rollup_period
+
+    def gateways(self,devaddr:str):
+        """
+        Params:
+            devaddr:str : Device address
+        Returns:
+            gateways:list[str] : Gateways that received the device
+        """
+        with self._lock:
+            return [gateway for (device,gateway) in self._series if device == devaddr]
+
+    def values(self,devaddr:str,gateway:str,start:float,end:float):
+        """
+        Get the LSNR of a time range, e.g. to compute its distribution.
+        Params:
+            devaddr:str : Device address
+            gateway:str : Gateway
+            start:float, end:float : Range [start, end)
+        Returns:
+            values:array : LSNR, oldest first
+        """
+        with self._lock:
+            series = self._series.get((devaddr,gateway))
+            if series is None:
+                return array('f')
+            return series.range(start,end)[1]
+
+    def stats(self,devaddr:str,gateway:str,start:float,end:float):
+        """
+        Get the statistics of a time range.
+        Params:
+            devaddr:str : Device address
+            gateway:str : Gateway
+            start:float, end:float : Range [start, end)
+        Returns:
+            stats:dict : count, mean, std, min, max (None without sample)
+        """
+        with self._lock:
+            series = self._series.get((devaddr,gateway))
+            if series is None:
+                return {"count":0,"mean":None,"std":None,"min":None,"max":None}
+            (count,total,squares,minimum,maximum) = series.stats(start,end)
+        if count == 0:
+            return {"count":0,"mean":None,"std":None,"min":None,"max":None}
+        mean = total/count
+        return {"count":count,"mean":mean,"std":max(squares/count - mean*mean,0.0)**0.5,
+                "min":minimum,"max":maximum}
+
+    def save(self,path:str):
+        """
+        Write a snapshot of every series.
+        Params:
+            path:str : Snapshot file
+        """
+        with self._lock:
+            chunks = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC,SNAPSHOT_VERSION,len(self._series))]
+            for ((devaddr,gateway),series) in self._series.items():
+                (times,values) = series.arrays()
+                for name in (devaddr,gateway):
+                    encoded = name.encode("utf-8")
+                    chunks.append(struct.pack("<B",len(encoded)) + encoded)
+                chunks.append(struct.pack("<I",len(times)))
+                chunks.append(_little_endian(times))
+                chunks.append(_little_endian(values))
+        with open(path,"wb") as file:
+            file.write(zlib.compress(b"".join(chunks)))
+
+    def load(self,path:str):
+        """
+        Add the samples of a snapshot.
+        Params:
+            path:str : Snapshot file written by save
+        """
+        with open(path,"rb") as file:
+            data = zlib.decompress(file.read())
+        (magic,version,nb_series) = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} SNR snapshot")
+
+        offset = SNAPSHOT_HEADER.size
+        for _ in range(nb_series):
+            names = []
+            for _ in range(2):
+                length = data[offset]
+                names.append(data[offset + 1:offset + 1 + length].decode("utf-8"))
+                offset += 1 + length
+            (count,) = struct.unpack_from("<I",data,offset)
+            offset += 4
+            times = _from_little_endian('d',data[offset:offset + 8*count])
+            offset += 8*count
+            values = _from_little_endian('f',data[offset:offset + 4*count])
+            offset += 4*count
+            for (timestamp,value) in zip(times,values):
+                self.add(names[0],names[1],timestamp,value)
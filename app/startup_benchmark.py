@@ -0,0 +1,126 @@
+"""
+    This module measures the startup cost of the decision path, with and without NumPy
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Startup benchmark
+#
+# Each path runs in a fresh interpreter, from the imports of the node modules to the first
+# q_model decision (what precedes the first uplink, the serial link apart) :
+#   runtime : action_table, the precomputed .actions file and the integer binning
+#   numpy   : the former path, pickle + np.digitize + np.argmax through qtable
+# Reported : wall time of the process, time of the imports and first decision, peak RSS,
+# and whether NumPy was imported.
+#
+# Usage :
+#   python3 startup_benchmark.py ./config/Q_model-LORA-rob.pkl --repeat 5
+#
+# ===
+# Notes
+#   - The .actions file is written first if missing, by action_table.py in another
+#     process : ru_maxrss of a child starts from the RSS of its parent at the fork.
+#   - Peak RSS is VmHWM of /proc/self/status, ru_maxrss where there is no /proc.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Node modules imported by app.py before the first decision
+NODE_MODULES = ("RN2483","feedback_window","snr_store","campaign","uplink_aggregator",
+                "feedback_mailbox","uplink_scheduler","cycle_trace")
+
+#Code of each path, run with the table path in TABLE
+PATHS = {
+    "runtime":"import action_table\n"
+              "action = action_table.get_policy(TABLE).decide(-7.5,1)[0]\n",
+    "numpy":"import qtable\n"
+            "action = int(qtable.lookup(qtable.best_actions(qtable.load_q_table(TABLE)),"
+            "-7.5,1)[0])\n",
+}
+
+PROBE = """
+import json,resource,sys,time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+TABLE = {table!r}
+{code}
+elapsed = time.perf_counter() - start
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+try:
+    with open("/proc/self/status") as status:
+        rss_kb = int(next(line for line in status if line.startswith("VmHWM")).split()[1])
+except (OSError,StopIteration):
+    pass
+print(json.dumps({{"elapsed":elapsed,"action":action,"numpy":"numpy" in sys.modules,
+                  "rss_kb":rss_kb}}))
+"""
+
+# #############################################################################
+#
+# Functions
+#
+
+def run_path(name:str,table:str):
+    """
+    Run a path in a fresh interpreter.
+    Params:
+        name:str : Key of PATHS
+        table:str : Q-Table pickle
+    Returns:
+        result:dict : wall, elapsed (imports and decision), action, numpy, rss_kb
+    """
+    probe = PROBE.format(modules=NODE_MODULES,table=table,code=PATHS[name])
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable,"-c",probe],capture_output=True,text=True,
+                            check=True,cwd=os.path.dirname(os.path.abspath(__file__)))
+    wall = time.perf_counter() - start
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    result["wall"] = wall
+    return result
+
+def main():
+    #Command line entry point
+    parser = argparse.ArgumentParser(description="Startup cost of the decision path")
+    parser.add_argument("table",help="Q-Table pickle")
+    parser.add_argument("--repeat",type=int,default=5)
+    args = parser.parse_args()
+    table = os.path.abspath(args.table)
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    if not os.path.exists(os.path.splitext(table)[0] + ".actions"):
+        subprocess.run([sys.executable,os.path.join(directory,"action_table.py"),table],
+                       check=True)
+
+    results = {}
+    for name in PATHS:
+        runs = [run_path(name,table) for _ in range(args.repeat)]
+        results[name] = runs
+        print(f"{name:8s} wall {statistics.median(r['wall'] for r in runs)*1000:7.1f} ms"
+              f"   imports+decision {statistics.median(r['elapsed'] for r in runs)*1000:7.1f} ms"
+              f"   peak RSS {statistics.median(r['rss_kb'] for r in runs)/1024:6.1f} MB"
+              f"   numpy {runs[0]['numpy']}   action {runs[0]['action']}")
+    if results["runtime"][0]["action"] != results["numpy"][0]["action"]:
+        print("The two paths decided differently")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
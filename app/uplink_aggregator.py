@@ -0,0 +1,207 @@
+"""
+    This module packs the sensor samples into uplinks as large as the datarate allows
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Uplink aggregator
+#
+# The samples are queued and sent together, one uplink carries as many whole samples as
+# the maximum application payload of the current datarate allows (51/115/222 bytes, see
+# lora_phy.MAX_PAYLOAD). The queue is flushed when the next sample would not fit, or when
+# the oldest sample has waited max_delay seconds.
+#
+# Payload format :
+#   [length (1 byte)][sample (length bytes)] repeated
+#
+# ===
+# Notes
+#   - The limit of a datarate is lowered when the module answers invalid_data_len (MAC
+#     commands piggybacked in FOpts take room from the application payload), the samples
+#     are put back at the head of the queue and sent in a smaller uplink.
+#   - A sample must fit in the smallest payload (50 bytes plus its length).
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import time
+from collections import deque
+
+import lora_phy
+
+# #############################################################################
+#
+# Global Variables & Configs
+#
+
+#Length prefix of each sample
+SAMPLE_HEADER = 1
+
+#Largest sample, it must fit in the payload of the lowest datarate
+MAX_SAMPLE_LEN = min(lora_phy.MAX_PAYLOAD.values()) - SAMPLE_HEADER
+
+# #############################################################################
+#
+# Functions
+#
+
+def unpack_samples(payload:bytes):
+    """
+    Split an aggregated payload (network side).
+    Params:
+        payload:bytes : Payload of the uplink
+    Returns:
+        samples:list[bytes]
+    Raises:
+        ValueError : if the payload is truncated
+    """
+    samples = []
+    offset = 0
+    while offset < len(payload):
+        length = payload[offset]
+        offset += SAMPLE_HEADER
+        if offset + length > len(payload):
+            raise ValueError(f"Truncated sample at offset {offset} in {payload.hex()}")
+        samples.append(payload[offset:offset + length])
+        offset += length
+    return samples
+
+# #############################################################################
+#
+# Class UplinkAggregator
+#
+
+class UplinkAggregator:
+    """
+    Queue of samples, flushed into uplinks of the maximum size of the datarate
+    """
+    def __init__(self,max_delay:float=60):
+        self._max_delay = max_delay
+        self._samples = deque()
+        self._pending_bytes = 0
+        self._largest = 0
+        self._limits = dict(lora_phy.MAX_PAYLOAD)
+        self.samples_sent = 0
+        self.uplinks = 0
+        self.bytes_sent = 0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self,sample:bytes,now:float=None):
+        """
+        Queue a sample.
+        Params:
+            sample:bytes : Sample, at most MAX_SAMPLE_LEN bytes
+            now:float : time.monotonic() value, default now
+        """
+        if len(sample) > MAX_SAMPLE_LEN:
+            raise ValueError(f"Sample of {len(sample)} bytes, max {MAX_SAMPLE_LEN}")
+        if now is None:
+            now = time.monotonic()
+        self._samples.append((now,sample))
+        self._pending_bytes += SAMPLE_HEADER + len(sample)
+        self._largest = max(self._largest,SAMPLE_HEADER + len(sample))
+
+    def limit(self,datarate:int):
+        """
+        Params:
+            datarate:int : Datarate from 0 to 5
+        Returns:
+            limit:int : Maximum application payload in bytes
+        """
+        return self._limits[datarate]
+
+    def should_flush(self,datarate:int,now:float=None):
+        """
+        Tell if an uplink must be sent.
+        Params:
+            datarate:int : Datarate of the next uplink
+            now:float : time.monotonic() value, default now
+        Returns:
+            bool : True if another sample would not fit or the oldest one is too old
+        """
+        if not self._samples:
+            return False
+        if self._pending_bytes + self._largest > self._limits[datarate]:
+            return True
+        if now is None:
+            now = time.monotonic()
+        return now - self._samples[0][0] >= self._max_delay
+
+    def take_payload(self,datarate:int):
+        """
+        Remove the oldest samples that fit in one uplink.
+        Params:
+            datarate:int : Datarate of the uplink
+        Returns:
+            (payload,samples)
+            payload:bytes : Aggregated payload
+            samples:list : Samples taken, give them back to restore if the uplink fails
+        """
+        limit = self._limits[datarate]
+        samples = []
+        size = 0
+        while self._samples and size + SAMPLE_HEADER + len(self._samples[0][1]) <= limit:
+            samples.append(self._samples.popleft())
+            size += SAMPLE_HEADER + len(samples[-1][1])
+        self._pending_bytes -= size
+        if not self._samples:
+            self._largest = 0
+
+        payload = b"".join(bytes((len(sample),)) + sample for (_,sample) in samples)
+        return payload,samples
+
+    def restore(self,samples:list):
+        """
+        Put back samples taken by take_payload at the head of the queue.
+        Params:
+            samples:list : Samples returned by take_payload
+        """
+        for (added,sample) in reversed(samples):
+            self._samples.appendleft((added,sample))
+            self._pending_bytes += SAMPLE_HEADER + len(sample)
+            self._largest = max(self._largest,SAMPLE_HEADER + len(sample))
+
+    def sent(self,payload:bytes,samples:list):
+        """
+        Count an uplink accepted by the module.
+        Params:
+            payload:bytes : Payload sent
+            samples:list : Samples it carried
+        """
+        self.uplinks += 1
+        self.samples_sent += len(samples)
+        self.bytes_sent += len(payload)
+
+    def too_long(self,datarate:int,payload:bytes,samples:list):
+        """
+        Handle an invalid_data_len answer, lower the limit of the datarate and put back
+        the samples.
+        Params:
+            datarate:int : Datarate of the uplink
+            payload:bytes : Payload refused
+            samples:list : Samples it carried
+        Returns:
+            bool : True if the samples were put back, False if they are dropped (the
+                payload was already at the smallest limit)
+        """
+        floor = SAMPLE_HEADER + MAX_SAMPLE_LEN
+        if len(payload) <= floor:
+            return False
+        self._limits[datarate] = max(min(self._limits[datarate],len(payload) - 1),floor)
+        self.restore(samples)
+        return True
+
+    def metrics(self):
+        """
+        Returns:
+            metrics:dict : uplinks, samples and bytes sent, samples per uplink, queued
+        """
+        per_uplink = self.samples_sent/self.uplinks if self.uplinks else 0.0
+        return {"uplinks":self.uplinks,"samples":self.samples_sent,"bytes":self.bytes_sent,
+                "samples_per_uplink":round(per_uplink,2),"queued":len(self._samples)}
@@ -0,0 +1,208 @@
+"""
+    This module schedules the uplinks on a fixed cadence and stages the feedback decisions
+"""
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# Uplink scheduler
+#
+# The uplinks are sent in slots every period seconds (plus a random jitter), instead of as
+# fast as the serial link allows. The feedback is handled by a worker thread as soon as it
+# arrives in the mailbox, even while send_uplink is waiting for the end of a transmission : the decision
+# is computed there and staged, the main loop applies it at the next slot.
+#
+#   feedback -> FeedbackMailbox -> FeedbackWorker -> decide() -> StagedDecision -> next slot : apply + send
+#
+# ===
+# Notes
+#   - A slot missed by more than deadline seconds (long transmission, duty cycle) is
+#     skipped, the cadence is kept instead of sending a burst to catch up.
+#   - Only the newest staged decision is applied, a newer one replaces a pending one.
+# ===
+# oct.26  creation
+#
+
+# #############################################################################
+#
+# Import zone
+#
+import logging
+import random
+import threading
+import time
+
+# #############################################################################
+#
+# Class UplinkScheduler
+#
+
+class UplinkScheduler:
+    """
+    Slots every period seconds, with a jitter and a deadline
+    """
+    def __init__(self,period:float,jitter:float=0,deadline:float=None):
+        if period <= 0 or jitter < 0 or jitter >= period:
+            raise ValueError(f"Invalid period {period} or jitter {jitter}")
+        self._period = period
+        self._jitter = jitter
+        self._deadline = deadline if deadline is not None else period/2
+        self._stop = threading.Event()
+        self._next_index = 0
+        self._origin = None
+        self.slots = 0
+        self.missed = 0
+        self.total_lateness = 0.0
+
+    def _slot_time(self,index:int):
+        return (self._origin + index*self._period
+                + random.uniform(-self._jitter,self._jitter))
+
+    def wait_slot(self,idle=None):
+        """
+        Wait for the next slot, skipping the slots missed by more than the deadline.
+        Params:
+            idle:Callable[[float],any] : Called with the gap to the slot before waiting,
+                e.g. PowerManager.idle to sleep the module meanwhile
+        Returns:
+            bool : False if the scheduler was stopped
+        """
+        now = time.monotonic()
+        if self._origin is None:
+            self._origin = now
+        slot = max(self._slot_time(self._next_index),self._origin)
+        while now - slot > self._deadline:
+            self.missed += 1
+            self._next_index += 1
+            slot = self._slot_time(self._next_index)
+        self._next_index += 1
+
+        if idle is not None and slot > now and not self._stop.is_set():
+            idle(slot - now)
+            now = time.monotonic()
+        if self._stop.wait(max(slot - now,0)):
+            return False
+        self.slots += 1
+        self.total_lateness += max(time.monotonic() - slot,0)
+        return True
+
+    def stop(self):
+        """
+        Wake up and stop wait_slot.
+        """
+        self._stop.set()
+
+    def metrics(self):
+        """
+        Returns:
+            metrics:dict : slots used, slots missed, mean lateness in seconds
+        """
+        lateness = self.total_lateness/self.slots if self.slots else 0.0
+        return {"slots":self.slots,"missed":self.missed,"mean_lateness":round(lateness,4)}
+
+# #############################################################################
+#
+# Class StagedDecision
+#
+
+class StagedDecision:
+    """
+    Newest decision waiting for the next slot
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._decision = None
+        self._staged_at = None
+        self.staged = 0
+        self.applied = 0
+        self.replaced = 0
+        self.total_latency = 0.0
+
+    def stage(self,decision:tuple,received_at:float):
+        """
+        Stage a decision, replacing the pending one.
+        Params:
+            decision:tuple : (datarate,pwridx,source)
+            received_at:float : time.monotonic() of the feedback
+        """
+        with self._lock:
+            if self._decision is not None:
+                self.replaced += 1
+            self._decision = decision
+            self._staged_at = received_at
+            self.staged += 1
+
+    def take(self):
+        """
+        Take the pending decision.
+        Returns:
+            decision:tuple|None : (datarate,pwridx,source)
+        """
+        with self._lock:
+            decision = self._decision
+            if decision is not None:
+                self.applied += 1
+                self.total_latency += time.monotonic() - self._staged_at
+                self._decision = None
+            return decision
+
+    def discard(self):
+        """
+        Drop the pending decision.
+        """
+        with self._lock:
+            self._decision = None
+
+    def metrics(self):
+        """
+        Returns:
+            metrics:dict : staged, applied, replaced, mean feedback to apply latency
+        """
+        with self._lock:
+            latency = self.total_latency/self.applied if self.applied else 0.0
+            return {"staged":self.staged,"applied":self.applied,"replaced":self.replaced,
+                    "mean_latency":round(latency,4)}
+
+# #############################################################################
+#
+# Class FeedbackWorker
+#
+
+class FeedbackWorker(threading.Thread):
+    """
+    Consume the feedback mailbox and stage the decisions as soon as the feedback arrives
+    """
+    def __init__(self,mailbox,devaddr:str,decide,staged:StagedDecision):
+        """
+        Params:
+            mailbox:FeedbackMailbox : Newest feedback per device
+            devaddr:str : Device of the node
+            decide:Callable[[dict,int],tuple|None] : Gets the newest message and the number
+                of frames coalesced into it, returns (datarate,pwridx,source) or None
+            staged:StagedDecision : Where the decisions go
+        """
+        super().__init__(name="FeedbackWorker",daemon=True)
+        self._mailbox = mailbox
+        self._devaddr = devaddr
+        self._decide = decide
+        self._staged = staged
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            item = self._mailbox.get(self._devaddr,timeout=0.5)
+            if item is None:
+                continue
+            (message,coalesced,received_at) = item
+            try:
+                decision = self._decide(message,coalesced)
+            except Exception:
+                logging.exception("Feedback decision failed")
+                continue
+            if decision is not None:
+                self._staged.stage(decision,received_at)
+
+    def stop(self):
+        """
+        Stop the thread after the current decision.
+        """
+        self._stop_event.set()
@@ -0,0 +1,7 @@
+"""
+    Test configuration, the modules of the node are imported from app/
+"""
+import os
+import sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","app"))
@@ -0,0 +1,56 @@
+"""
+    Tests of linkcheck_feedback
+"""
+import pytest
+
+import lora_phy
+from linkcheck_feedback import LinkCheckFeedback
+
+class FakeModule:
+    """
+    Module returning the given (gateways,margin) readings, one per link check
+    """
+    def __init__(self,readings:list):
+        self._readings = list(readings)
+        self._current = None
+
+    def set_linkchk(self,interval:int):
+        return (0,["ok"])
+
+    def get_gateway_count(self):
+        self._current = self._readings.pop(0)
+        return (0,self._current[0])
+
+    def get_margin(self):
+        return (0,self._current[1])
+
+def check(feedback:LinkCheckFeedback,datarate:int):
+    #Expire the interval, then read the answer of the uplink
+    feedback._armed_at -= feedback._interval
+    return feedback.after_uplink(datarate)
+
+def required_snr(datarate:int):
+    return lora_phy.REQUIRED_SNR[lora_phy.datarate_to_sf(datarate)]
+
+def test_identical_answers_are_accepted():
+    feedback = LinkCheckFeedback(FakeModule([(1,20),(1,20)]),60)
+    feedback.start()
+    assert check(feedback,0) == pytest.approx(20 + required_snr(0))
+    assert check(feedback,0) == pytest.approx(20 + required_snr(0))
+    assert feedback.metrics()["answers"] == 2
+    assert feedback.metrics()["stale"] == 0
+
+def test_repeat_after_a_datarate_change_is_stale():
+    feedback = LinkCheckFeedback(FakeModule([(1,25),(1,25),(1,15)]),60)
+    feedback.start()
+    assert check(feedback,0) == pytest.approx(25 + required_snr(0))
+    assert check(feedback,5) is None
+    assert check(feedback,5) == pytest.approx(15 + required_snr(5))
+    assert feedback.metrics()["stale"] == 1
+    assert feedback.metrics()["last_datarate"] == 5
+
+def test_no_gateway_is_no_answer():
+    feedback = LinkCheckFeedback(FakeModule([(0,0)]),60)
+    feedback.start()
+    assert check(feedback,0) is None
+    assert feedback.metrics()["answers"] == 0
@@ -0,0 +1,119 @@
+"""
+    Tests of serial_mux
+"""
+import socket
+import threading
+import time
+
+import pytest
+
+from RN2483 import CommandCounters, parse_line
+import serial_mux
+from serial_mux import RN2483Client, SerialMux
+
+class FakeModule:
+    """
+    Sleeping module, its ok comes when end_sleep is called
+    """
+    def __init__(self):
+        self.counters = CommandCounters()
+        self.commands = []
+        self.wake_ups = 0
+        self._ok = threading.Event()
+
+    def add_unsolicited_handler(self,handler):
+        pass
+
+    @property
+    def in_waiting(self):
+        return 1 if self._ok.is_set() else 0
+
+    def read_reply(self,expected,deadline:float):
+        if self._ok.is_set():
+            self._ok.clear()
+            return parse_line("ok")
+        return None
+
+    def end_sleep(self):
+        self._ok.set()
+
+    def wake_up(self):
+        self.wake_ups += 1
+        return (0,["RN2483 1.0.5"])
+
+    def send_command(self,command:str,timeout:float):
+        self.commands.append(command)
+        return (0,["5"])
+
+class FakeClient:
+    """
+    Client of the daemon keeping its answers
+    """
+    def __init__(self):
+        self.closed = False
+        self.sent = []
+
+    def send(self,message:dict):
+        self.sent.append(message)
+
+def wait_for(condition,timeout:float=2):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+def test_diag_waits_for_the_end_of_the_sleep(tmp_path):
+    module = FakeModule()
+    mux = SerialMux(module,str(tmp_path / "mux.sock"))
+    (sleeper,client) = (FakeClient(),FakeClient())
+    mux._sleeper = (sleeper,{"id":1,"command":"sys sleep 10000"},time.monotonic() + 60,
+                    time.perf_counter())
+    mux._queue.put((serial_mux.PRIORITY_DIAG,0,time.monotonic(),client,
+                    {"id":2,"command":"mac get dr","timeout":1}))
+    worker = threading.Thread(target=mux._work,daemon=True)
+    worker.start()
+    try:
+        time.sleep(0.5)
+        assert module.wake_ups == 0
+        assert module.commands == []
+        module.end_sleep()
+        assert wait_for(lambda: module.commands == ["mac get dr"])
+        assert module.wake_ups == 0
+        assert sleeper.sent[0]["status"] == 0
+    finally:
+        mux._stop.set()
+        worker.join(timeout=2)
+
+def test_config_interrupts_the_sleep(tmp_path):
+    module = FakeModule()
+    mux = SerialMux(module,str(tmp_path / "mux.sock"))
+    (sleeper,client) = (FakeClient(),FakeClient())
+    mux._sleeper = (sleeper,{"id":1,"command":"sys sleep 10000"},time.monotonic() + 60,
+                    time.perf_counter())
+    mux._queue.put((serial_mux.PRIORITY_CONFIG,0,time.monotonic(),client,
+                    {"id":2,"command":"mac set dr 5","timeout":1}))
+    worker = threading.Thread(target=mux._work,daemon=True)
+    worker.start()
+    try:
+        assert wait_for(lambda: module.commands == ["mac set dr 5"])
+        assert module.wake_ups == 1
+    finally:
+        mux._stop.set()
+        worker.join(timeout=2)
+
+def test_client_serial_surface(tmp_path):
+    path = str(tmp_path / "mux.sock")
+    server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    try:
+        client = RN2483Client(path)
+        assert client.port == path
+        assert client.in_waiting == 0
+        assert path in repr(client)
+        with pytest.raises(NotImplementedError):
+            client.read_line(time.monotonic() + 1)
+        client.close()
+        assert not client.is_open
+    finally:
+        server.close()
@@ -0,0 +1,14 @@
+"""
+    Tests of uplink_scheduler
+"""
+from feedback_mailbox import FeedbackMailbox
+from uplink_scheduler import FeedbackWorker, StagedDecision
+
+def test_feedback_worker_stops_and_joins():
+    worker = FeedbackWorker(FeedbackMailbox(),"0000",lambda message,coalesced: None,
+                            StagedDecision())
+    worker.start()
+    assert worker.is_alive()
+    worker.stop()
+    worker.join(timeout=5)
+    assert not worker.is_alive()